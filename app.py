@@ -1,80 +1,282 @@
-import os, sys, logging, asyncio, hypercorn.asyncio, debugpy  # Core libraries and async server
+import os, sys, time, signal, logging, asyncio, hypercorn.asyncio, debugpy  # Core libraries and async server
 from quart import Quart, current_app, request, jsonify, Blueprint  # Quart framework imports
 from services import config  # Configuration module
 from services.cache import Cache  # Caching mechanism for API interactions
+from services.inference_cache import InferenceCache  # Persistent cache for AI results
+from services.queue import PersistentQueue  # Durable processing queue
+from services.backfill import Backfill  # Bulk processing of existing documents
+from services.bulk import BulkEditor, TagBatcher  # Batch mutations via the Paperless bulk edit endpoint
+from services.admission import AdmissionController  # Rate limits and load shedding of webhooks
+from services.resilience import CircuitOpenError  # Raised while a backend is down
+from services.metrics import DOCUMENTS  # Outcome counters of the queue entries
 from routes.documents import documents_bp  
 from routes.status import status_bp  
 from routes.frontend import frontend_bp  
-from routes.processing import process_queue, processing_bp  
+from routes.processing import process_queue, processing_bp, merge_entries, describe_entry  
+from routes.backfill import backfill_bp  
+from routes.metrics import metrics_bp  
 
 # Create a Quart application instance
 app = Quart(__name__)
 
-# Global request queue for handling asynchronous processing
-request_queue = asyncio.Queue()
-
 # Register application blueprints for different API functionalities
 app.register_blueprint(documents_bp)  
 app.register_blueprint(status_bp)  
 app.register_blueprint(frontend_bp)  
 app.register_blueprint(processing_bp)  
+app.register_blueprint(backfill_bp)  
+app.register_blueprint(metrics_bp)  
 
 # Event for handling server shutdown gracefully
 shutdown_event = asyncio.Event()
+app.config["SHUTDOWN"] = shutdown_event  # Lets the routes reject new work during the shutdown
 
 """ 
 Gracefully shuts down the Quart server.
-Logs the shutdown event, sets the shutdown flag, 
-waits briefly for cleanup, and exits the process.
+- Sets the shutdown flag, new webhooks are rejected and the backfill stops
+- Lets the workers finish the entries they are processing, up to SHUTDOWN_TIMEOUT seconds
+- Returns the entries which did not finish in time to the queue
+- Writes the buffered tag changes, acknowledges the entries they belong to and exits the process
 """
 async def stopServer():
     logging.info("Server is shutting down...")
     shutdown_event.set()  # Set shutdown event flag
-    await asyncio.sleep(1)  # Small delay to allow cleanup
+    start = time.monotonic()
+
+    backfill = app.config.get("BACKFILL")
+    if backfill is not None:
+        await backfill.stop()  # Continues from its checkpoint after the restart
+
+    abandoned = await drainWorkers(app.config["SHUTDOWN_TIMEOUT"])
+    if app.config.get("CACHE") is not None:
+        app.config["CACHE"].stopRefresher()
+
+    batcher = app.config.get("TAG_BATCHER")
+    if batcher is not None:
+        try:
+            await batcher.flush()  # Tags of documents which are already processed
+        except Exception as e:
+            logging.error(f"Writing the buffered tags failed: {e}")
+    await asyncio.gather(*app.config.get("TAGGING_ENTRIES", ()), return_exceptions=True)
+
+    logging.info(f"Drained the queue workers in {time.monotonic() - start:.1f}s, {abandoned} unfinished entries were returned to the queue")
     sys.exit(0)  # Terminate the process
 
+"""
+Starts the shutdown once, repeated signals are ignored.
+"""
+def requestShutdown():
+    if app.config.get("SHUTDOWN_TASK") is None:
+        app.config["SHUTDOWN_TASK"] = asyncio.create_task(stopServer())
+
+"""
+Stops the queue workers. Idle workers are stopped right away, busy workers may finish
+their entry until the timeout and are cancelled afterwards. A cancelled worker returns
+its entry to the queue, it is processed again after the restart.
+
+Parameters:
+- timeout (float): Seconds the busy workers may take to finish.
+
+Returns:
+- int: Number of entries which did not finish in time.
+"""
+async def drainWorkers(timeout: float) -> int:
+    tasks = [task for task in app.config.get("WORKER_TASKS") or [] if not task.done()]
+    workers = app.config.get("WORKERS", {})
+    busy = [worker_id for worker_id, worker in workers.items() if worker["state"] == "busy"]
+    if busy:
+        logging.info(f"Waiting up to {timeout}s for the workers {busy} to finish")
+    for worker_id, task in enumerate(app.config.get("WORKER_TASKS") or []):
+        if worker_id not in busy:
+            task.cancel()  # Idle or waiting for a connection, nothing to finish
+    if not tasks:
+        return 0
+
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    abandoned = sum(1 for worker in workers.values() if worker["state"] == "busy")
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)  # Wait until the entries are returned to the queue
+    if abandoned:
+        logging.warning(f"{abandoned} queue entries did not finish within {timeout}s")
+    return abandoned
+
 """ 
 Background worker that continuously processes queued requests.
-- Waits for new tasks in `request_queue`
+- Stops once the server shuts down, an entry in progress is finished first
+- Waits until the AI and Paperless connections are ready
+- Pauses while the circuit breaker of Ollama or Paperless is open
+- Leases the next entry of the persistent `REQUEST_QUEUE` and renews the lease while processing it
 - Processes each task asynchronously
+- Acknowledges processed entries, failed entries are retried by the queue
+- Entries whose tags are buffered by the `TAG_BATCHER` are acknowledged once the tags are written
+- Entries which failed because a backend went down are postponed without using up an attempt
 - Logs any errors that occur during processing
+
+Several workers run at the same time, each reports its state in `WORKERS`.
+
+Parameters:
+- worker_id (int): Number of the worker.
 """
-async def background_task():
-    logging.info("Starting background queue processor...")
+async def background_task(worker_id: int = 0):
+    logging.info(f"Starting background queue processor {worker_id}...")
+    worker = {"state": "starting", "stage": None, "document": None, "since": time.time(), "processed": 0, "failed": 0}
+    app.config.setdefault("WORKERS", {})[worker_id] = worker
+
+    while not shutdown_event.is_set():
+        worker.update(state="waiting for connections", since=time.time())
+        await app.config["AI_READY"].wait()  # Keep entries queued until the AI is available
+        await app.config["PAPERLESS_READY"].wait()  # Documents can only be fetched once Paperless is connected
+        breakers = [app.config["PAPERLESS_RESILIENCE"].breaker, app.config["OLLAMA_RESILIENCE"].breaker]
+        if any(breaker.retryIn() > 0 for breaker in breakers):
+            worker.update(state="waiting for backends", since=time.time())
+            for breaker in breakers:
+                await breaker.wait()  # Keep the entries queued while a backend is down
 
-    while True:
+        worker.update(state="idle", since=time.time())
+        request_queue = app.config["REQUEST_QUEUE"]
         queue_entry = await request_queue.get()  # Wait until a new request is available
+        queue_entry["last_attempt"] = queue_entry["attempts"] >= request_queue.max_attempts
+        app.config["AI_API"].noteActivity()  # Keep the model warm while the queue is busy
+        worker.update(state="busy", stage=None, document=queue_entry.get("doc_id"), since=time.time())
+        queue_id, lease = queue_entry["queue_id"], queue_entry["lease"]
+        heartbeat = asyncio.create_task(request_queue.heartbeat(queue_id, lease))  # Keeps slow inferences from being handed out twice
         try:
             async with app.app_context():  # Ensure Quart app context is available
-                logging.info(f"Processing queue entry: {queue_entry}")
-                await process_queue(queue_entry)  # Call the processing function
+                logging.info(f"Worker {worker_id} processing {describe_entry(queue_entry)}")
+                if await process_queue(queue_entry, worker):  # Call the processing function
+                    worker["processed"] += 1
+                    DOCUMENTS.inc("processed")
+                else:
+                    worker["failed"] += 1
+                    DOCUMENTS.inc("failed")
+            tagging = queue_entry.pop("tagging", None)
+            if tagging is not None:
+                task = asyncio.create_task(acknowledgeTagged(request_queue, queue_id, lease, tagging))
+                tasks = app.config.setdefault("TAGGING_ENTRIES", set())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                await request_queue.ack(queue_id, lease)  # Done, even if the document got the error tag
+        except asyncio.CancelledError:
+            # Stopped by the shutdown before the entry was finished, it is processed again after the restart
+            logging.warning(f"Worker {worker_id} was stopped while processing {describe_entry(queue_entry)}, returning it to the queue")
+            await request_queue.postpone(queue_id, lease, 0)
+            DOCUMENTS.inc("abandoned")
+            raise
         except Exception as e:
+            delay = max(breaker.retryIn() for breaker in breakers)
+            if isinstance(e, CircuitOpenError) or delay > 0:
+                logging.warning(f"Postponing queue entry {queue_id}: {e}")
+                await request_queue.postpone(queue_id, lease, max(delay, 1))
+                DOCUMENTS.inc("postponed")
+                continue
+            worker["failed"] += 1
             logging.error(f"Error processing queue entry: {e}")  # Log any errors
+            if await request_queue.nack(queue_id, lease, str(e)):
+                logging.info(f"Queue entry {queue_id} will be retried")
+                DOCUMENTS.inc("retried")
+            else:
+                DOCUMENTS.inc("given_up")
         finally:
-            request_queue.task_done()  # Mark task as completed
+            heartbeat.cancel()
+            worker.update(state="idle", stage=None, document=None)
+    worker.update(state="stopped", since=time.time())
+
+"""
+Acknowledges a processed entry once its buffered tags are written. If the tags could
+not be written, the entry is returned to the queue and the document is processed again.
+The lease is renewed meanwhile, the worker already took the next entry.
+
+Parameters:
+- request_queue (PersistentQueue): The queue of the entry.
+- queue_id (int): The id of the entry.
+- lease (str): The lease token of the entry.
+- tagging (asyncio.Future): Resolves once the tags are written.
+"""
+async def acknowledgeTagged(request_queue, queue_id: int, lease: str, tagging: asyncio.Future):
+    heartbeat = asyncio.create_task(request_queue.heartbeat(queue_id, lease))
+    try:
+        await tagging
+        await request_queue.ack(queue_id, lease)
+    except Exception as e:
+        if await request_queue.nack(queue_id, lease, str(e)):
+            DOCUMENTS.inc("retried")
+        else:
+            DOCUMENTS.inc("given_up")
+    finally:
+        heartbeat.cancel()
 
 """ 
 Initializes configurations and services before the server starts.
-- Validates application configuration
-- Initializes the PAPERLESS API connection
-- Sets up the global request queue
-- Starts the background queue processor
+- Starts the background queue workers
+- Starts the PAPERLESS API and AI connections in the background, so the server binds immediately
 """
 @app.before_serving
 async def init_before_serving():
+    if app.config.get("WORKER_TASKS"):
+        return  # Already initialized by main()
     logging.info("Starting pre-server initialization...")
 
-    app.config["REQUEST_QUEUE"] = request_queue  # Store the request queue in app config
-    # Start the background queue processing task
-    app.config["BACKGROUND_TASK"] = asyncio.create_task(background_task())
-    await config.initializeConnections(app)  # Validate configuration
+    # Start the background queue workers
+    app.config["WORKER_TASKS"] = [asyncio.create_task(background_task(worker_id)) for worker_id in range(app.config["WORKER_COUNT"])]
+    await config.initializeConnections(app)  # Connect to Paperless and Ollama in the background
     logging.info("Pre-server initialization complete.")
 
 # Apply configuration settings from the `config` module
 config.setConfig(app)
 
-# Initialize cache with API instance and cache expiration time
-app.config["CACHE"] = Cache(app.config["PAPERLESS_API"], app.config["CACHE_TIME"])
+# Persistent request queue, entries left over from the last run are processed again
+request_queue = PersistentQueue(
+    app.config["QUEUE_PATH"],
+    app.config["QUEUE_LEASE"],
+    app.config["QUEUE_MAX_ATTEMPTS"],
+    app.config["QUEUE_RETRY_DELAY"],
+    lanes=app.config["QUEUE_LANE_DELAYS"]
+)
+app.config["REQUEST_QUEUE"] = request_queue  # Store the request queue in app config
+
+# Backfill of existing documents, an interrupted backfill continues once Paperless is connected
+app.config["BACKFILL"] = Backfill(
+    app.config["PAPERLESS_API"],
+    request_queue,
+    app.config["BACKFILL_STATE_PATH"],
+    merge_entries,
+    app.config["BACKFILL_RATE"],
+    app.config["BACKFILL_MAX_PENDING"],
+    resilience=app.config["PAPERLESS_RESILIENCE"]
+)
+
+# Admission control of the webhook endpoint
+app.config["ADMISSION"] = AdmissionController(
+    app.config["ADMISSION_MAX_QUEUE"],
+    app.config["ADMISSION_RATE"],
+    app.config["ADMISSION_BURST"],
+    app.config["ADMISSION_SHED"],
+    app.config["ADMISSION_RETRY_AFTER"]
+)
+
+# Batch mutations, the tags of processed documents are optionally written in batches
+app.config["BULK_EDITOR"] = BulkEditor(app.config["PAPERLESS_API"], app.config["BULK_CHUNK_SIZE"], app.config["PAPERLESS_RESILIENCE"])
+if app.config["TAG_BATCH_SIZE"] > 0:
+    app.config["TAG_BATCHER"] = TagBatcher(app.config["BULK_EDITOR"], app.config["TAG_BATCH_SIZE"], app.config["TAG_BATCH_INTERVAL"])
+
+# Initialize cache with API instance and cache expiration time, the snapshot of the last run is loaded right away
+app.config["CACHE"] = Cache(
+    app.config["PAPERLESS_API"],
+    app.config["CACHE_TIME"],
+    app.config["PAPERLESS_RESILIENCE"],
+    app.config["CACHE_SNAPSHOT_PATH"] or None,
+    app.config["CACHE_FULL_REFRESH"]
+)
+
+# Initialize the persistent inference cache unless it is disabled
+if app.config["INFERENCE_CACHE_PATH"]:
+    app.config["INFERENCE_CACHE"] = InferenceCache(
+        app.config["INFERENCE_CACHE_PATH"],
+        app.config["INFERENCE_CACHE_MAX_ENTRIES"],
+        app.config["INFERENCE_CACHE_MAX_AGE"]
+    )
 
 """ 
 Main entry point for starting the Quart application.
@@ -120,7 +322,14 @@ async def main():
     conf.accesslog = "-"  # Enable access logging
     conf.errorlog = "-"  # Enable error logging
 
-    await hypercorn.asyncio.serve(app, conf)  # Start Quart application with Hypercorn
+    # SIGTERM and SIGINT drain the workers before the process exits
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, requestShutdown)
+
+    await hypercorn.asyncio.serve(app, conf, shutdown_trigger=shutdown_event.wait)  # Start Quart application with Hypercorn
+    if app.config.get("SHUTDOWN_TASK") is not None:
+        await app.config["SHUTDOWN_TASK"]  # Finish the drain, the server stopped accepting connections
 
 # Ensure the application runs when executed as a script
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+from quart import Blueprint, request, jsonify, current_app  # Import necessary modules
+import logging  # Consolidating imports
+
+# Blueprint for processing existing documents in bulk
+backfill_bp = Blueprint("backfill", __name__)
+
+"""
+Starts a backfill which queues every document matching a Paperless query.
+
+Request body:
+- "query" (str, optional): Paperless full text query.
+- "filters" (dict, optional): Paperless document filters, e.g. {"tags__id__all": 3}.
+- "rate" (float, optional): Maximum number of documents queued per second.
+- "tag" (str, optional): Tag which is removed after processing, like for `/ai/request`.
+- "bypass_cache" (bool, optional): Runs the AI again even if a cached result exists.
+- One entry per field to extract, like for `/ai/request` (e.g. "title": "<prompt>").
+
+Returns:
+- JSON response with the progress of the started backfill.
+"""
+@backfill_bp.route('/backfill', methods=['POST'])
+async def start_backfill():
+    try:
+        data = await request.get_json() or {}
+        if not current_app.config["PAPERLESS_READY"].is_set():
+            return jsonify({"error": "Paperless connection not established"}), 503
+
+        fields = [{field: data[field]} for field in current_app.config['ACCEPTED_DATAFIELDS'] if field in data]
+        if not fields:
+            return jsonify({'error': 'No valid fields provided'}), 400
+        if data.get("filters") is not None and not isinstance(data["filters"], dict):
+            return jsonify({'error': '"filters" has to be an object'}), 400
+
+        template = {
+            "client_ip": request.remote_addr,
+            "fields": fields,
+            "tag": data.get("tag"),
+            "bypass_cache": bool(data.get("bypass_cache", False))
+        }
+        backfill = current_app.config["BACKFILL"]
+        progress = await backfill.start(template, data.get("query"), data.get("filters"), data.get("rate"))
+        logging.info(f"Backfill started for query {data.get('query')!r} and filters {data.get('filters')}")
+        return jsonify(progress), 202
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error starting the backfill: {e}")
+        return jsonify({"error": str(e)}), 500
+
+"""
+Reports the progress of the current or last backfill.
+
+Returns:
+- JSON response with state, position, counters, throughput and estimated remaining seconds.
+"""
+@backfill_bp.route('/backfill', methods=['GET'])
+async def backfill_progress():
+    return jsonify(current_app.config["BACKFILL"].progress()), 200
+
+@backfill_bp.route('/backfill/pause', methods=['POST'])
+async def pause_backfill():
+    backfill = current_app.config["BACKFILL"]
+    await backfill.pause()
+    return jsonify(backfill.progress()), 200
+
+@backfill_bp.route('/backfill/resume', methods=['POST'])
+async def resume_backfill():
+    backfill = current_app.config["BACKFILL"]
+    await backfill.resume()
+    return jsonify(backfill.progress()), 200
+
+@backfill_bp.route('/backfill/cancel', methods=['POST'])
+async def cancel_backfill():
+    backfill = current_app.config["BACKFILL"]
+    await backfill.cancel()
+    return jsonify(backfill.progress()), 200
@@ -1,9 +1,22 @@
 from quart import Blueprint, request, jsonify, current_app  # Import necessary modules
 import logging  # Consolidating imports
+from services.changeset import DocumentChangeSet  # Single-write document updates
+from services.resilience import CircuitOpenError  # Raised while Paperless is down
 
 # Blueprint for document-related API endpoints
 documents_bp = Blueprint("documents", __name__)
 
+"""
+Answers requests which need Paperless or Ollama while its circuit breaker is open.
+
+Returns:
+- 503 Service Unavailable with a Retry-After header.
+"""
+@documents_bp.app_errorhandler(CircuitOpenError)
+async def backend_unavailable(error):
+    retry_after = str(max(int(error.retry_in), 1))
+    return jsonify({"error": str(error), "retry_after": int(retry_after)}), 503, {"Retry-After": retry_after}
+
 """
 Fetches detailed information about a document by its ID.
 
@@ -16,7 +29,7 @@ Returns:
 @documents_bp.route('/doc/get_info/<int:doc_id>', methods=['GET'])
 async def document_info(doc_id):
     api = current_app.config["PAPERLESS_API"]  # Retrieve Paperless API instance
-    doc = await api.documents(doc_id)  # Fetch document details
+    doc = await current_app.config["PAPERLESS_RESILIENCE"].call(lambda: api.documents(doc_id))  # Fetch document details
     cache = current_app.config["CACHE"]  # Retrieve cache instance
 
     # Retrieve related metadata from cache
@@ -69,12 +82,11 @@ Returns:
 @documents_bp.route('/doc/list_inbox', methods=['GET'])
 async def inbox_list():
     if current_app.config["PAPERLESS_API"].is_initialized:
-        inboxlist = []
+        api = current_app.config["PAPERLESS_API"]
         search = f"tag:{current_app.config['INBOX_TAG']}"  # Search for inbox-tagged documents
 
-        # Fetch all matching documents asynchronously
-        async for document in current_app.config["PAPERLESS_API"].documents.search(search):
-            inboxlist.append(document.id)
+        # Fetch the ids of all matching documents, every request has its own deadline and retries
+        inboxlist = await _searchIDs(api, current_app.config["PAPERLESS_RESILIENCE"], search)
         return jsonify(inboxlist), 200
     else:
         return jsonify({"Error: Connection to Paperless-NGX not established "}), 404
@@ -86,12 +98,13 @@ Assigns or removes tags from a document.
 Parameters:
 - doc_id (int): The ID of the document to modify.
 - tag_names (list of str): List of tag names to add or remove.
+- document (optional): The already fetched document, saves one request.
 
 Returns:
 - JSON success message if successful.
 - JSON error message if tag not found or an error occurs.
 """
-async def set_tag(doc_id, tag_names):
+async def set_tag(doc_id, tag_names, document=None):
     api = current_app.config["PAPERLESS_API"]  # Retrieve API instance
     cache = current_app.config["CACHE"]  # Retrieve cache instance
 
@@ -102,10 +115,10 @@ async def set_tag(doc_id, tag_names):
     tag_ids_to_add = []
     tag_ids_to_remove = []
 
-    for tag_name in tag_names:
+    clean_tag_names = [tag_name.strip().lstrip('-') for tag_name in tag_names]  # Clean tag names for lookup
+    tag_ids = await cache.getTagIDsByName(clean_tag_names)  # Retrieve all tag IDs at once
+    for tag_name, clean_tag_name, tag_id in zip(tag_names, clean_tag_names, tag_ids):
         remove_tag = tag_name.strip().startswith('-')  # Determine if it's a removal operation
-        clean_tag_name = tag_name.strip().lstrip('-')  # Clean tag name for lookup
-        tag_id = await cache.getTagIDByName(clean_tag_name)  # Retrieve tag ID
 
         if not tag_id:
             return jsonify({"error": f"Tag '{clean_tag_name}' not found"}), 404  # Return error if tag does not exist
@@ -115,25 +128,14 @@ async def set_tag(doc_id, tag_names):
         else:
             tag_ids_to_add.append(tag_id)
 
-    # Fetch the document from Paperless
-    document = await api.documents(doc_id)
-
-    # Get the current tags assigned to the document
-    current_tags = document.tags
+    # Fetch the document from Paperless unless it is given
+    paperless = current_app.config["PAPERLESS_RESILIENCE"]
+    if document is None:
+        document = await paperless.call(lambda: api.documents(doc_id))
 
-    # Remove specified tags
-    for tag_id in tag_ids_to_remove:
-        if tag_id in current_tags:
-            current_tags.remove(tag_id)
-
-    # Add new tags if they are not already assigned
-    for tag_id in tag_ids_to_add:
-        if tag_id not in current_tags:
-            current_tags.append(tag_id)
-
-    # Update document tags
-    document.tags = current_tags
-    success = await document.update()  # Commit changes asynchronously
+    # Update document tags with a single request
+    changes = DocumentChangeSet(document).removeTags(tag_ids_to_remove).addTags(tag_ids_to_add)
+    success = await paperless.call(lambda: changes.commit(api, check_conflicts=False))  # Commit changes asynchronously
 
     return success  # Return success status
 
@@ -171,10 +173,10 @@ async def cor_document(doc_id):
     #doc_id = data.get("doc_id")  # Extract document ID
     correspondent = data.get("correspondent", "")  # Extract tag names, default to empty list
     # Fetch the document from Paperless
-    document = await api.documents(doc_id)
+    document = await current_app.config["PAPERLESS_RESILIENCE"].call(lambda: api.documents(doc_id))
     document.correspondent = await cache.getCorrespondantIDByName(correspondent)
 
-    success = await document.update()  # Commit changes asynchronously
+    success = await current_app.config["PAPERLESS_RESILIENCE"].call(document.update)  # Commit changes asynchronously
 
     if success:
         return jsonify({"message": f"Correspondant {correspondent} successfully updated for document {doc_id}"}), 200
@@ -189,7 +191,7 @@ async def type_document(doc_id):
     #doc_id = data.get("doc_id")  # Extract document ID
     type = data.get("type", "")  # Extract tag names, default to empty list
     # Fetch the document from Paperless
-    document = await api.documents(doc_id)
+    document = await current_app.config["PAPERLESS_RESILIENCE"].call(lambda: api.documents(doc_id))
     document.type = await cache.getTypeIDByName(type)
 
 
@@ -201,7 +203,7 @@ async def type_document(doc_id):
     document.tags = current_tags
 
 
-    success = await document.update()  # Commit changes asynchronously
+    success = await current_app.config["PAPERLESS_RESILIENCE"].call(document.update)  # Commit changes asynchronously
 
     if success:
         return jsonify({"message": f"Type {type} successfully updated for document {doc_id}"}), 200
@@ -216,7 +218,7 @@ async def path_document(doc_id):
     #doc_id = data.get("doc_id")  # Extract document ID
     path = data.get("path", "")  # Extract tag names, default to empty list
     # Fetch the document from Paperless
-    document = await api.documents(doc_id)
+    document = await current_app.config["PAPERLESS_RESILIENCE"].call(lambda: api.documents(doc_id))
     document.path = await cache.getPathIDByName(path)
 
 
@@ -228,9 +230,204 @@ async def path_document(doc_id):
     document.tags = current_tags
 
 
-    success = await document.update()  # Commit changes asynchronously
+    success = await current_app.config["PAPERLESS_RESILIENCE"].call(document.update)  # Commit changes asynchronously
 
     if success:
         return jsonify({"message": f"Correspondant {correspondant} successfully updated for document {doc_id}"}), 200
     else:
-        return jsonify({"error": "Error updating document tags"}), 500  # Return error if operation failed
\ No newline at end of file
+        return jsonify({"error": "Error updating document tags"}), 500  # Return error if operation failed
+
+"""
+Changes tags and metadata of many documents with the Paperless bulk edit endpoint.
+
+Expected JSON payload:
+- "operations" (list): Each operation has "documents" (list of ids) and any of
+  "add_tags", "remove_tags" (lists of tag names), "correspondent", "document_type"
+  and "storage_path" (names, null removes the value).
+
+Returns:
+- JSON response with the result per document.
+- 400 with the invalid entry if the payload is invalid, 404 if a name is unknown.
+"""
+@documents_bp.route('/doc/bulk', methods=['POST'])
+async def bulk_documents():
+    cache = current_app.config["CACHE"]  # Retrieve cache instance
+    data = await request.get_json() or {}
+    operations = data.get("operations")
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations (list) is required"}), 400
+
+    lookups = {
+        "correspondent": cache.getCorrespondantIDByName,
+        "document_type": cache.getTypeIDByName,
+        "storage_path": cache.getPathIDByName
+    }
+    resolved = []
+    for operation in operations:
+        if not isinstance(operation, dict) or not operation.get("documents"):
+            return jsonify({"error": "Every operation needs a list of documents"}), 400
+        if not isinstance(operation["documents"], list):
+            return jsonify({"error": "documents has to be a list of document ids", "entry": operation["documents"]}), 400
+        entry = {"documents": []}
+        for doc_id in operation["documents"]:
+            if isinstance(doc_id, bool) or not (isinstance(doc_id, int) or (isinstance(doc_id, str) and doc_id.strip().isdigit())):
+                return jsonify({"error": "Invalid document id", "entry": doc_id}), 400
+            entry["documents"].append(int(doc_id))
+        for key in ("add_tags", "remove_tags"):
+            names = operation.get(key) or []
+            if not isinstance(names, list):
+                return jsonify({"error": f"{key} has to be a list of tag names", "entry": names}), 400
+            for name in names:
+                if not isinstance(name, str) or not name.strip():
+                    return jsonify({"error": f"Invalid tag name in {key}", "entry": name}), 400
+            entry[key] = await cache.getTagIDsByName(names)
+            for name, tag_id in zip(names, entry[key]):
+                if not tag_id:
+                    return jsonify({"error": f"Tag '{name}' not found"}), 404
+        for field, lookup in lookups.items():
+            if field not in operation:
+                continue
+            entry[field] = None
+            if operation[field] is not None and (not isinstance(operation[field], str) or not operation[field].strip()):
+                return jsonify({"error": f"{field} has to be a name or null", "entry": operation[field]}), 400
+            if operation[field] is not None:
+                entry[field] = await lookup(operation[field])
+                if entry[field] is None:
+                    return jsonify({"error": f"{field} '{operation[field]}' not found"}), 404
+        resolved.append(entry)
+
+    results = await current_app.config["BULK_EDITOR"].run(resolved)
+    failed = sum(1 for result in results.values() if not result["ok"])
+    logging.info(f"Bulk edit of {len(results)} documents, {failed} failed")
+    return jsonify({"results": results, "failed": failed}), 200 if not failed else 207
+
+"""
+Suggests correspondent, document type and storage path for a document.
+
+Parameters:
+- doc_id (int): The unique identifier of the document.
+
+Query parameters:
+- "fallback" (bool, optional): Asks the AI if no similar document is known. Defaults to true.
+
+Returns:
+- JSON response with the suggestion, score and source per field.
+- 503 if the classifier is not available.
+"""
+@documents_bp.route('/doc/suggest/<int:doc_id>', methods=['GET'])
+async def suggest_document(doc_id):
+    classifier = current_app.config.get("CLASSIFIER")
+    if classifier is None:
+        return jsonify({"error": "Classifier is not available"}), 503
+
+    api = current_app.config["PAPERLESS_API"]
+    document = await current_app.config["PAPERLESS_RESILIENCE"].call(lambda: api.documents(doc_id))
+    fallback = request.args.get("fallback", "true").lower() != "false"
+    suggestions = await classifier.suggest([document], fallback=fallback)
+    return jsonify(suggestions[document.id]), 200
+
+"""
+Suggests correspondent, document type and storage path for many documents at once.
+
+Expected JSON payload:
+- "ids" (list of int, optional): The documents to classify.
+- "inbox" (bool, optional): Classifies all documents in the inbox instead.
+- "fallback" (bool, optional): Asks the AI if no similar document is known. Defaults to false.
+
+Returns:
+- JSON response with the suggestions per document id.
+"""
+@documents_bp.route('/doc/suggest', methods=['POST'])
+async def suggest_documents():
+    classifier = current_app.config.get("CLASSIFIER")
+    if classifier is None:
+        return jsonify({"error": "Classifier is not available"}), 503
+
+    api = current_app.config["PAPERLESS_API"]
+    data = await request.get_json() or {}
+    fallback = bool(data.get("fallback", False))
+
+    if data.get("inbox"):
+        search = f"tag:{current_app.config['INBOX_TAG']}"
+        ids = await _searchIDs(api, current_app.config["PAPERLESS_RESILIENCE"], search)
+        if not ids:
+            return jsonify({}), 200
+        documents = _documentsByID(api, ids)
+    elif data.get("ids"):
+        documents = _documentsByID(api, [int(doc_id) for doc_id in data["ids"]])
+    else:
+        return jsonify({"error": "ids (list) or inbox (bool) is required"}), 400
+
+    # Classify in batches, so only one batch of document contents is held in memory
+    suggestions = {}
+    batch = []
+    async for document in documents:
+        batch.append(document)
+        if len(batch) >= classifier.BATCH_SIZE:
+            suggestions.update(await classifier.suggest(batch, fallback=fallback))
+            batch = []
+    if batch:
+        suggestions.update(await classifier.suggest(batch, fallback=fallback))
+
+    return jsonify(suggestions), 200
+
+"""
+Returns the ids of the documents matching a full text query.
+
+Only the ids are requested. Paperless lists all of them in the "all" attribute of the
+first page, otherwise the pages are fetched one by one. Every request runs through the
+resilience layer on its own, so a large result does not share one deadline.
+
+Parameters:
+- api: The Paperless API instance.
+- paperless (Resilience): Deadline, retries and circuit breaker of the requests.
+- query (str): The full text query, e.g. "tag:Inbox".
+
+Returns:
+- list[int]: The ids of the matching documents.
+"""
+async def _searchIDs(api, paperless, query: str) -> list:
+    params = {"query": query, "fields": "id"}
+    request = lambda params: paperless.call(lambda: api.request_json("get", "/api/documents/", params=params))
+    page = await request(dict(params, page_size=1))
+    if page.get("all") is not None:
+        return list(page["all"])
+    ids = []
+    number = 1
+    while True:
+        page = await request(dict(params, page_size=100, page=number))
+        ids.extend(result["id"] for result in page.get("results", []))
+        if not page.get("next") or not page.get("results"):
+            return list(dict.fromkeys(ids))
+        number += 1
+
+async def _documentsByID(api, ids):
+    async with api.documents.reduce(id__in=ids, page_size=100):
+        async for document in api.documents:
+            yield document
+
+"""
+Updates the classifier index with the documents changed since the last synchronisation.
+
+Expected JSON payload:
+- "full" (bool, optional): Rebuilds the index from scratch.
+
+Returns:
+- JSON response with the number of updated documents.
+"""
+@documents_bp.route('/doc/classifier/sync', methods=['POST'])
+async def sync_classifier():
+    classifier = current_app.config.get("CLASSIFIER")
+    if classifier is None:
+        return jsonify({"error": "Classifier is not available"}), 503
+
+    data = await request.get_json(silent=True) or {}
+    updated = await classifier.sync(full=bool(data.get("full", False)))
+    return jsonify({"updated": updated, **classifier.status()}), 200
+
+@documents_bp.route('/doc/classifier/status', methods=['GET'])
+async def classifier_status():
+    classifier = current_app.config.get("CLASSIFIER")
+    if classifier is None:
+        return jsonify({"error": "Classifier is not available"}), 503
+    return jsonify(classifier.status()), 200
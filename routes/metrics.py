@@ -0,0 +1,41 @@
+import asyncio
+from quart import Blueprint, Response, current_app
+from services import metrics
+
+# Blueprint for the Prometheus metrics endpoint
+metrics_bp = Blueprint("metrics", __name__)
+
+"""
+Exposes the metrics of the pipeline in the Prometheus text format.
+
+The counters and histograms are recorded while processing, the gauges (queue, inference
+cache, circuit breakers, workers) are read right before rendering.
+
+Returns:
+- The metrics as text/plain in the Prometheus exposition format 0.0.4.
+"""
+@metrics_bp.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    queue = current_app.config.get("REQUEST_QUEUE")
+    if queue is not None:
+        states, lanes = await asyncio.to_thread(lambda: (queue.stats(), queue.laneStats()))
+        for state, count in states.items():
+            metrics.QUEUE_ENTRIES.set(state, value=count)
+        for lane, stats in lanes.items():
+            metrics.QUEUE_PENDING.set(lane, value=stats["pending"])
+
+    inference_cache = current_app.config.get("INFERENCE_CACHE")
+    if inference_cache is not None:
+        stats = await asyncio.to_thread(inference_cache.stats)
+        for key in ("hits", "misses", "hit_ratio", "entries"):
+            metrics.INFERENCE_CACHE.set(key, value=stats[key])
+
+    for name in ("paperless", "ollama"):
+        resilience = current_app.config.get(f"{name.upper()}_RESILIENCE")
+        if resilience is not None:
+            metrics.BREAKER_OPEN.set(name, value=int(resilience.breaker.state != resilience.breaker.CLOSED))
+
+    workers = current_app.config.get("WORKERS", {})
+    metrics.WORKERS_BUSY.set(value=sum(1 for worker in workers.values() if worker["state"] == "busy"))
+
+    return Response(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,6 +1,9 @@
-import logging, asyncio  # Consolidating imports
+import time, logging  # Consolidating imports
 from quart import Blueprint, request, jsonify, current_app
 from routes.documents import set_tag  # Importing required function
+from services.changeset import DocumentChangeSet  # Single-write document updates
+from services.resilience import isTransient  # Errors which are worth a retry
+from services.metrics import STAGE_SECONDS  # Latency per processing stage
 
 # Blueprint for processing AI-based document requests
 processing_bp = Blueprint("processing", __name__)
@@ -8,59 +11,116 @@ processing_bp = Blueprint("processing", __name__)
 """
 Processes a queued document request using AI and updates the document accordingly.
 
+Several workers run this concurrently. The Paperless requests and the inference are
+limited separately by the PAPERLESS_SLOTS and INFERENCE_SLOTS semaphores, so a worker
+waiting for the AI does not block the Paperless I/O of the others. All Paperless requests
+run through PAPERLESS_RESILIENCE with a deadline and retries. Transient failures are
+always raised, the queue retries the entry instead of giving the document the error tag.
+
 Parameters:
-- data (dict): A dictionary containing:
-    - "document" (object): The document to be processed.
+- data (dict): A compact queue entry containing:
+    - "doc_id" (int): Id of the document, the document itself is fetched just in time.
     - "fields" (list): A list of fields to extract information from using AI.
     - "tag" (str, optional): A tag associated with the document.
+    - "bypass_cache" (bool, optional): Runs the AI again even if a cached result exists.
+    - "last_attempt" (bool, optional): If False, errors are raised so the queue retries the entry,
+      otherwise the document gets the error tag unless the error is transient.
+  With a TAG_BATCHER, "tagging" is set to a future which resolves once the buffered tags
+  are written, the entry may only be acknowledged afterwards.
+- worker (dict, optional): Status of the calling worker, its "stage" is updated while processing.
+
+Returns:
+- bool: True if the document was updated successfully.
 """
-async def process_queue(data: dict) -> None:
+async def process_queue(data: dict, worker: dict = None) -> bool:
+    worker = worker if worker is not None else {}
+    paperless_slots = current_app.config["PAPERLESS_SLOTS"]
+    inference_slots = current_app.config["INFERENCE_SLOTS"]
+    paperless = current_app.config["PAPERLESS_RESILIENCE"]
+    api = current_app.config["PAPERLESS_API"]
+    doc = None
+    success = False
     try:
         if not data:
-            return  # Skip processing if data is empty
+            return False  # Skip processing if data is empty
 
-        logging.info(f"Processing request: {data}")
+        logging.info(f"Processing request: {describe_entry(data)}")
 
-        doc = data.get("document")  # Extract the document object
-        if not doc:
-            logging.error("Document object is missing in the data.")
-            return
+        if not data.get("doc_id"):
+            logging.error("Document id is missing in the data.")
+            return False
+        worker["stage"] = "fetching"
+        async with paperless_slots:
+            with STAGE_SECONDS.time("fetch"):
+                doc = await paperless.call(lambda: api.documents(int(data["doc_id"])))
         
         results = []
         ai = current_app.config["AI_API"]  # Get AI API configuration
 
-        # Iterate through fields and process AI responses
+        # Collect the prompt of every requested field
+        prompts = {}
         for field in data["fields"]:
             for key in current_app.config['ACCEPTED_DATAFIELDS']:
                 if key in field:
-                    response = ai.getResponse(doc.content, field[key])  # AI processing
-                    results.append({"key": key, "value": response})
-
-        # If AI processing generated results, update the document
-        if results:
-            for result in results:
-                setattr(doc, result["key"], result["value"])  # Dynamically set attributes
-            
-            success = await doc.update()  # Save document changes
-            logging.info(f"Document {doc.id} updated: {success}")
+                    prompts[key] = field[key]
+
+        bypass_cache = data.get("bypass_cache", False)
+        worker["stage"] = "waiting for inference"
+        async with inference_slots:
+            worker["stage"] = "inference"
+            start = time.monotonic()
+            if current_app.config['EXTRACTION_MODE'] == 'single':
+                # One inference per field
+                for key, prompt in prompts.items():
+                    response = await ai.getResponses(doc.content, {key: prompt}, bypass_cache=bypass_cache)  # AI processing
+                    results.append({"key": key, "value": response[key]})
+            else:
+                # All fields in a single inference
+                responses = await ai.getResponses(doc.content, prompts, bypass_cache=bypass_cache)  # AI processing
+                results = [{"key": key, "value": value} for key, value in responses.items()]
+            STAGE_SECONDS.observe("inference", value=time.monotonic() - start)
+
+        # Collect the AI results and the tag changes, they are written with a single request
+        cache = current_app.config['CACHE']
+        changes = DocumentChangeSet(doc)
+        for result in results:
+            changes.set(result["key"], result["value"])
 
         # Handle tagging if a tag is provided
+        removeTags = []
         tagname = data.get("tag")
         if tagname:
-            callTag = await current_app.config['CACHE'].getTagIDByName(tagname)
-            if callTag in doc.tags:
-                await set_tag(doc.id, [f"-{tagname}"])  # Remove existing tag
-                logging.debug(f"Removed Call Tag {tagname}")
+            callTag = await cache.getTagIDByName(tagname)
+            if callTag:
+                removeTags.append(callTag)  # Remove existing tag
 
         # Assign success or error tag based on processing outcome
-        if success:
-            await set_tag(doc.id, [current_app.config['PROCESSING_TAG']])
-        else:
-            await set_tag(doc.id, [current_app.config['ERROR_TAG']])
+        success = bool(results)
+        resultTag = await cache.getTagIDByName(current_app.config['PROCESSING_TAG' if success else 'ERROR_TAG'])
+        addTags = [resultTag] if resultTag else []
+
+        batcher = current_app.config.get("TAG_BATCHER")
+        if batcher is None:
+            changes.removeTags(removeTags).addTags(addTags)
+
+        worker["stage"] = "waiting for paperless"
+        async with paperless_slots:
+            worker["stage"] = "updating"
+            with STAGE_SECONDS.time("update"):
+                updated = await paperless.call(lambda: changes.commit(api, current_app.config["CONFLICT_CHECK"]))
+            logging.info(f"Document {doc.id} updated: {updated}")
+            if batcher is not None:
+                data["tagging"] = await batcher.add(doc.id, add=addTags, remove=removeTags)  # Tagged together with other documents
+        return success
 
     except Exception as e:
+        if not data.get("last_attempt", True) or isTransient(e):
+            raise  # The queue retries the entry later, a backend which is down is no reason for the error tag
         logging.error(f"Error in queue processing: {e}")
-        await set_tag(doc.id, [current_app.config['ERROR_TAG']])  # Assign error tag in case of failure
+        if doc is not None:
+            async with paperless_slots:
+                await set_tag(doc.id, [current_app.config['ERROR_TAG']], document=doc)  # Assign error tag, the document is already fetched
+        return False
 
 """
 Handles incoming AI processing requests via HTTP POST.
@@ -84,30 +144,101 @@ async def receive_data():
 
         # Extract document ID from the provided URL
         doc_id = data["url"].rstrip('/').split('/')[-1]
-        document = await api.documents(doc_id)  # Fetch document details
-
-        if not document:
-            return jsonify({"error": f"Document {doc_id} not found"}), 404
+        if not doc_id.isdigit():
+            return jsonify({'error': f'No document id in "url" {data["url"]}'}), 400
+        doc_id = int(doc_id)
 
         # Extract fields for processing based on the accepted data fields
         fields = [{field: data[field]} for field in current_app.config['ACCEPTED_DATAFIELDS'] if field in data]
-
-        if fields:
-            # Create a queue entry for asynchronous processing
-            queue_entry = {
-                "document": document,
-                "client_ip": client_ip,
-                "fields": fields,
-                "tag": data.get("tag")
-            }
-            logging.info(f"Adding request for Document {doc_id} to queue...")
-
-            asyncio.create_task(current_app.config["REQUEST_QUEUE"].put(queue_entry))  # Add task to queue
-
-            return jsonify({"message": "Request added to processing queue"}), 200
-        else:
+        if not fields:
             return jsonify({'error': 'No valid fields provided'}), 400
 
+        if current_app.config["SHUTDOWN"].is_set():
+            retry_after = str(int(current_app.config["SHUTDOWN_TIMEOUT"]))
+            return jsonify({"error": "Server is shutting down"}), 503, {"Retry-After": retry_after}
+
+        queue = current_app.config["REQUEST_QUEUE"]
+        priority = data.get("priority") or queue.DEFAULT_LANE
+        if priority not in queue.lanes:
+            return jsonify({'error': f'Unknown priority "{priority}", expected one of {list(queue.lanes)}'}), 400
+
+        # Reject the request if the client sends too many or the queue is too full for its priority
+        admitted, retry_after, reason = current_app.config["ADMISSION"].admit(client_ip, priority, queue.depth)
+        if not admitted:
+            logging.warning(f"Rejected request for Document {doc_id} from {client_ip}: {reason}")
+            return jsonify({"error": f"Request rejected ({reason})", "retry_after": retry_after}), 429, {"Retry-After": str(retry_after)}
+
+        paperless = current_app.config["PAPERLESS_RESILIENCE"]
+        starting = not current_app.config["PAPERLESS_READY"].is_set() or paperless.breaker.retryIn() > 0
+        if not starting:
+            # Only check that the document exists, its content is fetched by the worker
+            found = await paperless.call(
+                lambda: api.request_json("get", "/api/documents/", params={"id": doc_id, "fields": "id"})
+            )
+            if not found.get("count"):
+                return jsonify({"error": f"Document {doc_id} not found"}), 404
+
+        # Create a compact queue entry for asynchronous processing, the worker fetches the document just in time
+        queue_entry = {
+            "doc_id": doc_id,
+            "client_ip": client_ip,
+            "fields": fields,
+            "tag": data.get("tag"),
+            "bypass_cache": bool(data.get("bypass_cache", False)),
+            "received": time.time()
+        }
+        logging.info(f"Adding request for Document {doc_id} to queue...")
+
+        # Stored on disk before the webhook is answered, repeated webhooks for the same document are coalesced
+        _, status = await queue.put(queue_entry, key=doc_id, merge=merge_entries, lane=priority)
+        if status != "queued":
+            logging.info(f"Request for Document {doc_id} was {status}")
+        if current_app.config.get("AI_API"):
+            current_app.config["AI_API"].noteActivity()  # Start loading the model while the entry waits
+
+        if starting:
+            return jsonify({"message": "Request queued, waiting for the Paperless connection", "status": status, "merged": status == "merged"}), 202
+        return jsonify({"message": "Request added to processing queue", "status": status, "merged": status == "merged"}), 200
+
     except Exception as e:
         logging.error(f"Error in receive_data: {e}")
-        return jsonify({"error": str(e)}), 500  # Return error response in case of failure
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500  # Return error response in case of failure
+
+"""
+Merges a new request for a document into its pending queue entry.
+
+Parameters:
+- pending (dict): The queue entry which is waiting to be processed.
+- new (dict): The new queue entry for the same document.
+
+Returns:
+- dict: The pending entry with the union of the fields (the newer prompt wins) and the latest tag.
+"""
+def merge_entries(pending: dict, new: dict) -> dict:
+    prompts = {}
+    for field in pending.get("fields", []) + new.get("fields", []):
+        prompts.update(field)
+    merged = dict(pending)
+    merged.update({
+        "fields": [{key: prompt} for key, prompt in prompts.items()],
+        "tag": new.get("tag") or pending.get("tag"),
+        "client_ip": new.get("client_ip"),
+        "bypass_cache": bool(pending.get("bypass_cache")) or bool(new.get("bypass_cache"))
+    })
+    return merged
+
+"""
+Summarizes a queue entry for the log without the prompts.
+
+Parameters:
+- entry (dict): The queue entry.
+
+Returns:
+- str: Document id, requested fields, tag, lane and attempt of the entry.
+"""
+def describe_entry(entry: dict) -> str:
+    fields = [key for field in entry.get("fields", []) for key in field]
+    summary = f"document {entry.get('doc_id')} fields {fields} tag {entry.get('tag')!r}"
+    if "queue_id" in entry:
+        summary += f" (queue entry {entry['queue_id']}, {entry.get('lane')} lane, attempt {entry.get('attempts')})"
+    return summary
@@ -1,5 +1,5 @@
 from quart import Blueprint, request, jsonify, current_app, Response, stream_with_context  # Import necessary modules
-import logging, subprocess  # Consolidating imports
+import time, asyncio, logging, subprocess  # Consolidating imports
 from services.config import initializeAIConnection, initializePaperlessConnection
 
 # Blueprint for status-related API endpoints
@@ -10,11 +10,105 @@ async def check_status():
     """
     API-Route zur Überprüfung der aktuellen Verbindungszustände.
     """
+    inference_cache = current_app.config.get("INFERENCE_CACHE")
+    ai = current_app.config.get("AI_API")
     return jsonify({
         "aiconnection": current_app.config.get("AICONNECTION", False),
-        "paperlessconnection": current_app.config.get("PAPERLESSCONNECTION", False)
+        "paperlessconnection": current_app.config.get("PAPERLESSCONNECTION", False),
+        "inference_cache": await asyncio.to_thread(inference_cache.stats) if inference_cache else None,
+        "ollama_hosts": ai.hostStatus() if ai else [],
+        "admission": current_app.config["ADMISSION"].status(),
+        "breakers": {
+            "paperless": current_app.config["PAPERLESS_RESILIENCE"].status(),
+            "ollama": current_app.config["OLLAMA_RESILIENCE"].status()
+        }
     })
 
+"""
+Liveness probe, answers as soon as the server is running.
+
+Returns:
+- JSON response with the uptime in seconds.
+"""
+@status_bp.route('/status/live', methods=['GET'])
+async def liveness():
+    started = current_app.config["STARTUP"]["started"]
+    return jsonify({"status": "alive", "uptime": round(time.time() - started, 1) if started else 0}), 200
+
+"""
+Readiness probe, succeeds once Paperless and the AI are connected.
+
+Webhooks are accepted and queued before, so this only tells whether queued documents are processed.
+
+Returns:
+- JSON response with the connection states, the number of queued requests and the startup phase timings.
+  Status 200 if ready, otherwise 503.
+"""
+@status_bp.route('/status/ready', methods=['GET'])
+async def readiness():
+    ready = current_app.config["AI_READY"].is_set() and current_app.config["PAPERLESS_READY"].is_set()
+    queue = current_app.config.get("REQUEST_QUEUE")
+    return jsonify({
+        "ready": ready,
+        "aiconnection": current_app.config.get("AICONNECTION", False),
+        "paperlessconnection": current_app.config.get("PAPERLESSCONNECTION", False),
+        "queued": await asyncio.to_thread(queue.qsize) if queue else 0,
+        "startup": current_app.config["STARTUP"]["phases"]
+    }), 200 if ready else 503
+
+"""
+Reports the state of the queue workers and the free slots of the processing stages.
+
+Returns:
+- JSON response with the queue length, states and wait times per priority lane, the worker states and the available inference and Paperless slots.
+"""
+@status_bp.route('/status/workers', methods=['GET'])
+async def worker_status():
+    queue = current_app.config.get("REQUEST_QUEUE")
+    # The SQLite queries wait for the queue lock and the WAL, so they must not block the event loop
+    queued, states, lanes = await asyncio.to_thread(lambda: (queue.qsize(), queue.stats(), queue.laneStats())) if queue else (0, None, None)
+    return jsonify({
+        "queued": queued,
+        "queue": states,
+        "lanes": lanes,
+        "tag_batcher": current_app.config["TAG_BATCHER"].status() if current_app.config.get("TAG_BATCHER") else None,
+        "workers": current_app.config.get("WORKERS", {}),
+        "inference_slots": {
+            "limit": current_app.config["INFERENCE_CONCURRENCY"],
+            "free": current_app.config["INFERENCE_SLOTS"]._value
+        },
+        "paperless_slots": {
+            "limit": current_app.config["PAPERLESS_CONCURRENCY"],
+            "free": current_app.config["PAPERLESS_SLOTS"]._value
+        }
+    }), 200
+
+"""
+Reports the residency of the AI models.
+
+Returns:
+- JSON response with the load/unload timings per model and the models Ollama currently holds in memory.
+"""
+@status_bp.route('/status/models', methods=['GET'])
+async def model_status():
+    ai = current_app.config.get("AI_API")
+    if ai is None:
+        return jsonify({"error": "AI connection not established"}), 503
+    return jsonify(await ai.residency()), 200
+
+"""
+Reports the timings of the most recent inferences.
+
+Returns:
+- JSON response with time to first token, tokens per second and duration of the recent inferences.
+"""
+@status_bp.route('/status/inference', methods=['GET'])
+async def inference_status():
+    ai = current_app.config.get("AI_API")
+    if ai is None:
+        return jsonify({"error": "AI connection not established"}), 503
+    return jsonify(ai.inferenceStats()), 200
+
 """
 Streams the application log in real-time by reading from stdout.
 
@@ -79,7 +173,7 @@ async def connect_to_ai():
     - JSON-Response mit Status der Verbindung.
     """
     try:
-        success = initializeAIConnection(current_app)
+        success = await initializeAIConnection(current_app)
         if success:
             return jsonify({"status": "success", "message": "AI connection established"}), 200
         else:
@@ -0,0 +1,111 @@
+import math, time
+from collections import OrderedDict
+
+"""
+Token bucket rate limiter.
+
+Parameters:
+- rate (float): Tokens added per second.
+- burst (float): Maximum number of tokens.
+"""
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    """
+    Takes one token.
+
+    Returns:
+    - float: 0 if a token was available, otherwise the seconds until the next token.
+    """
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+"""
+Decides whether a request is accepted into the processing queue.
+
+A request is rejected if its client exceeds its rate limit, if the queue is full or if
+the queue is filled beyond the shedding level of the request's priority lane. Lower
+priorities are shed first, so interactive requests still get in while bulk work is
+refused. The queue is checked before the rate limit, a request which is refused
+because of the queue does not use up the rate of its client. The buckets of the
+`MAX_CLIENTS` most recently seen clients are kept, the least recently seen client is
+forgotten first.
+
+Parameters:
+- max_depth (int): Maximum number of unfinished queue entries.
+- rate (float): Requests per second and client, 0 disables the rate limit.
+- burst (int): Requests a client may send at once.
+- shed (dict): Per lane the fraction of `max_depth` above which requests of the lane are rejected.
+- retry_after (int): Seconds a client is asked to wait if the queue is full.
+"""
+class AdmissionController:
+    MAX_CLIENTS = 1000  # Least recently seen clients are forgotten above this number
+
+    def __init__(self, max_depth: int = 10000, rate: float = 10, burst: int = 50, shed: dict = None, retry_after: int = 30):
+        self.max_depth = max_depth
+        self.rate = rate
+        self.burst = burst
+        self.shed = shed or {}
+        self.retry_after = retry_after
+        self._buckets = OrderedDict()
+        self.admitted = 0
+        self.rejected = {}
+
+    """
+    Checks a request.
+
+    Parameters:
+    - client (str): The client address.
+    - lane (str): The priority lane of the request.
+    - depth (int): The current number of unfinished queue entries.
+
+    Returns:
+    - tuple: (accepted, seconds the client should wait, reason of the rejection)
+    """
+    def admit(self, client: str, lane: str, depth: int) -> tuple:
+        if depth >= self.max_depth:
+            return self._reject("queue_full", lane, self.retry_after)
+        if depth >= self.max_depth * self.shed.get(lane, 1.0):
+            return self._reject("shed", lane, self.retry_after)
+        if self.rate > 0:
+            wait = self._bucket(client).take()
+            if wait > 0:
+                return self._reject("rate_limit", lane, wait)
+        self.admitted += 1
+        return True, 0, None
+
+    def status(self) -> dict:
+        return {
+            "max_depth": self.max_depth,
+            "rate": self.rate,
+            "burst": self.burst,
+            "shed": {lane: int(self.max_depth * level) for lane, level in self.shed.items()},
+            "clients": len(self._buckets),
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
+
+    def _bucket(self, client: str) -> TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.MAX_CLIENTS:
+                self._buckets.popitem(last=False)  # The least recently seen client
+        else:
+            self._buckets.move_to_end(client)
+        return bucket
+
+    def _reject(self, reason: str, lane: str, wait: float) -> tuple:
+        counts = self.rejected.setdefault(reason, {})
+        counts[lane] = counts.get(lane, 0) + 1
+        return False, max(1, math.ceil(wait)), reason
@@ -1,18 +1,53 @@
 import json
+import time
+import asyncio
+from collections import deque
 import logging
-from ollama import ps, pull, chat, ProcessResponse, ChatResponse  # Consolidating imports
+import httpx
+from ollama import AsyncClient, ProcessResponse, ResponseError  # Consolidating imports
 from datetime import datetime
-from pydantic import BaseModel
+from functools import lru_cache
+from pydantic import BaseModel, create_model
+from services.content import prepareContent
+from services.resilience import Resilience
+from services.metrics import INFERENCE_SECONDS
 
 """
 AI class for handling document analysis and extracting relevant information using the Ollama model.
 
+All calls go through an `OllamaPool` of async clients, so inference never blocks the event
+loop, the HTTP connections are reused and every request is routed to the least loaded
+healthy Ollama host.
+
 Parameters:
 - model (str): The name of the Ollama model to use.
 - logger (logging.Logger): Logger instance for logging.
+- host (str|list, optional): The Ollama host(s), as list or comma separated. Falls back to the OLLAMA_HOST environment variable.
+- timeout (float): Default timeout in seconds for a single inference call.
+- max_connections (int): Size of the HTTP connection pool towards each Ollama host.
+- datafields (iterable, optional): Names of the fields which can be extracted in a single pass.
+- cache (InferenceCache, optional): Persistent cache for inference results.
+- strategies (dict, optional): Content strategy per field, see `services.content`.
+- default_strategy (str): Content strategy for fields without an own strategy.
+- parallelism (int): Maximum number of chunks of one document analyzed at the same time.
+- max_chunks (int): Maximum number of chunks analyzed per document.
+- keep_alive (str|float, optional): How long Ollama keeps the model loaded after a request (e.g. "30m", -1 = forever).
+- stream (bool): Streams the answers and stops the generation as soon as all requested fields are complete.
+- max_tokens (int): Maximum number of generated tokens per requested field.
+- cascade (list, optional): Cheaper models which are tried before `model`. A field is only
+  escalated to the next model if the answer is rejected by the `validator`.
+- validator (FieldValidator, optional): Checks the answers of the cheaper models.
+- resilience (Resilience, optional): Retries and circuit breaker of the inference calls.
 """
 class AI:
-    def __init__(self, model: str, logger: logging.Logger):
+    COLD_LOAD_THRESHOLD = 0.5  # Seconds of load_duration after which a request counts as a cold load
+    CALL_STATS_SIZE = 100  # Number of recent inferences kept for the statistics
+    JSON_OVERHEAD_TOKENS = 16  # Tokens for the JSON syntax around the answer
+
+    def __init__(self, model: str, logger: logging.Logger, host: str = None, timeout: float = 300.0, max_connections: int = 10, datafields=None, cache=None,
+                 strategies: dict = None, default_strategy: str = "full", parallelism: int = 2, max_chunks: int = 16, keep_alive=None,
+                 stream: bool = False, max_tokens: int = 256, cascade: list = None, validator=None,
+                 resilience=None):
         if logger is None:
             raise ValueError("Logger cannot be None")
         if model is None:
@@ -20,6 +55,25 @@ class AI:
 
         self._logger = logger
         self._model = model
+        self._tiers = [tier for tier in (cascade or []) if tier != model] + [model]  # Cheapest model first
+        self._validator = validator
+        self._tierStats = {tier: {"calls": 0, "fields": 0, "accepted": 0, "escalated": 0, "failures": 0, "seconds": 0.0} for tier in self._tiers}
+        self._timeout = timeout
+        self._datafields = tuple(datafields) if datafields else ()
+        self._cache = cache
+        self._strategies = strategies or {}
+        self._default_strategy = default_strategy
+        self._parallelism = parallelism
+        self._max_chunks = max_chunks
+        self._keep_alive = keep_alive
+        self._stream = stream
+        self._max_tokens = max_tokens
+        self._callStats = deque(maxlen=self.CALL_STATS_SIZE)  # Timings of the most recent inferences
+        self._lastActivity = None
+        self._keepWarmTask = None
+        self._warmTask = None
+        self._pool = OllamaPool(host, logger, timeout, max_connections)
+        self.resilience = resilience or Resilience("ollama", None, retries=0)
         self.systemprompt = (
             "You are a personalized document analyzer. Your task is to analyze documents and extract relevant information. "
             "Analyze the document content which you will get in the next message. "
@@ -34,76 +88,931 @@ class AI:
     Parameters:
     - content (str): The document content to analyze.
     - prompt (str): The specific instruction on what information to extract.
+    - timeout (float, optional): Overrides the default timeout for this call.
+    - bypass_cache (bool): Ignores a cached result and runs the model again.
 
     Returns:
-    - dict: Extracted information in JSON format.
+    - str: The extracted information.
+
+    Raises:
+    - asyncio.TimeoutError: If the model does not answer within the timeout.
     """
-    def getResponse(self, content: str, prompt: str) -> dict:
+    async def getResponse(self, content: str, prompt: str, timeout: float = None, bypass_cache: bool = False) -> str:
+        key = None
+        if self._cache is not None:
+            key = self._cache.key(self._model, self.systemprompt, content, prompt)
+            if not bypass_cache:
+                cached = await self._cache.get(key)
+                if cached is not None:
+                    self._logger.debug(f"The AI cache returned: {cached}")
+                    return cached
+
         messages = [
             {'role': 'system', 'content': self.systemprompt},
             {'role': 'system', 'content': content},
             {'role': 'user', 'content': prompt},
         ]
 
-        response = chat(self._model, messages=messages, format=Info.model_json_schema())
+        response = await self._chat(messages, buildInfoModel(("info",)).model_json_schema(), ("info",), timeout)
         jsonvalue = json.loads(response['message']['content'])
         self._logger.debug(f"The AI returned: {jsonvalue['info']}")
+        if key is not None:
+            await self._cache.put(key, jsonvalue['info'])
         return jsonvalue['info']
 
     """
-    Checks if the AI model is available and loads it if necessary.
+    Extracts several fields from a document with as few inferences as possible.
+
+    The document content and the system prompt are only sent once per content part. The
+    per-field prompts are combined into one instruction and the answer is constrained by a
+    JSON schema which contains exactly the requested fields. Fields with a cached result
+    are not sent to the model again.
+
+    Each field sees the content according to its content strategy (see `services.content`).
+    Fields sharing a strategy are extracted together. If the content is split into several
+    chunks, each chunk is analyzed separately (at most `parallelism` at a time) and the
+    partial answers are combined by a final inference.
+
+    Parameters:
+    - content (str): The document content to analyze.
+    - prompts (dict): Mapping of field name to the instruction for that field.
+    - timeout (float, optional): Overrides the default timeout for a single inference.
+    - bypass_cache (bool): Ignores cached results and runs the model again.
+
+    Returns:
+    - dict: Mapping of field name to the extracted information.
+
+    Raises:
+    - ValueError: If a field is not part of the accepted datafields.
+    - asyncio.TimeoutError: If the model does not answer within the timeout.
+    """
+    async def getResponses(self, content: str, prompts: dict, timeout: float = None, bypass_cache: bool = False) -> dict:
+        if not prompts:
+            return {}
+        unknown = [field for field in prompts if field not in self._datafields]
+        if unknown:
+            raise ValueError(f"Fields {unknown} are not accepted datafields")
+
+        # Group the fields by the content they need to see
+        groups = {}
+        for field, prompt in prompts.items():
+            strategy = self._strategies.get(field, self._default_strategy)
+            groups.setdefault(strategy, {})[field] = prompt
+
+        results = {}
+        for strategy, group in groups.items():
+            chunks = prepareContent(content, strategy, self._max_chunks)
+            results.update(await self._cascade(chunks, group, timeout, bypass_cache))
+        return results
+
+    """
+    Extracts the fields with the cheapest model first and escalates rejected fields.
+
+    Every answer of a model except the last one is checked by the validator. Accepted
+    fields are final, the others are sent to the next model of the cascade. The answer
+    of the last model is always accepted.
+
+    Parameters:
+    - chunks (list[str]): The content parts of the document in order.
+    - prompts (dict): Mapping of field name to the instruction for that field.
+    - timeout (float, optional): Overrides the default timeout for a single inference.
+    - bypass_cache (bool): Ignores cached results and runs the model again.
+
+    Returns:
+    - dict: Mapping of field name to the extracted information.
+    """
+    async def _cascade(self, chunks: list, prompts: dict, timeout: float = None, bypass_cache: bool = False) -> dict:
+        results = {}
+        pending = dict(prompts)
+        for tier, model in enumerate(self._tiers):
+            final = tier == len(self._tiers) - 1
+            stats = self._tierStats[model]
+            start = time.monotonic()
+            try:
+                if len(chunks) == 1:
+                    answers = await self._extract(model, chunks[0], pending, timeout, bypass_cache)
+                else:
+                    answers = await self._mapReduce(model, chunks, pending, timeout, bypass_cache)
+            except Exception as e:
+                if final:
+                    raise
+                self._logger.info(f"Model {model} failed ({e}), escalating {list(pending)}")
+                answers = {}
+                stats["failures"] += 1
+            finally:
+                duration = time.monotonic() - start
+                stats["calls"] += 1
+                stats["seconds"] += duration
+                INFERENCE_SECONDS.observe(model, ",".join(sorted(pending)), value=duration)
+
+            accepted = {}
+            for field, value in answers.items():
+                if final or self._validator is None or await self._validator.validate(field, value):
+                    accepted[field] = value
+            results.update(accepted)
+
+            stats["fields"] += len(pending)
+            stats["accepted"] += len(accepted)
+            pending = {field: prompt for field, prompt in pending.items() if field not in accepted}
+            if not pending:
+                break
+            stats["escalated"] += len(pending)
+            self._logger.debug(f"Model {model} answers for {list(pending)} were rejected, escalating")
+        return results
+
+    """
+    Extracts the fields from every chunk and combines the partial answers.
+
+    Parameters:
+    - model (str): The model to use.
+    - chunks (list[str]): The content parts of the document in order.
+    - prompts (dict): Mapping of field name to the instruction for that field.
+    - timeout (float, optional): Overrides the default timeout for a single inference.
+    - bypass_cache (bool): Ignores cached results and runs the model again.
+
+    Returns:
+    - dict: Mapping of field name to the combined information.
+    """
+    async def _mapReduce(self, model: str, chunks: list, prompts: dict, timeout: float = None, bypass_cache: bool = False) -> dict:
+        self._logger.debug(f"Analyzing {len(chunks)} chunks for the fields {list(prompts)} with {model}")
+        semaphore = asyncio.Semaphore(self._parallelism)
+
+        async def extractChunk(chunk):
+            async with semaphore:
+                return await self._extract(model, chunk, prompts, timeout, bypass_cache)
+
+        partials = await asyncio.gather(*(extractChunk(chunk) for chunk in chunks))
+
+        summary = (
+            "The document was too long to be analyzed at once. "
+            "These are the answers extracted from its consecutive parts:\n"
+        )
+        summary += "\n".join(f"Part {index + 1}: {json.dumps(partial, ensure_ascii=False)}" for index, partial in enumerate(partials))
+        reducePrompts = {
+            field: f"Combine the answers of all parts into one final answer for '{field}'. The original instruction was: {prompt}"
+            for field, prompt in prompts.items()
+        }
+        return await self._extract(model, summary, reducePrompts, timeout, bypass_cache)
+
+    """
+    Runs one inference for the given fields on the given content, using the cache if possible.
+
+    Parameters:
+    - model (str): The model to use.
+    - content (str): The content to analyze.
+    - prompts (dict): Mapping of field name to the instruction for that field.
+    - timeout (float, optional): Overrides the default timeout for this call.
+    - bypass_cache (bool): Ignores cached results and runs the model again.
+
+    Returns:
+    - dict: Mapping of field name to the extracted information.
+    """
+    async def _extract(self, model: str, content: str, prompts: dict, timeout: float = None, bypass_cache: bool = False) -> dict:
+        results = {}
+        keys = {}
+        if self._cache is not None:
+            for field in prompts:
+                keys[field] = self._cache.key(model, self.systemprompt, content, f"{field}: {prompts[field]}")
+                if not bypass_cache:
+                    cached = await self._cache.get(keys[field])
+                    if cached is not None:
+                        results[field] = cached
+            if results:
+                self._logger.debug(f"The AI cache returned: {results}")
+
+        fields = tuple(field for field in self._datafields if field in prompts and field not in results)
+        if not fields:
+            return results
+
+        instruction = "Extract the following information and return it as a JSON object with exactly these keys:\n"
+        instruction += "\n".join(f"- {field}: {prompts[field]}" for field in fields)
+
+        messages = [
+            {'role': 'system', 'content': self.systemprompt},
+            {'role': 'system', 'content': content},
+            {'role': 'user', 'content': instruction},
+        ]
+
+        response = await self._chat(messages, buildInfoModel(fields).model_json_schema(), fields, timeout, model)
+        jsonvalue = json.loads(response['message']['content'])
+        self._logger.debug(f"The AI returned: {jsonvalue}")
+        for field in fields:
+            results[field] = jsonvalue[field]
+            if field in keys:
+                await self._cache.put(keys[field], jsonvalue[field])
+        return results
+
+    """
+    Sends a chat request to the model.
+
+    Applies the keep_alive setting, the output token limit and the timeout, and records
+    the load time if the model had to be loaded for this request. In streaming mode the
+    answer is parsed while it is generated and the generation is stopped as soon as all
+    fields are complete.
+
+    Parameters:
+    - messages (list): The chat messages.
+    - format (dict): The JSON schema of the expected answer.
+    - fields (tuple[str]): The fields the answer has to contain.
+    - timeout (float, optional): Overrides the default timeout for this call.
+    - model (str, optional): The model to use. Defaults to the model of this instance.
 
     Returns:
-    - bool: True if the model is successfully loaded, otherwise False.
+    - dict: The response of the model with the answer in ['message']['content'].
+    """
+    async def _chat(self, messages: list, format: dict, fields: tuple, timeout: float = None, model: str = None) -> dict:
+        model = model or self._model
+        self._lastActivity = time.monotonic()
+        options = {"num_predict": self._max_tokens * len(fields) + self.JSON_OVERHEAD_TOKENS}
+
+        async def chat(backend):
+            start = time.monotonic()
+            if self._stream:
+                response, stats = await self._streamChat(backend, model, messages, format, options, fields)
+            else:
+                response = await backend.client.chat(model, messages=messages, format=format, options=options, keep_alive=self._keep_alive)
+                stats = {"ttft": None, "tokens": response.get('eval_count'), "early_stop": False}
+            stats["duration"] = time.monotonic() - start
+            self._recordCall(backend, model, stats, response)
+
+            residency = self._modelStats(backend, model)
+            residency["loaded"] = True
+            residency["last_used"] = time.time()
+            load_duration = (response.get('load_duration') or 0) / 1e9
+            if load_duration >= self.COLD_LOAD_THRESHOLD:
+                self._recordLoad(backend, model, load_duration, load_duration)
+                self._logger.info(f"Model {model} had to be loaded on {backend.host} for a request, this took {load_duration:.1f}s")
+            return response
+
+        # Transient failures of all hosts are retried, the circuit breaker stops calls while Ollama is down
+        return await self.resilience.call(lambda: self._pool.call(chat, timeout or self._timeout))
+
     """
-    def selfCheck(self) -> bool:
+    Streams a chat answer and stops as soon as all fields are complete.
+
+    Parameters:
+    - backend (OllamaBackend): The host to use.
+    - model (str): The model to use.
+    - messages (list): The chat messages.
+    - format (dict): The JSON schema of the expected answer.
+    - options (dict): The model options.
+    - fields (tuple[str]): The fields the answer has to contain.
+
+    Returns:
+    - tuple: The response with the (possibly completed) JSON answer and the timing statistics.
+    """
+    async def _streamChat(self, backend, model: str, messages: list, format: dict, options: dict, fields: tuple) -> tuple:
+        start = time.monotonic()
+        parser = StreamingJSONParser()
+        stats = {"ttft": None, "tokens": 0, "early_stop": False}
+        last = {}
+
+        stream = await backend.client.chat(model, messages=messages, format=format, options=options,
+                                           keep_alive=self._keep_alive, stream=True)
+        try:
+            async for chunk in stream:
+                last = chunk
+                text = chunk['message']['content']
+                if text:
+                    if stats["ttft"] is None:
+                        stats["ttft"] = time.monotonic() - start
+                    stats["tokens"] += 1
+                    parser.feed(text)
+                if chunk.get('done'):
+                    break
+                if parser.complete(fields):
+                    stats["early_stop"] = True
+                    break
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()  # Closes the connection, which makes Ollama stop generating
+
+        if last.get('done') and last.get('eval_count'):
+            stats["tokens"] = last['eval_count']
+            stats["eval_duration"] = (last.get('eval_duration') or 0) / 1e9
+
+        content = json.dumps(parser.value, ensure_ascii=False) if parser.complete(fields) else parser.buffer
+        response = {
+            "message": {"role": "assistant", "content": content},
+            "load_duration": last.get('load_duration'),
+            "eval_count": stats["tokens"]
+        }
+        return response, stats
+
+    def _recordCall(self, backend, model: str, stats: dict, response) -> None:
+        generation = stats.pop("eval_duration", None)
+        if not generation:
+            eval_duration = response.get('eval_duration')
+            generation = eval_duration / 1e9 if eval_duration else stats["duration"] - (stats["ttft"] or 0)
+        tokens = stats["tokens"] or 0
+        stats["tokens_per_second"] = round(tokens / generation, 1) if generation > 0 and tokens else None
+        stats["model"] = model
+        stats["host"] = backend.host
+        stats["duration"] = round(stats["duration"], 3)
+        if stats["ttft"] is not None:
+            stats["ttft"] = round(stats["ttft"], 3)
+        self._callStats.append(stats)
+        self._logger.debug(
+            f"Inference on {backend.host}: {tokens} tokens in {stats['duration']}s, "
+            f"time to first token {stats['ttft']}s, {stats['tokens_per_second']} tokens/s, early stop: {stats['early_stop']}"
+        )
+
+    """
+    Calculates embedding vectors for texts.
+
+    Parameters:
+    - texts (list[str]): The texts to embed.
+    - model (str): The embedding model.
+    - timeout (float, optional): Overrides the default timeout for this call.
+
+    Returns:
+    - list[list[float]]: One vector per text.
+    """
+    async def embed(self, texts: list, model: str, timeout: float = None) -> list:
+        self._lastActivity = time.monotonic()
+
+        async def embed(backend):
+            response = await backend.client.embed(model=model, input=texts, keep_alive=self._keep_alive)
+            return response['embeddings']
+
+        return await self.resilience.call(lambda: self._pool.call(embed, timeout or self._timeout))
+
+    """
+    Reports the timings of the most recent inferences.
+
+    Returns:
+    - dict: Averages and the individual timings (time to first token, tokens/s, duration).
+    """
+    def inferenceStats(self) -> dict:
+        calls = list(self._callStats)
+
+        def average(key):
+            values = [call[key] for call in calls if call.get(key) is not None]
+            return round(sum(values) / len(values), 3) if values else None
+
+        return {
+            "calls": len(calls),
+            "early_stops": sum(1 for call in calls if call["early_stop"]),
+            "avg_ttft": average("ttft"),
+            "avg_tokens_per_second": average("tokens_per_second"),
+            "avg_duration": average("duration"),
+            "tiers": {
+                model: {
+                    **stats,
+                    "seconds": round(stats["seconds"], 3),
+                    "hit_rate": round(stats["accepted"] / stats["fields"], 3) if stats["fields"] else None,
+                    "avg_latency": round(stats["seconds"] / stats["calls"], 3) if stats["calls"] else None
+                }
+                for model, stats in self._tierStats.items()
+            },
+            "recent": calls[-10:]
+        }
+
+    """
+    Checks if the AI models of the cascade are available on every Ollama host and loads them if necessary.
+
+    Hosts on which the model cannot be pulled are marked as unhealthy.
+
+    Returns:
+    - bool: True if the model is successfully loaded on at least one host, otherwise False.
+    """
+    async def selfCheck(self) -> bool:
+        results = await asyncio.gather(*(self._pull(backend) for backend in self._pool.backends))
+        if not any(results):
+            return False
+        for model in self._tiers[:-1]:
+            if not await self.pullModel(model):
+                return False
+
+        # Load the model into memory, so the first request does not pay for it
+        duration = await self.loadModel()
+        self._logger.debug(f"It took {duration:.1f}s to load the model")
+
+        return True
+
+    """
+    Makes sure an additional model (e.g. an embedding model) is available on every host.
+
+    Parameters:
+    - model (str): The model to pull.
+
+    Returns:
+    - bool: True if the model is available on at least one host.
+    """
+    async def pullModel(self, model: str) -> bool:
+        results = await asyncio.gather(*(self._pull(backend, model) for backend in self._pool.healthyBackends()))
+        return any(results)
+
+    async def _pull(self, backend, model: str = None) -> bool:
+        model = model or self._model
         start = datetime.now()
-        response = pull(self._model, stream=True)
-        self._logger.debug("Checking if the model is already pulled.")
+        self._logger.debug(f"Checking if the model {model} is already pulled on {backend.host}.")
 
         progress_states = set()
+        progress = {}
         try:
-            for progress in response:
+            response = await backend.client.pull(model, stream=True)
+            async for progress in response:
                 if progress.get('status') and progress['status'].startswith("pulling manifest"):
-                    self._logger.info(f"Model {self._model} not found. Pulling the model")
-                self._logger.debug(progress.get('status'))
+                    self._logger.info(f"Model {model} not found on {backend.host}. Pulling the model")
                 if progress.get('status') in progress_states:
                     continue
+                self._logger.debug(progress.get('status'))
                 progress_states.add(progress.get('status'))
-        except Exception:
-            self._logger.error(f"Something went wrong. Maybe the model {self._model} does not exist?")
+        except Exception as e:
+            self._logger.error(f"Something went wrong on {backend.host}. Maybe the model {model} does not exist?")
+            backend.markFailed(e)
             return False
 
-        self._logger.info(progress.get('status'))
+        self._logger.info(f"{backend.host}: {progress.get('status')}")
         end = datetime.now()
         duration = end - start
-        self._logger.debug(f"It took {duration} to pull the model")
+        self._logger.debug(f"It took {duration} to pull the model on {backend.host}")
+        return True
 
-        # Wait for the model to load
-        start = datetime.now()
-        self._logger.debug("Waiting for model to load...")
-        end = datetime.now()
-        duration = end - start
-        self._logger.debug(f"It took {duration} to load the model")
+    """
+    Loads the model into memory on every healthy host and keeps it there for `keep_alive`.
 
-        # Run a simple test command to check if the model is responsive
-        start = datetime.now()
-        response: ProcessResponse = ps()
+    An empty prompt makes Ollama load the model without generating anything, so the
+    call is cheap when the model is already loaded.
+
+    Parameters:
+    - model (str, optional): The model to load. Defaults to all models of the cascade.
+
+    Returns:
+    - float: The longest wall-clock time of the call in seconds.
+    """
+    async def loadModel(self, model: str = None) -> float:
+        if model is None:
+            return max([await self.loadModel(tier) for tier in self._tiers])
+
+        async def load(backend):
+            start = time.monotonic()
+            response = await asyncio.wait_for(
+                backend.client.generate(model, prompt="", keep_alive=self._keep_alive),
+                self._timeout
+            )
+            duration = time.monotonic() - start
+            load_duration = (response.get('load_duration') or 0) / 1e9
+            stats = self._modelStats(backend, model)
+            if stats["loads"] == 0 or load_duration >= self.COLD_LOAD_THRESHOLD:
+                self._recordLoad(backend, model, duration, load_duration)
+            stats["loaded"] = True
+            return duration
+
+        return max(await self._pool.each(load), default=0.0)
+
+    """
+    Unloads the model from memory on every healthy host.
+
+    Parameters:
+    - model (str, optional): The model to unload. Defaults to the model of this instance.
 
-        response: ChatResponse = chat(
-            model=self._model,
-            messages=[{'role': 'user', 'content': 'Say Hello Gemma'}]
+    Returns:
+    - float: The longest wall-clock time of the call in seconds.
+    """
+    async def unloadModel(self, model: str = None) -> float:
+        model = model or self._model
+
+        async def unload(backend):
+            start = time.monotonic()
+            await asyncio.wait_for(backend.client.generate(model, prompt="", keep_alive=0), self._timeout)
+            duration = time.monotonic() - start
+            stats = self._modelStats(backend, model)
+            stats["loaded"] = False
+            stats["unloads"] += 1
+            stats["last_unload_seconds"] = round(duration, 3)
+            stats["last_unload_at"] = time.time()
+            self._logger.info(f"Model {model} unloaded on {backend.host} in {duration:.1f}s")
+            return duration
+
+        return max(await self._pool.each(unload), default=0.0)
+
+    """
+    Unloads the models of this instance which a replacing instance does not use, e.g.
+    after OLLAMA_MODEL or OLLAMA_CASCADE changed, so they do not occupy memory until
+    their keep_alive expires.
+
+    Parameters:
+    - keep (list[str]): The models which are still used.
+    """
+    async def releaseModels(self, keep: list) -> None:
+        for model in self._tiers:
+            if model not in keep:
+                await self.unloadModel(model)
+
+    """
+    The models of the cascade, cheapest first.
+    """
+    @property
+    def models(self) -> list:
+        return list(self._tiers)
+
+    """
+    Records activity of the processing queue.
+
+    Called when requests are queued or processed. If the model is not known to be loaded,
+    a load is started in the background, so it overlaps with the time the entry waits in
+    the queue.
+    """
+    def noteActivity(self) -> None:
+        self._lastActivity = time.monotonic()
+        loaded = all(
+            self._modelStats(backend, model)["loaded"] for backend in self._pool.healthyBackends() for model in self._tiers
         )
+        if loaded or self._keepWarmTask is None:
+            return
+        if self._warmTask is None or self._warmTask.done():
+            self._warmTask = asyncio.create_task(self._warm())
 
-        self._logger.debug(response['message']['content'])
-        end = datetime.now()
-        duration = end - start
-        self._logger.debug(f"It took {duration} to greet you")
+    """
+    Starts the background task which keeps the model loaded while the queue is active.
+
+    Parameters:
+    - interval (float): Seconds between two keep-warm pings.
+    - window (float): Seconds after the last queue activity during which the model is kept warm.
+    """
+    def startKeepWarm(self, interval: float, window: float) -> None:
+        if interval <= 0 or self._keepWarmTask is not None:
+            return
+        self._keepWarmTask = asyncio.create_task(self._keepWarm(interval, window))
+
+    async def _keepWarm(self, interval: float, window: float) -> None:
+        self._logger.info(f"Keeping models {self._tiers} warm every {interval}s for {window}s after queue activity")
+        while True:
+            await asyncio.sleep(interval)
+            if self._lastActivity is not None and time.monotonic() - self._lastActivity <= window:
+                await self._warm()
+            else:
+                for backend in self._pool.backends:
+                    for model in self._tiers:
+                        self._modelStats(backend, model)["loaded"] = False  # Ollama unloads it after keep_alive
+
+    async def _warm(self) -> None:
+        try:
+            await self.loadModel()
+        except Exception as e:
+            self._logger.warning(f"Keep-warm of models {self._tiers} failed: {e}")
+
+    """
+    Reports the residency of the models per Ollama host.
+
+    Combines the recorded load/unload timings with the models Ollama currently holds in memory.
+
+    Returns:
+    - dict: Residency information per host and model.
+    """
+    async def residency(self) -> dict:
+        report = {}
+        for backend in self._pool.backends:
+            models = report[backend.host] = {model: dict(stats) for model, stats in backend.residency.items()}
+            try:
+                response: ProcessResponse = await asyncio.wait_for(backend.client.ps(), 10)
+                for running in response.models:
+                    entry = models.setdefault(running.model, {})
+                    entry["resident"] = True
+                    entry["expires_at"] = running.expires_at.isoformat() if running.expires_at else None
+                    entry["size_vram"] = running.size_vram
+            except Exception as e:
+                self._logger.warning(f"Could not query the loaded models on {backend.host}: {e}")
+        return report
+
+    """
+    Reports the state of the Ollama hosts.
+
+    Returns:
+    - list[dict]: Health, in-flight requests and latency per host.
+    """
+    def hostStatus(self) -> list:
+        return self._pool.status()
+
+    """
+    Starts the periodic health checks of the Ollama hosts.
+
+    Parameters:
+    - interval (float): Seconds between two health checks.
+    """
+    def startHealthChecks(self, interval: float) -> None:
+        self._pool.startHealthChecks(interval)
+
+    def _modelStats(self, backend, model: str) -> dict:
+        return backend.residency.setdefault(model, {
+            "loaded": False, "loads": 0, "last_load_seconds": None, "last_load_duration": None,
+            "last_load_at": None, "unloads": 0, "last_unload_seconds": None, "last_unload_at": None,
+            "last_used": None
+        })
+
+    def _recordLoad(self, backend, model: str, seconds: float, load_duration: float) -> None:
+        stats = self._modelStats(backend, model)
+        stats["loads"] += 1
+        stats["last_load_seconds"] = round(seconds, 3)  # Wall-clock time including the request
+        stats["last_load_duration"] = round(load_duration, 3)  # Load time reported by Ollama
+        stats["last_load_at"] = time.time()
+
+    """
+    Stops the background tasks and closes the connection pools towards Ollama.
+    """
+    async def close(self) -> None:
+        for task in (self._keepWarmTask, self._warmTask):
+            if task is not None:
+                task.cancel()
+        self._keepWarmTask = self._warmTask = None
+        await self._pool.close()
+
+"""
+A single Ollama host with its own connection pool and statistics.
+
+Parameters:
+- host (str): The URL of the Ollama host.
+- timeout (float): Default timeout in seconds for requests to the host.
+- max_connections (int): Size of the HTTP connection pool towards the host.
+"""
+class OllamaBackend:
+    LATENCY_WEIGHT = 0.2  # Weight of the newest request in the moving average of the latency
+
+    def __init__(self, host: str, timeout: float, max_connections: int):
+        self.host = host
+        self.client = AsyncClient(
+            host=host,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self.healthy = True
+        self.inflight = 0
+        self.latency = None  # Moving average of the request duration in seconds
+        self.requests = 0
+        self.failures = 0
+        self.lastError = None
+        self.residency = {}  # Load/unload statistics per model
+
+    def recordSuccess(self, duration: float) -> None:
+        self.requests += 1
+        self.healthy = True
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency += self.LATENCY_WEIGHT * (duration - self.latency)
+
+    def markFailed(self, error: Exception) -> None:
+        self.failures += 1
+        self.healthy = False
+        self.lastError = str(error) or type(error).__name__
+        for stats in self.residency.values():
+            stats["loaded"] = False
+
+    def status(self) -> dict:
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "inflight": self.inflight,
+            "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.lastError
+        }
+
+"""
+Pool of Ollama hosts which routes every request to the least loaded healthy host.
+
+A host is marked unhealthy when a request fails because the host is unreachable or
+broken, and the request is retried on the next host. Periodic health checks bring
+recovered hosts back into the rotation.
+
+Parameters:
+- hosts (str|list): The Ollama host(s), as list or comma separated.
+- logger (logging.Logger): Logger instance for logging.
+- timeout (float): Default timeout in seconds for requests.
+- max_connections (int): Size of the HTTP connection pool towards each host.
+"""
+class OllamaPool:
+    def __init__(self, hosts, logger: logging.Logger, timeout: float = 300.0, max_connections: int = 10):
+        if isinstance(hosts, str) or hosts is None:
+            hosts = parseHosts(hosts)
+        self._logger = logger
+        self.backends = [OllamaBackend(host, timeout, max_connections) for host in hosts or [None]]
+        self._healthTask = None
+
+    def healthyBackends(self) -> list:
+        return [backend for backend in self.backends if backend.healthy]
+
+    """
+    Runs an operation on the least loaded healthy host and fails over to the next host
+    if the host is unreachable or broken.
+
+    Parameters:
+    - operation (callable): Coroutine function which gets the `OllamaBackend` to use.
+    - timeout (float): Timeout in seconds for a single attempt.
+
+    Returns:
+    - The result of the operation.
+
+    Raises:
+    - asyncio.TimeoutError: If the host does not answer within the timeout.
+    - ConnectionError: If no host is able to handle the request.
+    """
+    async def call(self, operation, timeout: float):
+        tried = []
+        lastError = None
+        while True:
+            backend = self._select(tried)
+            if backend is None:
+                raise ConnectionError(f"No Ollama host was able to handle the request: {lastError}")
+            tried.append(backend)
+
+            backend.inflight += 1
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(operation(backend), timeout)
+            except Exception as e:
+                if not isBackendFailure(e):
+                    raise
+                backend.markFailed(e)
+                lastError = e
+                self._logger.warning(f"Ollama host {backend.host} failed: {e}. Trying the next host.")
+                continue
+            finally:
+                backend.inflight -= 1
+            backend.recordSuccess(time.monotonic() - start)
+            return result
+
+    """
+    Runs an operation on every healthy host at the same time.
+
+    Parameters:
+    - operation (callable): Coroutine function which gets the `OllamaBackend` to use.
+
+    Returns:
+    - list: The results of the hosts on which the operation succeeded.
+    """
+    async def each(self, operation) -> list:
+        backends = self.healthyBackends()
+        results = await asyncio.gather(*(operation(backend) for backend in backends), return_exceptions=True)
+        succeeded = []
+        for backend, result in zip(backends, results):
+            if isinstance(result, Exception):
+                self._logger.warning(f"Ollama host {backend.host} failed: {result}")
+                if isBackendFailure(result):
+                    backend.markFailed(result)
+            else:
+                succeeded.append(result)
+        return succeeded
+
+    """
+    Starts the periodic health checks.
+
+    Parameters:
+    - interval (float): Seconds between two health checks, 0 disables them.
+    """
+    def startHealthChecks(self, interval: float) -> None:
+        if interval <= 0 or self._healthTask is not None:
+            return
+        self._healthTask = asyncio.create_task(self._healthChecks(interval))
+
+    async def _healthChecks(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.checkHealth()
 
+    """
+    Checks every host by listing its loaded models.
+    """
+    async def checkHealth(self) -> None:
+        async def check(backend):
+            try:
+                await asyncio.wait_for(backend.client.ps(), 10)
+            except Exception as e:
+                if backend.healthy:
+                    self._logger.warning(f"Ollama host {backend.host} is unhealthy: {e}")
+                backend.markFailed(e)
+            else:
+                if not backend.healthy:
+                    self._logger.info(f"Ollama host {backend.host} is healthy again")
+                backend.healthy = True
+
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+
+    def status(self) -> list:
+        return [backend.status() for backend in self.backends]
+
+    async def close(self) -> None:
+        if self._healthTask is not None:
+            self._healthTask.cancel()
+            self._healthTask = None
+        for backend in self.backends:
+            await backend.client.close()
+
+    def _select(self, tried: list):
+        candidates = [backend for backend in self.healthyBackends() if backend not in tried]
+        if not candidates and not tried:
+            candidates = self.backends  # All hosts are unhealthy, try them anyway
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: (backend.inflight, backend.latency or 0.0))
+
+"""
+Incremental parser for a JSON object which is generated token by token.
+
+Tracks the nesting and string state of the streamed text and tries to parse the object
+whenever a top-level value may be complete, so that the caller knows which fields are
+already finished before the model closes the object.
+"""
+class StreamingJSONParser:
+    def __init__(self):
+        self.buffer = ""
+        self.value = {}
+        self._depth = 0
+        self._inString = False
+        self._escape = False
+
+    """
+    Adds streamed text.
+
+    Parameters:
+    - text (str): The next part of the answer.
+    """
+    def feed(self, text: str) -> None:
+        for char in text:
+            self.buffer += char
+            if self._inString:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._inString = False
+                    if self._depth == 1:
+                        self._tryParse(self.buffer + "}")  # A top-level string value may be complete
+            elif char == '"':
+                self._inString = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._tryParse(self.buffer)  # The object is complete
+                elif self._depth == 1:
+                    self._tryParse(self.buffer + "}")  # A nested top-level value is complete
+            elif char == "," and self._depth == 1:
+                self._tryParse(self.buffer[:-1] + "}")  # The previous top-level value is complete
+
+    """
+    Checks whether all fields have a complete value.
+
+    Parameters:
+    - fields (iterable): The required fields.
+
+    Returns:
+    - bool: True if every field has been parsed.
+    """
+    def complete(self, fields) -> bool:
+        return all(field in self.value for field in fields)
+
+    def _tryParse(self, text: str) -> None:
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return
+        if isinstance(value, dict):
+            self.value = value
+
+"""
+Splits a comma separated list of Ollama hosts.
+
+Parameters:
+- hosts (str): The hosts, e.g. "http://gpu1:11434,http://gpu2:11434".
+
+Returns:
+- list[str]: The hosts.
+"""
+def parseHosts(hosts: str) -> list:
+    return [host.strip() for host in (hosts or "").split(",") if host.strip()]
+
+"""
+Decides whether an error means the Ollama host is unreachable or broken, so that the
+request should be retried on another host.
+
+Parameters:
+- error (Exception): The raised error.
+
+Returns:
+- bool: True for connection errors and server errors, False for everything else.
+"""
+def isBackendFailure(error: Exception) -> bool:
+    if isinstance(error, (httpx.TransportError, ConnectionError)):
         return True
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500 or error.status_code == 404  # 404: model missing on this host
+    return False
 
 """
-Defines the expected response format for AI output.
+Builds the expected response format for AI output.
+
+Parameters:
+- fields (tuple[str]): Names of the fields the model has to return.
+
+Returns:
+- type[BaseModel]: A pydantic model with one required string attribute per field.
 """
-class Info(BaseModel):
-    info: str
\ No newline at end of file
+@lru_cache(maxsize=None)
+def buildInfoModel(fields: tuple) -> type[BaseModel]:
+    return create_model("Info", **{field: (str, ...) for field in fields})
@@ -0,0 +1,303 @@
+import os, json, time, asyncio, logging
+from services.resilience import CircuitOpenError
+
+"""
+Feeds the documents matching a Paperless query into the processing queue.
+
+The ids of all matching documents are resolved once when the backfill starts, from the
+"all" attribute of the Paperless list response, and written to an id file next to the
+checkpoint. A full text query returns its hits by relevance, not by id, so the position
+in this list is checkpointed instead of an id cursor. The checkpoint itself only holds
+the position and the counters, so it stays small however many documents match. Every document gets a queue entry in the bulk
+lane, at most `rate` documents per second and only while fewer than `max_pending` bulk
+entries are waiting, so the queue never grows faster than the workers can drain it.
+After every `page_size` documents the position is written to a checkpoint file, an
+interrupted backfill continues from there after a restart.
+
+Parameters:
+- paperless: API instance to page through the documents.
+- queue (PersistentQueue): The processing queue.
+- path (str): Path of the checkpoint file, the ids are written to the same name with ".ids" before the extension.
+- merge (callable): Merges a queue entry into a pending entry of the same document.
+- rate (float): Maximum number of documents queued per second, 0 disables the limit.
+- max_pending (int): Maximum number of waiting bulk entries.
+- page_size (int): Number of document ids fetched per request and documents queued between checkpoints.
+- resilience (Resilience, optional): Deadline, retries and circuit breaker of the requests.
+"""
+class Backfill:
+    LANE = "bulk"
+
+    def __init__(self, paperless, queue, path: str, merge=None, rate: float = 5.0, max_pending: int = 200, page_size: int = 100,
+                 resilience=None):
+        self._api = paperless
+        self._queue = queue
+        self._path = path
+        root, extension = os.path.splitext(path)
+        self._idsPath = f"{root}.ids{extension or '.json'}"
+        self._ids = None  # Ids of the current backfill, loaded from the id file on resume
+        self._merge = merge
+        self._rate = _parseRate(rate, allow_zero=True)
+        self._max_pending = max_pending
+        self._page_size = page_size
+        self._resilience = resilience
+        self._task = None
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self.job = self._load()
+
+    """
+    Starts a new backfill.
+
+    Parameters:
+    - request (dict): The template of the queue entries ("fields", "tag", "bypass_cache").
+    - query (str, optional): Paperless full text query.
+    - filters (dict, optional): Additional Paperless document filters, e.g. {"tags__id__all": 3}.
+    - rate (float, optional): Overrides the rate of this backfill, has to be a positive number.
+
+    Returns:
+    - dict: The progress of the new backfill.
+
+    Raises:
+    - RuntimeError: If a backfill is already running.
+    - ValueError: If the rate is not a positive number.
+    """
+    async def start(self, request: dict, query: str = None, filters: dict = None, rate: float = None) -> dict:
+        if self.running:
+            raise RuntimeError("A backfill is already running")
+        rate = _parseRate(rate) if rate is not None else self._rate
+        self._ids = None
+        self.job = {
+            "state": "running",
+            "query": query,
+            "filters": filters or {},
+            "request": request,
+            "rate": rate,
+            "resolved": False,  # The ids of the matching documents were written to the id file
+            "index": 0,  # Number of ids which were queued
+            "cursor": None,  # Last queued document id
+            "total": None,
+            "queued": 0,
+            "merged": 0,
+            "started": time.time(),
+            "finished": None,
+            "error": None
+        }
+        await self._save()
+        self._spawn()
+        return self.progress()
+
+    """
+    Continues an interrupted backfill, e.g. after a restart.
+
+    Returns:
+    - bool: True if a backfill was continued.
+    """
+    def resumeInterrupted(self) -> bool:
+        if self.job is None or self.job["state"] != "running" or self.running:
+            return False
+        logging.info(f"Continuing backfill after {self.job.get('index', 0)} of {self.job.get('total')} documents")
+        self._spawn()
+        return True
+
+    async def pause(self) -> None:
+        if self.running and self.job["state"] == "running":
+            self._resume.clear()
+            self.job["state"] = "paused"
+            await self._save()
+
+    async def resume(self) -> None:
+        if self.job is not None and self.job["state"] == "paused":
+            self.job["state"] = "running"
+            await self._save()
+            if self.running:
+                self._resume.set()
+            else:
+                self._spawn()  # Paused before a restart
+
+    async def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.job is not None and self.job["state"] in ("running", "paused"):
+            self.job.update(state="cancelled", finished=time.time())
+            await self._save()
+        self._resume.set()
+
+    """
+    Stops the backfill task without changing its state, e.g. during the shutdown. A
+    running backfill continues from its checkpoint after the restart.
+    """
+    async def stop(self) -> None:
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    """
+    Returns the progress of the current or last backfill.
+
+    Returns:
+    - dict: State, counters, throughput in documents per second and the estimated remaining seconds.
+    """
+    def progress(self) -> dict:
+        if self.job is None:
+            return {"state": "idle"}
+        job = self.job
+        elapsed = (job["finished"] or time.time()) - job["started"]
+        processed = job["queued"] + job["merged"]
+        throughput = processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(job["total"] - processed, 0) if job["total"] is not None else None
+        return {
+            "state": job["state"],
+            "query": job["query"],
+            "filters": job["filters"],
+            "index": job.get("index", 0),
+            "cursor": job["cursor"],
+            "total": job["total"],
+            "queued": job["queued"],
+            "merged": job["merged"],
+            "throughput": round(throughput, 2),
+            "eta": round(remaining / throughput) if remaining is not None and throughput else None,
+            "started": job["started"],
+            "finished": job["finished"],
+            "error": job["error"]
+        }
+
+    def _spawn(self) -> None:
+        self._resume.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        job = self.job
+        try:
+            if self._ids is None and job.get("resolved"):
+                self._ids = await asyncio.to_thread(self._loadIds)
+            if self._ids is None:
+                ids = await self._resolve(job)
+                index = 0
+                if job.get("cursor") and not job["query"]:
+                    index = sum(1 for doc_id in ids if doc_id <= job["cursor"])  # Checkpoint of an id cursor
+                await asyncio.to_thread(self._writeJSON, self._idsPath, ids)
+                self._ids = ids
+                job.update(resolved=True, index=index, total=len(ids))
+                await self._save()
+            ids = self._ids
+            while job["index"] < len(ids):
+                doc_id = ids[job["index"]]
+                await self._backpressure(job)
+                entry = dict(job["request"], doc_id=doc_id)
+                _, status = await self._queue.put(entry, key=doc_id, merge=self._merge, lane=self.LANE)
+                job["merged" if status == "merged" else "queued"] += 1
+                job["index"] += 1
+                job["cursor"] = doc_id
+                if job["index"] % self._page_size == 0:
+                    await self._save()  # Checkpoint after every page
+            job.update(state="finished", finished=time.time())
+            logging.info(f"Backfill finished: {job['queued']} documents queued, {job['merged']} merged")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Backfill failed after {job.get('index', 0)} documents: {e}")
+            job.update(state="failed", finished=time.time(), error=str(e))
+        await self._save()
+
+    """
+    Resolves the ids of all matching documents.
+
+    Paperless lists them in the "all" attribute of a list response, so a single request
+    with a page size of 1 is enough. Otherwise the result pages are collected by page
+    number, which keeps the order of a full text query as well.
+
+    Returns:
+    - list[int]: The document ids in the order Paperless returns them, without duplicates.
+    """
+    async def _resolve(self, job: dict) -> list:
+        params = {**job["filters"], "fields": "id"}
+        if job["query"]:
+            params["query"] = job["query"]
+        else:
+            params["ordering"] = "id"
+        page = await self._request(dict(params, page_size=1))
+        ids = page.get("all")
+        if ids is None:
+            ids = []
+            number = 1
+            while True:
+                page = await self._request(dict(params, page_size=self._page_size, page=number))
+                ids.extend(result["id"] for result in page.get("results", []))
+                if not page.get("next") or not page.get("results"):
+                    break
+                number += 1
+        return list(dict.fromkeys(ids))
+
+    async def _request(self, params: dict) -> dict:
+        request = lambda: self._api.request_json("get", "/api/documents/", params=dict(params))
+        while True:
+            try:
+                return await (self._resilience.call(request) if self._resilience else request())
+            except CircuitOpenError as e:
+                logging.warning(f"Backfill paused: {e}")
+                await asyncio.sleep(e.retry_in)  # Paperless is down, continue once it is back
+
+    async def _backpressure(self, job: dict) -> None:
+        await self._resume.wait()
+        while self._queue.laneStats()[self.LANE]["pending"] >= self._max_pending:
+            await asyncio.sleep(1)  # Let the workers catch up
+            await self._resume.wait()
+        await asyncio.sleep(1 / job["rate"] if job["rate"] > 0 else 0)
+
+    def _load(self) -> dict:
+        if not os.path.exists(self._path):
+            return None
+        try:
+            with open(self._path) as file:
+                return json.load(file)
+        except Exception as e:
+            logging.error(f"Could not read the backfill checkpoint: {e}")
+            return None
+
+    def _loadIds(self) -> list:
+        try:
+            with open(self._idsPath) as file:
+                return json.load(file)
+        except Exception as e:
+            logging.warning(f"Could not read the backfill ids, resolving them again: {e}")
+            return None
+
+    async def _save(self) -> None:
+        await asyncio.to_thread(self._writeJSON, self._path, dict(self.job))
+
+    def _writeJSON(self, path: str, data) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(data, file)
+        os.replace(temporary, path)  # Atomic, a crash never leaves a broken file behind
+
+"""
+Checks the rate of a backfill.
+
+Parameters:
+- rate: The requested documents per second.
+- allow_zero (bool): Accepts 0, which disables the limit.
+
+Returns:
+- float: The rate.
+
+Raises:
+- ValueError: If the rate is not a number or not positive.
+"""
+def _parseRate(rate, allow_zero: bool = False) -> float:
+    try:
+        value = float(rate)
+    except (TypeError, ValueError):
+        raise ValueError(f"The rate has to be a number, got {rate!r}") from None
+    if not (value > 0 or (allow_zero and value == 0)) or value == float("inf"):
+        raise ValueError(f"The rate has to be a positive number, got {rate!r}")
+    return value
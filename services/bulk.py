@@ -0,0 +1,190 @@
+import asyncio, logging
+from services.metrics import STAGE_SECONDS
+
+"""
+Batch mutations of documents through the Paperless bulk edit endpoint.
+
+Operations for many documents are grouped by their kind and parameters, so all
+documents which get the same tags or the same document type are changed with one
+request per chunk instead of one fetch and update per document.
+
+Parameters:
+- paperless: API instance used for the requests.
+- chunk_size (int): Maximum number of documents per bulk edit request.
+- resilience (Resilience, optional): Deadline, retries and circuit breaker of the requests.
+"""
+class BulkEditor:
+    def __init__(self, paperless, chunk_size: int = 100, resilience=None):
+        self._api = paperless
+        self._chunk_size = chunk_size
+        self._resilience = resilience
+
+    """
+    Runs a list of operations.
+
+    Parameters:
+    - operations (list[dict]): Each operation has "documents" (list of ids) and any of
+      "add_tags", "remove_tags" (lists of tag ids), "correspondent", "document_type" and
+      "storage_path" (ids, None removes the value).
+
+    Returns:
+    - dict: Per document id a dict with "ok" and, on failure, the "errors".
+    """
+    async def run(self, operations: list) -> dict:
+        results = {}
+        for (method, parameters), documents in self.group(operations).items():
+            for doc_id, error in (await self.edit(sorted(documents), method, dict(parameters))).items():
+                result = results.setdefault(doc_id, {"ok": True})
+                if error:
+                    result["ok"] = False
+                    result.setdefault("errors", []).append(f"{method}: {error}")
+        return results
+
+    """
+    Groups operations by bulk edit method and parameters.
+
+    Parameters:
+    - operations (list[dict]): See `run()`.
+
+    Returns:
+    - dict: Per (method, parameters) the set of document ids.
+    """
+    @staticmethod
+    def group(operations: list) -> dict:
+        groups = {}
+        for operation in operations:
+            documents = [int(doc_id) for doc_id in operation.get("documents", [])]
+            kinds = []
+            add, remove = tuple(sorted(operation.get("add_tags") or [])), tuple(sorted(operation.get("remove_tags") or []))
+            if add or remove:
+                kinds.append(("modify_tags", (("add_tags", add), ("remove_tags", remove))))
+            for field in ("correspondent", "document_type", "storage_path"):
+                if field in operation:
+                    kinds.append((f"set_{field}", ((field, operation[field]),)))
+            for kind in kinds:
+                groups.setdefault(kind, set()).update(documents)
+        return groups
+
+    """
+    Runs one bulk edit method for many documents in chunks.
+
+    Parameters:
+    - documents (list[int]): The document ids.
+    - method (str): The bulk edit method, e.g. "modify_tags".
+    - parameters (dict): The parameters of the method.
+
+    Returns:
+    - dict: Per document id None on success, otherwise the error message.
+    """
+    async def edit(self, documents: list, method: str, parameters: dict) -> dict:
+        parameters = {key: list(value) if isinstance(value, tuple) else value for key, value in parameters.items()}
+        results = {}
+        for start in range(0, len(documents), self._chunk_size):
+            chunk = documents[start:start + self._chunk_size]
+            request = lambda chunk=chunk: self._api.request_json(
+                "post", "/api/documents/bulk_edit/",
+                json={"documents": chunk, "method": method, "parameters": parameters}
+            )
+            try:
+                await (self._resilience.call(request) if self._resilience else request())
+                results.update({doc_id: None for doc_id in chunk})
+            except Exception as e:
+                logging.error(f"Bulk edit {method} of {len(chunk)} documents failed: {e}")
+                results.update({doc_id: str(e) for doc_id in chunk})
+        return results
+
+"""
+Collects tag changes of processed documents and writes them in batches.
+
+The tag changes of the queue workers are buffered and flushed through the bulk edit
+endpoint once `size` documents are collected or `interval` seconds have passed. Every
+buffered change comes with a future which resolves once it is written, the queue entry
+of the document is only acknowledged then. A failed or lost flush therefore leaves the
+entry in the queue and the document is processed again.
+
+Parameters:
+- editor (BulkEditor): Runs the bulk edits.
+- size (int): Number of documents which trigger a flush.
+- interval (float): Maximum seconds a tag change is buffered.
+"""
+class TagBatcher:
+    def __init__(self, editor: BulkEditor, size: int = 50, interval: float = 5.0):
+        self._editor = editor
+        self._size = size
+        self._interval = interval
+        self._pending = []
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushed = 0
+        self.failed = 0
+
+    """
+    Buffers the tag changes of one document.
+
+    Parameters:
+    - doc_id (int): The document id.
+    - add (list[int]): Tag ids to add.
+    - remove (list[int]): Tag ids to remove.
+
+    Returns:
+    - asyncio.Future: Resolves to True once the tags are written and raises if writing them failed,
+      None if there is nothing to change.
+    """
+    async def add(self, doc_id: int, add: list = None, remove: list = None) -> asyncio.Future:
+        if not add and not remove:
+            return None
+        written = asyncio.get_running_loop().create_future()
+        self._pending.append(({"documents": [doc_id], "add_tags": add or [], "remove_tags": remove or []}, written))
+        if len(self._pending) >= self._size:
+            await self.flush()
+        elif self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flushLater())
+        return written
+
+    """
+    Writes all buffered tag changes and resolves their futures.
+
+    Returns:
+    - dict: The per document results of the bulk edit.
+    """
+    async def flush(self) -> dict:
+        async with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return {}
+            operations = [operation for operation, _ in pending]
+            try:
+                with STAGE_SECONDS.time("tagging"):
+                    results = await self._editor.run(operations)
+            except asyncio.CancelledError:
+                self._resolve(pending, {})  # The entries stay in the queue
+                raise
+            except Exception as e:
+                logging.error(f"Tagging of {len(operations)} documents failed: {e}")
+                results = {operation["documents"][0]: {"ok": False, "errors": [str(e)]} for operation in operations}
+        failed = [doc_id for doc_id, result in results.items() if not result["ok"]]
+        self.flushed += len(results) - len(failed)
+        self.failed += len(failed)
+        if failed:
+            logging.error(f"Tagging of the documents {failed} failed, they are processed again")
+        self._resolve(pending, results)
+        return results
+
+    def status(self) -> dict:
+        return {"pending": len(self._pending), "flushed": self.flushed, "failed": self.failed}
+
+    async def _flushLater(self) -> None:
+        await asyncio.sleep(self._interval)
+        await self.flush()
+
+    @staticmethod
+    def _resolve(pending: list, results: dict) -> None:
+        for operation, written in pending:
+            if written.done():
+                continue
+            doc_id = operation["documents"][0]
+            result = results.get(doc_id, {"ok": False, "errors": ["no result"]})
+            if result["ok"]:
+                written.set_result(True)
+            else:
+                written.set_exception(RuntimeError(f"Tagging of document {doc_id} failed: {'; '.join(result['errors'])}"))
@@ -1,20 +1,48 @@
-import time, logging
+import os, json, time, asyncio, logging
+from services.metrics import CACHE_LOOKUPS
 
 """
 Cache class for storing and retrieving document-related metadata to reduce API calls.
 
+Every cache container keeps dict indexes by id and by normalized name next to the item
+list, so lookups take constant time regardless of the number of tags or correspondents.
+
+Refreshes run as one background task per container. Lookups never wait for them once
+the container was loaded: an expired container is served from its previous items until
+the new items are swapped in. Containers are refreshed ahead of their expiry, when they
+are used and by the refresher started with `startRefresher()`.
+
+Refreshes are incremental where possible: the ids of all objects are requested with a
+single small request, deleted objects are dropped and only new objects are fetched.
+Renames are not visible in the ids, they are picked up by a full refresh every
+`full_refresh` minutes. After every refresh the containers are written to a snapshot
+file, which is loaded on the next start, so lookups are answered right away after a
+restart.
+
 Parameters:
 - paperless: API instance to fetch document-related data.
 - cache_time (int): Time in minutes before cache expiration.
+- resilience (Resilience, optional): Deadline, retries and circuit breaker of the Paperless requests.
+- snapshot_path (str, optional): Location of the snapshot file, None disables it.
+- full_refresh (int): Minutes between full refreshes of a container.
 """
 class Cache:
-    def __init__(self, paperless, cache_time: int):
+    REFRESH_AHEAD = 0.8  # Fraction of the cache time after which a container is refreshed in the background
+    DELTA_CHUNK_SIZE = 100  # New objects fetched per request
+
+    def __init__(self, paperless, cache_time: int, resilience=None, snapshot_path: str = None, full_refresh: int = 60):
         self._cache_time = cache_time
         self._api = paperless
-        self._documentTypeCache = {"lastRefresh": None, "cache": []}
-        self._storagePathCache = {"lastRefresh": None, "cache": []}
-        self._correspondentCache = {"lastRefresh": None, "cache": []}
-        self._tagsCache = {"lastRefresh": None, "cache": []}
+        self._resilience = resilience
+        self._snapshot_path = snapshot_path
+        self._full_refresh = full_refresh
+        self._snapshotLock = asyncio.Lock()
+        self._documentTypeCache = {"name": "document_types", "lastRefresh": None, "cache": [], "byID": {}, "byName": {}, "task": None, "lastFull": None}
+        self._storagePathCache = {"name": "storage_paths", "lastRefresh": None, "cache": [], "byID": {}, "byName": {}, "task": None, "lastFull": None}
+        self._correspondentCache = {"name": "correspondents", "lastRefresh": None, "cache": [], "byID": {}, "byName": {}, "task": None, "lastFull": None}
+        self._tagsCache = {"name": "tags", "lastRefresh": None, "cache": [], "byID": {}, "byName": {}, "task": None, "lastFull": None}
+        self._refresherTask = None
+        self._loadSnapshot()
 
     """
     Retrieves the document type name by its ID.
@@ -74,7 +102,7 @@ class Cache:
     - list[str]: List of corresponding tag names.
     """
     async def getTagListNamesByID(self, keys: list[int]) -> list[str]:
-        return [await self.getTagNameByID(key) for key in keys]
+        return await self.getItemsByID(self._tagsCache, self._api.tags, keys)
 
     """
     Retrieves the tag ID by its name.
@@ -87,6 +115,18 @@ class Cache:
     """
     async def getTagIDByName(self, name: str) -> int:
         return await self.getItemByName(self._tagsCache, self._api.tags, name)
+
+    """
+    Retrieves the tag IDs of many tag names.
+
+    Parameters:
+    - names (list[str]): Names of the tags.
+
+    Returns:
+    - list[int]: The tag IDs in the order of the names, None for unknown names.
+    """
+    async def getTagIDsByName(self, names: list[str]) -> list[int]:
+        return await self.getItemsByName(self._tagsCache, self._api.tags, names)
     
     async def getCorrespondantIDByName(self, name: str) -> int:
         return await self.getItemByName(self._correspondentCache, self._api.correspondents, name)
@@ -108,8 +148,7 @@ class Cache:
         return await self.getAllItems(self._storagePathCache, self._api.storage_paths)
     
     async def getAllItems(self, cacheContainer: dict, cachingElement):
-        if cacheContainer["lastRefresh"] is None or cacheContainer["lastRefresh"] < time.time() - (self._cache_time * 60):
-            await self.refreshCacheOfContainer(cacheContainer, cachingElement)
+        await self.ensureFresh(cacheContainer, cachingElement)
         return cacheContainer["cache"]
 
     """
@@ -118,19 +157,14 @@ class Cache:
     Parameters:
     - cacheContainer (dict): Cache container for the specific data type.
     - cachingElement (async iterator): API source for the data.
-    - name (str): The name of the item to search for.
+    - name (str): The name of the item to search for, case and whitespace are ignored.
 
     Returns:
     - int: ID of the item if found, otherwise None.
     """
     async def getItemByName(self, cacheContainer: dict, cachingElement, name: str) -> int:
-        if cacheContainer["lastRefresh"] is None or cacheContainer["lastRefresh"] < time.time() - (self._cache_time * 60):
-            await self.refreshCacheOfContainer(cacheContainer, cachingElement)
-
-        for item in cacheContainer["cache"]:
-            if item["name"] == name:
-                return item["id"]
-        return None
+        await self.ensureFresh(cacheContainer, cachingElement)
+        return cacheContainer["byName"].get(normalizeName(name))
 
     """
     Retrieves an item name by its ID from the cache or API.
@@ -144,13 +178,108 @@ class Cache:
     - str: Name of the item if found, otherwise None.
     """
     async def getItemByID(self, cacheContainer: dict, cachingElement, key: int) -> str:
-        if cacheContainer["lastRefresh"] is None or cacheContainer["lastRefresh"] < time.time() - (self._cache_time * 60):
-            await self.refreshCacheOfContainer(cacheContainer, cachingElement)
+        await self.ensureFresh(cacheContainer, cachingElement)
+        return cacheContainer["byID"].get(key)
+
+    """
+    Retrieves the IDs of many items with one freshness check.
+
+    Parameters:
+    - cacheContainer (dict): Cache container for the specific data type.
+    - cachingElement (async iterator): API source for the data.
+    - names (list[str]): The names of the items.
+
+    Returns:
+    - list[int]: The IDs in the order of the names, None for unknown names.
+    """
+    async def getItemsByName(self, cacheContainer: dict, cachingElement, names: list) -> list:
+        await self.ensureFresh(cacheContainer, cachingElement)
+        index = cacheContainer["byName"]
+        return [index.get(normalizeName(name)) for name in names]
+
+    """
+    Retrieves the names of many items with one freshness check.
+
+    Parameters:
+    - cacheContainer (dict): Cache container for the specific data type.
+    - cachingElement (async iterator): API source for the data.
+    - keys (list[int]): The IDs of the items.
+
+    Returns:
+    - list[str]: The names in the order of the IDs, None for unknown IDs.
+    """
+    async def getItemsByID(self, cacheContainer: dict, cachingElement, keys: list) -> list:
+        await self.ensureFresh(cacheContainer, cachingElement)
+        index = cacheContainer["byID"]
+        return [index.get(key) for key in keys]
+
+    """
+    Makes sure a cache container can be used.
+
+    Only the first load of a container is awaited, concurrent callers share it. A container
+    which is expired or about to expire is refreshed in the background while the previous
+    items are used.
+
+    Parameters:
+    - cacheContainer (dict): Cache container for the specific data type.
+    - cachingElement (async iterator): API source for the data.
+    """
+    async def ensureFresh(self, cacheContainer: dict, cachingElement) -> None:
+        if cacheContainer["lastRefresh"] is None:
+            CACHE_LOOKUPS.inc(cacheContainer["name"], "miss")
+            await asyncio.shield(self.refreshInBackground(cacheContainer, cachingElement))
+            return
+        age = time.time() - cacheContainer["lastRefresh"]
+        if age >= self._cache_time * 60:
+            CACHE_LOOKUPS.inc(cacheContainer["name"], "stale")
+            self.refreshInBackground(cacheContainer, cachingElement)
+        else:
+            CACHE_LOOKUPS.inc(cacheContainer["name"], "hit")
+            if age >= self._cache_time * 60 * self.REFRESH_AHEAD:
+                self.refreshInBackground(cacheContainer, cachingElement)
 
-        for item in cacheContainer["cache"]:
-            if item["id"] == key:
-                return item["name"]
-        return None
+    """
+    Starts a refresh of a cache container unless one is already running.
+
+    Parameters:
+    - cacheContainer (dict): Cache container for the specific data type.
+    - cachingElement (async iterator): API source for the data.
+
+    Returns:
+    - asyncio.Task: The running refresh.
+    """
+    def refreshInBackground(self, cacheContainer: dict, cachingElement) -> asyncio.Task:
+        task = cacheContainer["task"]
+        if task is None or task.done():
+            task = cacheContainer["task"] = asyncio.create_task(self.refreshCacheOfContainer(cacheContainer, cachingElement))
+            task.add_done_callback(_retrieveError)
+        return task
+
+    """
+    Refreshes all containers concurrently right away and then in the background before
+    they expire.
+
+    Parameters:
+    - interval (float, optional): Seconds between the checks, defaults to a tenth of the cache time.
+    """
+    def startRefresher(self, interval: float = None) -> None:
+        if self._refresherTask is not None and not self._refresherTask.done():
+            return
+        for container in self._containers():
+            self.refreshInBackground(container, getattr(self._api, container["name"]))
+        self._refresherTask = asyncio.create_task(self._refresh(interval or max(self._cache_time * 6, 1)))
+
+    def stopRefresher(self) -> None:
+        if self._refresherTask is not None:
+            self._refresherTask.cancel()
+            self._refresherTask = None
+
+    async def _refresh(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for container in self._containers():
+                if container["lastRefresh"] is not None and time.time() - container["lastRefresh"] >= self._cache_time * 60 * self.REFRESH_AHEAD:
+                    self.refreshInBackground(container, getattr(self._api, container["name"]))
 
     """
     Refreshes the cache for a given container by fetching the latest data.
@@ -160,15 +289,140 @@ class Cache:
     - cachingElement (async iterator): API source for the data.
 
     Updates:
-    - Resets cache and fetches the latest items asynchronously.
+    - Fetches the changes since the last refresh, or all items if the container is empty
+      or its last full refresh is older than `full_refresh`. The items are swapped in at
+      once, lookups see either the old or the new items. If Paperless is not reachable,
+      the previous items are kept and used until the next refresh succeeds.
     """
     async def refreshCacheOfContainer(self, cacheContainer: dict, cachingElement) -> None:
-        cacheContainer["lastRefresh"] = None  # Reset cache timestamp
-        cacheContainer["cache"] = []  # Clear existing cache
+        async def fetch():
+            items = []
+            async for item in cachingElement:
+                logging.debug(item.name)  # Log item name for debugging
+                items.append({"id": item.id, "name": item.name})
+            return items
+
+        full = self._needsFullRefresh(cacheContainer)
+        try:
+            items = None
+            if not full:
+                items = await self._call(lambda: self._delta(cacheContainer))
+            if items is None:
+                full = True
+                items = await self._call(fetch)
+        except Exception as e:
+            if cacheContainer["lastRefresh"] is None:
+                raise  # Nothing cached yet
+            logging.warning(f"Refreshing the cache failed, using the cached items: {e}")
+            return
+
+        self._swap(cacheContainer, items, time.time(), time.time() if full else cacheContainer["lastFull"])
+        logging.debug(f"Cache {cacheContainer['name']} refreshed with {len(items)} items ({'full' if full else 'delta'})")
+        await self._saveSnapshot()
+
+    def _needsFullRefresh(self, cacheContainer: dict) -> bool:
+        if cacheContainer["lastRefresh"] is None or cacheContainer["lastFull"] is None:
+            return True
+        if not hasattr(self._api, "request_json"):
+            return True
+        return time.time() - cacheContainer["lastFull"] >= self._full_refresh * 60
 
-        async for item in cachingElement:
-            logging.debug(item.name)  # Log item name for debugging
-            cacheContainer["cache"].append({"id": item.id, "name": item.name})  # Store new cache entry
+    """
+    Fetches the changes of a container since the last refresh.
+
+    Paperless lists the ids of all objects in the "all" attribute of every list response,
+    so one request with a page size of 1 shows which objects were added or deleted.
+
+    Parameters:
+    - cacheContainer (dict): The cache container to refresh.
+
+    Returns:
+    - list[dict]: The updated items, None if Paperless does not report the ids.
+    """
+    async def _delta(self, cacheContainer: dict) -> list:
+        endpoint = f"/api/{cacheContainer['name']}/"
+        page = await self._api.request_json("get", endpoint, params={"page_size": 1})
+        ids = page.get("all") if isinstance(page, dict) else None
+        if ids is None:
+            return None
+        current = set(ids)
+        items = [item for item in cacheContainer["cache"] if item["id"] in current]  # Drop deleted objects
+        added = [key for key in ids if key not in cacheContainer["byID"]]
+        for start in range(0, len(added), self.DELTA_CHUNK_SIZE):
+            chunk = added[start:start + self.DELTA_CHUNK_SIZE]
+            data = await self._api.request_json(
+                "get", endpoint, params={"id__in": ",".join(str(key) for key in chunk), "fields": "id,name", "page_size": len(chunk)}
+            )
+            items.extend({"id": result["id"], "name": result["name"]} for result in data.get("results", []))
+        if added:
+            items.sort(key=lambda item: normalizeName(item["name"]))
+        return items
+
+    async def _call(self, operation):
+        return await self._resilience.call(operation) if self._resilience else await operation()
+
+    def _swap(self, cacheContainer: dict, items: list, lastRefresh: float, lastFull: float) -> None:
+        byName = {}
+        for item in items:
+            byName.setdefault(normalizeName(item["name"]), item["id"])  # Paperless names are unique regardless of case
+        byID = {item["id"]: item["name"] for item in items}
+        # Swapped without an await in between, so no lookup sees a partially updated container
+        cacheContainer.update(cache=items, byID=byID, byName=byName, lastRefresh=lastRefresh, lastFull=lastFull)
+
+    def _containers(self) -> tuple:
+        return (self._documentTypeCache, self._storagePathCache, self._correspondentCache, self._tagsCache)
+
+    """
+    Loads the containers from the snapshot file of the last run.
+    """
+    def _loadSnapshot(self) -> None:
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return
+        try:
+            with open(self._snapshot_path) as file:
+                snapshot = json.load(file)
+            for container in self._containers():
+                data = snapshot.get(container["name"])
+                if data and data.get("lastRefresh"):
+                    self._swap(container, data["cache"], data["lastRefresh"], data.get("lastFull"))
+            logging.info(f"Loaded the metadata cache snapshot from {self._snapshot_path}")
+        except Exception as e:
+            logging.error(f"Could not read the metadata cache snapshot: {e}")
+
+    async def _saveSnapshot(self) -> None:
+        if not self._snapshot_path:
+            return
+        snapshot = {
+            container["name"]: {"lastRefresh": container["lastRefresh"], "lastFull": container["lastFull"], "cache": container["cache"]}
+            for container in self._containers() if container["lastRefresh"] is not None
+        }
+        async with self._snapshotLock:
+            try:
+                await asyncio.to_thread(self._writeSnapshot, snapshot)
+            except Exception as e:
+                logging.error(f"Could not write the metadata cache snapshot: {e}")
+
+    def _writeSnapshot(self, snapshot: dict) -> None:
+        directory = os.path.dirname(self._snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{self._snapshot_path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(temporary, self._snapshot_path)  # Atomic, a crash never leaves a broken snapshot behind
+
+"""
+Normalizes a name for the lookup, case and surrounding or repeated whitespace are ignored.
+
+Parameters:
+- name (str): The name.
+
+Returns:
+- str: The normalized name.
+"""
+def normalizeName(name: str) -> str:
+    return " ".join(str(name).split()).casefold() if name is not None else None
 
-        cacheContainer["lastRefresh"] = time.time()  # Update last refresh timestamp
-        logging.debug(cacheContainer)  # Log updated cache contents
\ No newline at end of file
+def _retrieveError(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Refreshing the cache failed: {task.exception()}")
@@ -0,0 +1,131 @@
+import logging
+from datetime import datetime
+
+"""
+Raised when a document was modified by someone else and the changes cannot be applied.
+"""
+class ConflictError(Exception):
+    pass
+
+"""
+Collects the changes to a document and writes them with a single PATCH request.
+
+Field changes and tag operations are accumulated first. `commit()` sends only the
+fields which actually differ from the fetched document, the tags are sent as the
+resulting tag list. On request the `modified` timestamp of the document is compared
+with the current one in Paperless before writing. If the document was changed in the
+meantime, it is fetched again and the changes are applied on top of the new version,
+so concurrent tag changes are not overwritten. The check costs an extra request and is
+not an atomic compare-and-swap, Paperless has no conditional PATCH, so a change made
+between the check and the PATCH is still overwritten.
+
+Parameters:
+- document: The pypaperless document which is changed.
+"""
+class DocumentChangeSet:
+    def __init__(self, document):
+        self.document = document
+        self._fields = {}
+        self._add = []
+        self._remove = []
+
+    """
+    Sets a field of the document.
+
+    Parameters:
+    - field (str): The name of the field, e.g. "title".
+    - value: The new value.
+    """
+    def set(self, field: str, value) -> "DocumentChangeSet":
+        self._fields[field] = value
+        return self
+
+    """
+    Adds tags to the document.
+
+    Parameters:
+    - tag_ids (list[int]): Ids of the tags.
+    """
+    def addTags(self, tag_ids: list) -> "DocumentChangeSet":
+        for tag_id in tag_ids:
+            if tag_id in self._remove:
+                self._remove.remove(tag_id)
+            if tag_id not in self._add:
+                self._add.append(tag_id)
+        return self
+
+    """
+    Removes tags from the document.
+
+    Parameters:
+    - tag_ids (list[int]): Ids of the tags.
+    """
+    def removeTags(self, tag_ids: list) -> "DocumentChangeSet":
+        for tag_id in tag_ids:
+            if tag_id in self._add:
+                self._add.remove(tag_id)
+            if tag_id not in self._remove:
+                self._remove.append(tag_id)
+        return self
+
+    """
+    Returns the PATCH payload for the given version of the document.
+
+    Parameters:
+    - document (optional): The version to compare against, defaults to the fetched document.
+
+    Returns:
+    - dict: The changed fields, empty if nothing changes.
+    """
+    def payload(self, document=None) -> dict:
+        document = document or self.document
+        payload = {field: value for field, value in self._fields.items() if getattr(document, field, None) != value}
+        tags = list(document.tags or [])
+        tags = [tag for tag in tags if tag not in self._remove] + [tag for tag in self._add if tag not in tags]
+        if tags != list(document.tags or []):
+            payload["tags"] = tags
+        return payload
+
+    """
+    Writes all changes with one request.
+
+    Parameters:
+    - api: The Paperless API instance.
+    - check_conflicts (bool): Compares the `modified` timestamp before writing, one extra request.
+
+    Returns:
+    - bool: True if something was written, False if there was nothing to change.
+
+    Raises:
+    - ConflictError: If the document was deleted in the meantime.
+    """
+    async def commit(self, api, check_conflicts: bool = False) -> bool:
+        document = self.document
+        if check_conflicts and await self._modified(api, document):
+            logging.info(f"Document {document.id} was modified in the meantime, applying the changes to the current version")
+            document = await api.documents(document.id)
+        payload = self.payload(document)
+        if not payload:
+            return False
+        data = await api.request_json("patch", f"/api/documents/{document.id}/", json=payload)
+        for field, value in payload.items():
+            setattr(self.document, field, value)  # Keep the local object in sync
+        if isinstance(data, dict) and data.get("modified"):
+            self.document.modified = _parseTime(data["modified"])
+        return True
+
+    async def _modified(self, api, document) -> bool:
+        current = await api.request_json("get", "/api/documents/", params={"id": document.id, "fields": "id,modified"})
+        results = current.get("results") or []
+        if not results:
+            raise ConflictError(f"Document {document.id} does not exist anymore")
+        known = document.modified
+        if known is None:
+            return False
+        return _parseTime(results[0]["modified"]) != (known if isinstance(known, datetime) else _parseTime(known))
+
+"""
+Parses a timestamp of the Paperless API.
+"""
+def _parseTime(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
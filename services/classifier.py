@@ -0,0 +1,349 @@
+import os, json, time, asyncio, logging
+import numpy as np
+
+"""
+Nearest-neighbour classifier for correspondent, document type and storage path.
+
+Documents which are already classified in Paperless are embedded with a local Ollama
+embedding model. The normalized vectors are kept in a NumPy matrix together with the
+metadata ids of each document, so a suggestion is a single matrix product followed by
+a similarity weighted vote of the k nearest neighbours. If even the nearest neighbour
+is not similar enough, the AI is asked to choose from the known names instead.
+
+The index is persisted to disk and updated incrementally with the documents modified
+since the last synchronisation.
+
+Parameters:
+- ai (AI): The AI instance used for embeddings and the fallback.
+- paperless: API instance to fetch the documents.
+- cache (Cache): Metadata cache to translate between ids and names.
+- path (str): Path of the index file (.npz).
+- model (str): The Ollama embedding model.
+- k (int): Number of neighbours which vote for a suggestion.
+- threshold (float): Minimum cosine similarity of the nearest neighbour. Below it the AI is asked.
+- max_chars (int): Number of characters of the content which are embedded.
+"""
+class Classifier:
+    FIELDS = ("correspondent", "document_type", "storage_path")
+    BATCH_SIZE = 32  # Documents embedded with one request
+    FALLBACK_CANDIDATES = 50  # Maximum number of names offered to the AI in the fallback
+
+    def __init__(self, ai, paperless, cache, path: str, model: str, k: int = 5, threshold: float = 0.8, max_chars: int = 2000):
+        self.ai = ai
+        self._api = paperless
+        self._cache = cache
+        self._path = path
+        self._model = model
+        self._k = k
+        self._threshold = threshold
+        self._max_chars = max_chars
+        self._lock = asyncio.Lock()
+        self._syncTask = None
+        self.lastSync = None  # Time of the last synchronisation (epoch seconds)
+        self._reset()
+
+    def _reset(self) -> None:
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._vectors = None
+        self._labels = {field: np.zeros(0, dtype=np.int64) for field in self.FIELDS}
+        self._positions = {}  # Document id -> row in the index
+        self.lastSync = None
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    """
+    Loads the index from disk. An index built with another embedding model is discarded.
+
+    Returns:
+    - bool: True if an index was loaded.
+    """
+    async def load(self) -> bool:
+        if not os.path.exists(self._path):
+            return False
+        try:
+            data = await asyncio.to_thread(_read, self._path)
+            meta = json.loads(str(data["meta"]))
+            if meta.get("model") != self._model:
+                logging.info(f"Classifier index was built with {meta.get('model')}, rebuilding it with {self._model}")
+                return False
+            self._ids = data["ids"]
+            self._vectors = data["vectors"] if len(self._ids) else None
+            self._labels = {field: data[field] for field in self.FIELDS}
+            self._positions = {int(doc_id): row for row, doc_id in enumerate(self._ids)}
+            self.lastSync = meta.get("last_sync")
+            logging.info(f"Loaded classifier index with {len(self)} documents")
+            return True
+        except Exception as e:
+            logging.error(f"Could not load the classifier index: {e}")
+            self._reset()
+            return False
+
+    """
+    Writes the index to disk.
+    """
+    async def save(self) -> None:
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        vectors = self._vectors if self._vectors is not None else np.zeros((0, 0), dtype=np.float32)
+        meta = json.dumps({"model": self._model, "last_sync": self.lastSync})
+        temporary = f"{self._path}.tmp.npz"
+        await asyncio.to_thread(np.savez, temporary, ids=self._ids, vectors=vectors, meta=meta, **self._labels)
+        os.replace(temporary, self._path)  # Atomic, a crash never leaves a broken index behind
+
+    """
+    Adds all documents modified since the last synchronisation to the index and drops the
+    documents which were deleted in Paperless.
+
+    Parameters:
+    - full (bool): Rebuilds the index from scratch.
+
+    Returns:
+    - int: Number of documents which were added or updated.
+    """
+    async def sync(self, full: bool = False) -> int:
+        async with self._lock:
+            if full:
+                self._reset()
+            started = time.time()
+            filters = {"page_size": 100}
+            if self.lastSync:
+                filters["modified__gt"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.lastSync))
+
+            updated = 0
+            batch = []
+            async with self._api.documents.reduce(**filters):
+                async for document in self._api.documents:
+                    if all(getattr(document, field) is None for field in self.FIELDS) and document.id not in self._positions:
+                        continue  # Unclassified documents cannot teach anything
+                    batch.append(document)
+                    if len(batch) >= self.BATCH_SIZE:
+                        updated += await self._add(batch)
+                        batch = []
+            if batch:
+                updated += await self._add(batch)
+            removed = 0 if full else await self._prune()
+
+            self.lastSync = started
+            await self.save()
+            logging.info(f"Classifier index synchronised: {updated} documents updated, {removed} removed, {len(self)} in total")
+            return updated
+
+    async def _add(self, documents: list) -> int:
+        vectors = await self._embed(documents)
+        new = []
+        for document, vector in zip(documents, vectors):
+            row = self._positions.get(document.id)
+            if row is None:
+                new.append((document, vector))
+                continue
+            self._vectors[row] = vector
+            for field in self.FIELDS:
+                self._labels[field][row] = _label(getattr(document, field))
+
+        if new:
+            start = len(self._ids)
+            block = np.stack([vector for _, vector in new])
+            self._vectors = block if self._vectors is None else np.vstack([self._vectors, block])
+            self._ids = np.concatenate([self._ids, np.array([document.id for document, _ in new], dtype=np.int64)])
+            for field in self.FIELDS:
+                labels = np.array([_label(getattr(document, field)) for document, _ in new], dtype=np.int64)
+                self._labels[field] = np.concatenate([self._labels[field], labels])
+            for offset, (document, _) in enumerate(new):
+                self._positions[document.id] = start + offset
+        return len(documents)
+
+    """
+    Removes the documents which no longer exist in Paperless from the index.
+
+    Paperless lists the ids of all documents in the "all" attribute of a list response,
+    so a single request with a page size of 1 shows which documents were deleted.
+
+    Returns:
+    - int: Number of documents which were removed.
+    """
+    async def _prune(self) -> int:
+        if not len(self._ids) or not hasattr(self._api, "request_json"):
+            return 0
+        page = await self._api.request_json("get", "/api/documents/", params={"page_size": 1, "fields": "id"})
+        ids = page.get("all") if isinstance(page, dict) else None
+        if ids is None:
+            return 0  # Deleted documents are dropped by the next full rebuild instead
+        keep = np.isin(self._ids, np.array(ids, dtype=np.int64))
+        removed = int(len(keep) - keep.sum())
+        if removed:
+            self._ids = self._ids[keep]
+            self._vectors = self._vectors[keep] if len(self._ids) else None
+            self._labels = {field: labels[keep] for field, labels in self._labels.items()}
+            self._positions = {int(doc_id): row for row, doc_id in enumerate(self._ids)}
+        return removed
+
+    """
+    Suggests correspondent, document type and storage path for documents.
+
+    Parameters:
+    - documents (list): The Paperless documents to classify.
+    - fallback (bool): Asks the AI if the nearest neighbour is not similar enough.
+
+    Returns:
+    - dict: Per document id a dict per field with "id", "name", "score" and "source" ("knn" or "ai").
+    """
+    async def suggest(self, documents: list, fallback: bool = True) -> dict:
+        suggestions = {}
+        for start in range(0, len(documents), self.BATCH_SIZE):
+            batch = documents[start:start + self.BATCH_SIZE]
+            vectors = await self._embed(batch)
+            for document, votes in zip(batch, self.vote(np.stack(vectors))):
+                suggestions[document.id] = {}
+                for field in self.FIELDS:
+                    label, score, nearest = votes[field]
+                    source = "knn"
+                    if fallback and nearest < self._threshold:
+                        label = await self._askAI(document, field, label)
+                        source = "ai"
+                    suggestions[document.id][field] = {
+                        "id": label,
+                        "name": await self._name(field, label),
+                        "score": round(score, 3),
+                        "similarity": round(nearest, 3),
+                        "source": source if label is not None else None
+                    }
+        return suggestions
+
+    """
+    Votes for the metadata of the given embedding vectors with their k nearest neighbours.
+
+    Parameters:
+    - vectors (np.ndarray): Normalized query vectors, one per row.
+
+    Returns:
+    - list[dict]: Per query and field a tuple of (label or None, vote share, similarity of the nearest labelled neighbour).
+    """
+    def vote(self, vectors: np.ndarray) -> list:
+        results = []
+        if self._vectors is None or not len(self._ids):
+            return [{field: (None, 0.0, 0.0) for field in self.FIELDS} for _ in range(len(vectors))]
+
+        similarities = vectors @ self._vectors.T  # Cosine similarity, all vectors are normalized
+        for row in similarities:
+            result = {}
+            for field in self.FIELDS:
+                labelled = np.flatnonzero(self._labels[field] >= 0)
+                if not len(labelled):
+                    result[field] = (None, 0.0, 0.0)
+                    continue
+                candidates = row[labelled]
+                k = min(self._k, len(candidates))
+                nearest = labelled[np.argpartition(-candidates, k - 1)[:k]]
+                weights = {}
+                for position in nearest:
+                    label = int(self._labels[field][position])
+                    weights[label] = weights.get(label, 0.0) + max(float(row[position]), 0.0)
+                label = max(weights, key=weights.get)
+                total = sum(weights.values())
+                result[field] = (label, weights[label] / total if total else 0.0, float(row[nearest].max()))
+            results.append(result)
+        return results
+
+    """
+    Starts a background task which synchronises the index periodically.
+
+    Parameters:
+    - interval (float): Minutes between two synchronisations, 0 disables them.
+    """
+    def startSync(self, interval: float) -> None:
+        if interval <= 0 or self._syncTask is not None:
+            return
+        self._syncTask = asyncio.create_task(self._periodicSync(interval))
+
+    async def _periodicSync(self, interval: float) -> None:
+        while not self._api.is_initialized:
+            await asyncio.sleep(5)  # Wait for the Paperless connection
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.error(f"Classifier synchronisation failed: {e}")
+            await asyncio.sleep(interval * 60)
+
+    def stop(self) -> None:
+        if self._syncTask is not None:
+            self._syncTask.cancel()
+            self._syncTask = None
+
+    def status(self) -> dict:
+        return {
+            "documents": len(self),
+            "model": self._model,
+            "last_sync": self.lastSync,
+            "k": self._k,
+            "threshold": self._threshold
+        }
+
+    async def _embed(self, documents: list) -> list:
+        texts = [f"{document.title or ''}\n{(document.content or '')[:self._max_chars]}" for document in documents]
+        vectors = np.asarray(await self.ai.embed(texts, self._model), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return list(vectors / norms)
+
+    async def _askAI(self, document, field: str, suggestion: int):
+        names = await self._candidates(field, suggestion)
+        if not names:
+            return None
+        label = field.replace("_", " ")
+        prompt = (
+            f"Which {label} fits this document best? Answer with exactly one of the following names "
+            f"or with an empty string if none fits: {json.dumps(names, ensure_ascii=False)}"
+        )
+        try:
+            answer = await self.ai.getResponse((document.content or "")[:self._max_chars * 2], prompt)
+        except Exception as e:
+            logging.warning(f"AI fallback for the {label} of document {document.id} failed: {e}")
+            return suggestion
+        lookup = {
+            "correspondent": self._cache.getCorrespondantIDByName,
+            "document_type": self._cache.getTypeIDByName,
+            "storage_path": self._cache.getPathIDByName
+        }[field]
+        return await lookup(answer) if answer else None
+
+    async def _candidates(self, field: str, suggestion: int) -> list:
+        labels = self._labels[field]
+        labels = labels[labels >= 0]
+        ids, counts = np.unique(labels, return_counts=True) if len(labels) else (np.zeros(0), np.zeros(0))
+        ranked = [int(label) for label in ids[np.argsort(-counts)][:self.FALLBACK_CANDIDATES]]
+        if suggestion is not None and suggestion not in ranked:
+            ranked.insert(0, suggestion)
+        if not ranked:
+            items = await {
+                "correspondent": self._cache.getAllCorrespondents,
+                "document_type": self._cache.getAllTypes,
+                "storage_path": self._cache.getAllPaths
+            }[field]()
+            return [item["name"] for item in items[:self.FALLBACK_CANDIDATES]]
+        return [name for name in [await self._name(field, label) for label in ranked] if name]
+
+    async def _name(self, field: str, label: int) -> str:
+        if label is None:
+            return None
+        lookup = {
+            "correspondent": self._cache.getCorrespondentNameByID,
+            "document_type": self._cache.getDocumentTypeNameByID,
+            "storage_path": self._cache.getStoragePathNameByID
+        }[field]
+        return await lookup(label)
+
+"""
+Reads all arrays of an index file into memory.
+"""
+def _read(path: str) -> dict:
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+"""
+Converts an optional metadata id into the label stored in the index (-1 = not set).
+"""
+def _label(value) -> int:
+    return -1 if value is None else int(value)
@@ -1,19 +1,91 @@
-import logging, os, re, asyncio
-from services.ai_api import AI
+import logging, os, re, time, asyncio
+from services.ai_api import AI, parseHosts
+from services.classifier import Classifier
+from services.content import parseStrategy
+from services.validation import FieldValidator
+from services.resilience import Resilience
 from pypaperless import Paperless # type: ignore
 
+"""
+Parses a setting with one number per priority lane, e.g. "interactive:0,webhook:60".
+
+The parsed values are merged over the defaults, so a setting which only changes one
+lane keeps the others. Malformed entries are skipped with an error message.
+
+Parameters:
+- name (str): Name of the environment variable.
+- default (str): The built-in values in the same format.
+
+Returns:
+- dict: The number per lane.
+"""
+def parseLaneValues(name: str, default: str) -> dict:
+    values = {}
+    for source in (default, os.getenv(name, '')):
+        for item in source.split(","):
+            if not item.strip():
+                continue
+            lane, _, value = item.partition(":")
+            try:
+                if not lane.strip():
+                    raise ValueError("the lane is missing")
+                values[lane.strip()] = float(value)
+            except ValueError as e:
+                logging.error(f"Ignoring the entry '{item.strip()}' of {name}, expected lane:number ({e})")
+    return values
+
 # Load environment variables for configuration
 LOG_LEVEL = os.getenv('LOG_LEVEL', None)
 PAPERLESS_BASE_URL = os.getenv('PAPERLESS_BASE_URL', None)
 AUTH_TOKEN = os.getenv('AUTH_TOKEN', None)
 AI_USAGE = 'OLLAMA'  # Currently only OLLAMA is supported, so this remains fixed
 OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', None)
-OLLAMA_HOST = os.getenv('OLLAMA_HOST', None)
+OLLAMA_CASCADE = [model.strip() for model in os.getenv('OLLAMA_CASCADE', '').split(',') if model.strip()]  # Cheaper models tried before OLLAMA_MODEL
+OLLAMA_HOST = os.getenv('OLLAMA_HOST', None)  # One host or a comma separated list of hosts
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', 30))  # Seconds between health checks of the Ollama hosts
+OLLAMA_TIMEOUT = float(os.getenv('OLLAMA_TIMEOUT', 300))  # Timeout in seconds for a single inference call
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')  # How long Ollama keeps the model loaded after a request
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'True')  # Stream answers and stop as soon as all fields are complete
+MAX_TOKENS_PER_FIELD = int(os.getenv('MAX_TOKENS_PER_FIELD', 256))  # Upper bound of generated tokens per field
+KEEP_WARM_INTERVAL = float(os.getenv('KEEP_WARM_INTERVAL', 60))  # Seconds between keep-warm pings, 0 disables them
+KEEP_WARM_WINDOW = float(os.getenv('KEEP_WARM_WINDOW', 900))  # Seconds after the last queue activity the model is kept warm
 PROCESSING_TAG = os.getenv('PROCESSING_TAG', 'ai-processed')
 ERROR_TAG = os.getenv('ERROR_TAG', 'ai-error')
 INBOX_TAG = os.getenv('INBOX_TAG', 'Inbox')
 DEBUG = os.getenv('DEBUG', 'False')
 CACHE_TIME = int(os.getenv('CACHE_TIME', 60))  # Ensure CACHE_TIME is an integer
+CACHE_SNAPSHOT_PATH = os.getenv('CACHE_SNAPSHOT_PATH', 'data/metadata_cache.json')  # Empty to disable the snapshot
+CACHE_FULL_REFRESH = int(os.getenv('CACHE_FULL_REFRESH', 60))  # Minutes between full refreshes of the metadata cache, renames show up after at most this long
+INFERENCE_CACHE_PATH = os.getenv('INFERENCE_CACHE_PATH', 'data/inference_cache.sqlite')  # Empty to disable the cache
+INFERENCE_CACHE_MAX_ENTRIES = int(os.getenv('INFERENCE_CACHE_MAX_ENTRIES', 10000))
+INFERENCE_CACHE_MAX_AGE = int(os.getenv('INFERENCE_CACHE_MAX_AGE', 30))  # Maximum age of a cached result in days
+QUEUE_PATH = os.getenv('QUEUE_PATH', 'data/queue.sqlite')  # Location of the persistent processing queue
+QUEUE_LEASE = float(os.getenv('QUEUE_LEASE', 1800))  # Seconds before an entry whose lease is not renewed is handed out again
+QUEUE_MAX_ATTEMPTS = int(os.getenv('QUEUE_MAX_ATTEMPTS', 3))  # Attempts before a queue entry is given up
+QUEUE_RETRY_DELAY = float(os.getenv('QUEUE_RETRY_DELAY', 30))  # Seconds before the first retry, doubled with every attempt
+QUEUE_LANE_DELAYS = parseLaneValues('QUEUE_LANE_DELAYS', 'interactive:0,webhook:60,bulk:900')  # Seconds an entry of a priority lane lets more urgent work go first
+BACKFILL_STATE_PATH = os.getenv('BACKFILL_STATE_PATH', 'data/backfill.json')  # Checkpoint of the running backfill
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE', 5))  # Documents queued per second by a backfill
+BACKFILL_MAX_PENDING = int(os.getenv('BACKFILL_MAX_PENDING', 200))  # Waiting bulk entries before a backfill pauses
+CONFLICT_CHECK = os.getenv('CONFLICT_CHECK', 'False')  # Check if a document was modified during processing before writing, one extra request
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 100))  # Documents per Paperless bulk edit request
+TAG_BATCH_SIZE = int(os.getenv('TAG_BATCH_SIZE', 0))  # Processed documents tagged together, 0 tags every document right away
+TAG_BATCH_INTERVAL = float(os.getenv('TAG_BATCH_INTERVAL', 5))  # Maximum seconds a tag change is buffered
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 10000))  # Unfinished queue entries before webhooks are rejected
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 10))  # Webhooks per second and client, 0 disables the limit
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', 50))  # Webhooks a client may send at once
+ADMISSION_SHED = parseLaneValues('ADMISSION_SHED', 'bulk:0.5,webhook:0.9,interactive:1.0')  # Fraction of ADMISSION_MAX_QUEUE above which requests of a priority lane are rejected
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 30))  # Seconds a client should wait if the queue is full
+INFERENCE_CONCURRENCY = int(os.getenv('INFERENCE_CONCURRENCY', 2 * max(len(parseHosts(OLLAMA_HOST)), 1)))  # Documents analyzed by the AI at the same time, 2 per Ollama host
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', max(4, INFERENCE_CONCURRENCY + 2)))  # Queue entries processed at the same time, enough to keep the inference slots busy
+PAPERLESS_CONCURRENCY = int(os.getenv('PAPERLESS_CONCURRENCY', 4))  # Concurrent Paperless requests of the workers
+PAPERLESS_TIMEOUT = float(os.getenv('PAPERLESS_TIMEOUT', 30))  # Timeout in seconds for a single Paperless request
+PAPERLESS_RETRIES = int(os.getenv('PAPERLESS_RETRIES', 3))  # Retries of a Paperless request after a transient error
+OLLAMA_RETRIES = int(os.getenv('OLLAMA_RETRIES', 2))  # Retries of an inference after a transient error
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))  # Failed calls in a row before a backend is considered down
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', 30))  # Seconds before a backend which is down is tried again
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 30))  # Seconds the workers may finish their entries during a shutdown
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'combined')  # 'combined' = one inference for all fields, 'single' = one per field
 
 # Define application version
 VERSION = "1.5.0"
@@ -29,6 +101,31 @@ ACCEPTED_DATAFIELDS = {
     # "correspondend": ""  # Uncomment when needed
 }
 
+# Content strategy per field ("<mode>:<tokens>", see services/content.py).
+# A title is usually on the first page, so it does not need to see the whole document.
+CONTENT_STRATEGY = os.getenv('CONTENT_STRATEGY', 'mapreduce:6000')  # Default for fields without an own strategy
+FIELD_CONTENT_STRATEGIES = {
+    "title": "head:2000"
+}
+FIELD_CONTENT_STRATEGIES.update({
+    key[17:].lower(): value for key, value in os.environ.items() if key.startswith("CONTENT_STRATEGY_")
+})
+for field, strategy in list(FIELD_CONTENT_STRATEGIES.items()):
+    try:
+        parseStrategy(strategy)
+    except ValueError as e:
+        logging.error(f"Ignoring content strategy of field {field}: {e}")
+        del FIELD_CONTENT_STRATEGIES[field]
+MAPREDUCE_PARALLELISM = int(os.getenv('MAPREDUCE_PARALLELISM', 2))  # Chunks of one document analyzed at the same time
+MAPREDUCE_MAX_CHUNKS = int(os.getenv('MAPREDUCE_MAX_CHUNKS', 16))  # Upper bound of inferences per field and document
+
+# Embedding based classification of correspondent, document type and storage path
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'nomic-embed-text')  # Empty to disable the classifier
+CLASSIFIER_INDEX_PATH = os.getenv('CLASSIFIER_INDEX_PATH', 'data/classifier_index.npz')
+CLASSIFIER_K = int(os.getenv('CLASSIFIER_K', 5))  # Number of neighbours which vote for a suggestion
+CLASSIFIER_THRESHOLD = float(os.getenv('CLASSIFIER_THRESHOLD', 0.8))  # Minimum similarity, below the AI is asked
+CLASSIFIER_SYNC_INTERVAL = float(os.getenv('CLASSIFIER_SYNC_INTERVAL', 60))  # Minutes between index updates, 0 disables them
+
 # Initialize Paperless API connection
 paperless = Paperless(PAPERLESS_BASE_URL, AUTH_TOKEN)
 
@@ -55,21 +152,121 @@ def setConfig(app):
     app.config["AUTH_TOKEN"] = AUTH_TOKEN
     app.config["PAPERLESS_API"] = paperless
     app.config["CACHE_TIME"] = CACHE_TIME
+    app.config["CACHE_SNAPSHOT_PATH"] = CACHE_SNAPSHOT_PATH
+    app.config["CACHE_FULL_REFRESH"] = CACHE_FULL_REFRESH
     app.config["INBOX_TAG"] = INBOX_TAG
     app.config["LOG_LEVEL"] = LOG_LEVEL
     app.config["AI_USAGE"] = AI_USAGE
     app.config["OLLAMA_MODEL"] = OLLAMA_MODEL
+    app.config["OLLAMA_CASCADE"] = OLLAMA_CASCADE
     app.config["OLLAMA_HOST"] = OLLAMA_HOST
+    app.config["OLLAMA_HEALTH_INTERVAL"] = OLLAMA_HEALTH_INTERVAL
+    app.config["OLLAMA_TIMEOUT"] = OLLAMA_TIMEOUT
+    app.config["OLLAMA_KEEP_ALIVE"] = OLLAMA_KEEP_ALIVE
+    app.config["STREAM_RESPONSES"] = STREAM_RESPONSES
+    app.config["MAX_TOKENS_PER_FIELD"] = MAX_TOKENS_PER_FIELD
+    app.config["KEEP_WARM_INTERVAL"] = KEEP_WARM_INTERVAL
+    app.config["KEEP_WARM_WINDOW"] = KEEP_WARM_WINDOW
     app.config["PROCESSING_TAG"] = PROCESSING_TAG
     app.config["ERROR_TAG"] = ERROR_TAG
     app.config["DEBUG"] = DEBUG
     app.config["BUTTON_TAGS"] = BUTTON_TAGS
     app.config["ACCEPTED_DATAFIELDS"] = ACCEPTED_DATAFIELDS
+    app.config["EXTRACTION_MODE"] = EXTRACTION_MODE
+    app.config["QUEUE_PATH"] = QUEUE_PATH
+    app.config["QUEUE_LEASE"] = QUEUE_LEASE
+    app.config["QUEUE_MAX_ATTEMPTS"] = max(QUEUE_MAX_ATTEMPTS, 1)
+    app.config["QUEUE_RETRY_DELAY"] = QUEUE_RETRY_DELAY
+    app.config["QUEUE_LANE_DELAYS"] = QUEUE_LANE_DELAYS
+    app.config["BACKFILL_STATE_PATH"] = BACKFILL_STATE_PATH
+    app.config["BACKFILL_RATE"] = BACKFILL_RATE
+    app.config["BACKFILL_MAX_PENDING"] = BACKFILL_MAX_PENDING
+    app.config["CONFLICT_CHECK"] = CONFLICT_CHECK == 'True'
+    app.config["BULK_CHUNK_SIZE"] = max(BULK_CHUNK_SIZE, 1)
+    app.config["TAG_BATCH_SIZE"] = TAG_BATCH_SIZE
+    app.config["TAG_BATCH_INTERVAL"] = TAG_BATCH_INTERVAL
+    app.config["ADMISSION_MAX_QUEUE"] = ADMISSION_MAX_QUEUE
+    app.config["ADMISSION_RATE"] = ADMISSION_RATE
+    app.config["ADMISSION_BURST"] = ADMISSION_BURST
+    app.config["ADMISSION_SHED"] = ADMISSION_SHED
+    app.config["ADMISSION_RETRY_AFTER"] = ADMISSION_RETRY_AFTER
+    app.config["WORKER_COUNT"] = max(WORKER_COUNT, 1)
+    app.config["INFERENCE_CONCURRENCY"] = max(INFERENCE_CONCURRENCY, 1)
+    app.config["PAPERLESS_CONCURRENCY"] = max(PAPERLESS_CONCURRENCY, 1)
+    app.config["INFERENCE_SLOTS"] = asyncio.Semaphore(app.config["INFERENCE_CONCURRENCY"])
+    app.config["PAPERLESS_SLOTS"] = asyncio.Semaphore(app.config["PAPERLESS_CONCURRENCY"])
+    app.config["SHUTDOWN_TIMEOUT"] = SHUTDOWN_TIMEOUT
+    app.config["PAPERLESS_TIMEOUT"] = PAPERLESS_TIMEOUT
+    app.config["PAPERLESS_RETRIES"] = max(PAPERLESS_RETRIES, 0)
+    app.config["OLLAMA_RETRIES"] = max(OLLAMA_RETRIES, 0)
+    app.config["BREAKER_THRESHOLD"] = max(BREAKER_THRESHOLD, 1)
+    app.config["BREAKER_RESET"] = BREAKER_RESET
+    # Deadlines, retries and circuit breakers of all Paperless and Ollama calls
+    app.config["PAPERLESS_RESILIENCE"] = Resilience(
+        "paperless", PAPERLESS_TIMEOUT, app.config["PAPERLESS_RETRIES"],
+        failure_threshold=app.config["BREAKER_THRESHOLD"], reset_timeout=BREAKER_RESET
+    )
+    app.config["OLLAMA_RESILIENCE"] = Resilience(
+        "ollama", None, app.config["OLLAMA_RETRIES"],  # The Ollama pool enforces OLLAMA_TIMEOUT per request
+        failure_threshold=app.config["BREAKER_THRESHOLD"], reset_timeout=BREAKER_RESET
+    )
+    app.config["CONTENT_STRATEGY"] = CONTENT_STRATEGY
+    app.config["FIELD_CONTENT_STRATEGIES"] = FIELD_CONTENT_STRATEGIES
+    app.config["MAPREDUCE_PARALLELISM"] = MAPREDUCE_PARALLELISM
+    app.config["MAPREDUCE_MAX_CHUNKS"] = MAPREDUCE_MAX_CHUNKS
+    app.config["EMBEDDING_MODEL"] = EMBEDDING_MODEL
+    app.config["CLASSIFIER_INDEX_PATH"] = CLASSIFIER_INDEX_PATH
+    app.config["CLASSIFIER_K"] = CLASSIFIER_K
+    app.config["CLASSIFIER_THRESHOLD"] = CLASSIFIER_THRESHOLD
+    app.config["CLASSIFIER_SYNC_INTERVAL"] = CLASSIFIER_SYNC_INTERVAL
+    app.config["INFERENCE_CACHE_PATH"] = INFERENCE_CACHE_PATH
+    app.config["INFERENCE_CACHE_MAX_ENTRIES"] = INFERENCE_CACHE_MAX_ENTRIES
+    app.config["INFERENCE_CACHE_MAX_AGE"] = INFERENCE_CACHE_MAX_AGE
+    app.config["AICONNECTION"] = False
+    app.config["PAPERLESSCONNECTION"] = False
+    app.config["AI_READY"] = asyncio.Event()  # Set as soon as the AI connection is established
+    app.config["PAPERLESS_READY"] = asyncio.Event()  # Set as soon as the Paperless connection is established
+    app.config["STARTUP"] = {"started": None, "phases": {}}  # Timings of the startup phases
 
 
+"""
+Initializes the connections to Paperless and Ollama.
+
+Both connections are established concurrently in background tasks, so the server can
+bind its port immediately. The AI connection (model pull and load) can take minutes
+and Paperless may still be starting as well. Workers wait for `AI_READY` and
+`PAPERLESS_READY`, webhooks are queued in the meantime.
+"""
 async def initializeConnections(app):
-    initializeAIConnection(app)
-    await initializePaperlessConnection(app)
+    app.config["STARTUP"]["started"] = time.time()
+    app.config["AI_INIT_TASK"] = asyncio.create_task(runPhase(app, "ai", initializeAIConnection(app)))
+    app.config["PAPERLESS_INIT_TASK"] = asyncio.create_task(runPhase(app, "paperless", initializePaperlessConnection(app)))
+
+"""
+Runs one startup phase and records its state and duration in `STARTUP`.
+
+Parameters:
+- app (Quart): The Quart application instance.
+- name (str): Name of the phase.
+- coroutine: The initialization to run. A result of False marks the phase as failed.
+
+Returns:
+- The result of the coroutine.
+"""
+async def runPhase(app, name: str, coroutine):
+    phase = {"state": "running", "started": time.time(), "duration": None}
+    app.config["STARTUP"]["phases"][name] = phase
+    start = time.monotonic()
+    try:
+        result = await coroutine
+        phase["state"] = "failed" if result is False else "done"
+        return result
+    except Exception:
+        phase["state"] = "failed"
+        raise
+    finally:
+        phase["duration"] = round(time.monotonic() - start, 3)
+        logging.info(f"Startup phase {name} {phase['state']} after {phase['duration']}s")
 
 async def initializePaperlessConnection(app):
     logging.info("Initialize Paperless Connection")
@@ -81,6 +278,11 @@ async def initializePaperlessConnection(app):
             await app.config["PAPERLESS_API"].initialize()  # Ensure the API is ready            app.config["PAPERLESSCONNECTION"] = True
             logging.info("Paperless Connection established successfully.")
             app.config["PAPERLESSCONNECTION"] = True
+            app.config["PAPERLESS_READY"].set()
+            if app.config.get("CACHE") is not None:
+                app.config["CACHE"].startRefresher()  # Keep the metadata fresh without blocking requests
+            if app.config.get("BACKFILL") is not None:
+                app.config["BACKFILL"].resumeInterrupted()  # Continue a backfill interrupted by a restart
             return True
         except Exception as e:
             logging.warning(f"Attempt {attempt + 1} failed: {e}")
@@ -90,7 +292,7 @@ async def initializePaperlessConnection(app):
     app.config["PAPERLESSCONNECTION"] = False
     return False
 
-def initializeAIConnection(app):
+async def initializeAIConnection(app):
     logging.info("Initialize Ollama Connection")
     if not OLLAMA_HOST:
         logging.error("OLLAMA_HOST is not set.")
@@ -103,17 +305,77 @@ def initializeAIConnection(app):
         app.config["AICONNECTION"] = False
         return False
     logging.info(f"OLLAMA_MODEL is set to: {OLLAMA_MODEL}")
+    if OLLAMA_CASCADE:
+        logging.info(f"OLLAMA_CASCADE is set to: {OLLAMA_CASCADE}")
     try:
-        ai = AI(OLLAMA_MODEL, logging)
-        if not ai.selfCheck():
+        ai = AI(OLLAMA_MODEL, logging, host=OLLAMA_HOST, timeout=OLLAMA_TIMEOUT, datafields=ACCEPTED_DATAFIELDS,
+                cache=app.config.get("INFERENCE_CACHE"), strategies=FIELD_CONTENT_STRATEGIES, default_strategy=CONTENT_STRATEGY,
+                parallelism=MAPREDUCE_PARALLELISM, max_chunks=MAPREDUCE_MAX_CHUNKS, keep_alive=parseKeepAlive(OLLAMA_KEEP_ALIVE),
+                stream=STREAM_RESPONSES == 'True', max_tokens=MAX_TOKENS_PER_FIELD,
+                cascade=OLLAMA_CASCADE, validator=FieldValidator(lambda: app.config.get("CACHE")),
+                resilience=app.config["OLLAMA_RESILIENCE"])
+        if not await ai.selfCheck():
             logging.error("Ollama connection failed.")
             app.config["AICONNECTION"] = False
+            await ai.close()
             return False
         else:
+            previous = app.config.get("AI_API")
             app.config["AI_API"] = ai
             app.config["AICONNECTION"] = True
+            if previous is not None:
+                try:
+                    await previous.releaseModels(keep=ai.models)  # The model or the cascade changed
+                except Exception as e:
+                    logging.warning(f"Unloading the previous models failed: {e}")
+                await previous.close()  # Release the connection pool of the replaced instance
+            ai.startKeepWarm(KEEP_WARM_INTERVAL, KEEP_WARM_WINDOW)
+            ai.startHealthChecks(OLLAMA_HEALTH_INTERVAL)
+            app.config["AI_READY"].set()
+            await runPhase(app, "classifier", initializeClassifier(app, ai))
             return True
     except Exception as e:
         logging.error(f"Error initializing AI: {e}")
         app.config["AICONNECTION"] = False
-        return False
\ No newline at end of file
+        return False
+
+"""
+Converts the keep_alive setting into the format expected by Ollama.
+
+Parameters:
+- value (str): A duration like "30m" or a number of seconds, negative keeps the model loaded forever.
+
+Returns:
+- str|float: The keep_alive value for Ollama.
+"""
+def parseKeepAlive(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+"""
+Sets up the embedding based classifier once the AI connection is established.
+
+Parameters:
+- app (Quart): The Quart application instance.
+- ai (AI): The connected AI instance.
+"""
+async def initializeClassifier(app, ai):
+    if not EMBEDDING_MODEL:
+        return
+    classifier = app.config.get("CLASSIFIER")
+    if classifier is not None:
+        classifier.ai = ai  # Reconnect, keep the index
+        return
+    try:
+        if not await ai.pullModel(EMBEDDING_MODEL):
+            logging.error(f"Embedding model {EMBEDDING_MODEL} is not available, the classifier is disabled.")
+            return
+        classifier = Classifier(ai, app.config["PAPERLESS_API"], app.config["CACHE"], CLASSIFIER_INDEX_PATH,
+                                EMBEDDING_MODEL, CLASSIFIER_K, CLASSIFIER_THRESHOLD)
+        await classifier.load()
+        classifier.startSync(CLASSIFIER_SYNC_INTERVAL)
+        app.config["CLASSIFIER"] = classifier
+    except Exception as e:
+        logging.error(f"Error initializing the classifier: {e}")
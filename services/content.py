@@ -0,0 +1,124 @@
+import math, logging
+
+"""
+Token-budget aware preparation of document content for the AI.
+
+A content strategy decides which part of a document a field gets to see. It is written
+as "<mode>:<tokens>", e.g. "head:2000":
+- full: The whole content, regardless of its length.
+- head: Only the beginning of the document, up to the token budget.
+- window: The beginning and the end of the document, together up to the token budget.
+- mapreduce: The whole document, split into chunks of the token budget, which are
+  analyzed separately and combined afterwards.
+"""
+
+MODES = ("full", "head", "window", "mapreduce")
+
+# Rough number of characters per token for the usual models and european languages
+CHARS_PER_TOKEN = 4
+
+"""
+Estimates the number of tokens of a text.
+
+Parameters:
+- text (str): The text to estimate.
+
+Returns:
+- int: The estimated number of tokens.
+"""
+def estimateTokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+"""
+Parses a content strategy.
+
+Parameters:
+- strategy (str): The strategy in the form "<mode>:<tokens>" or just "full".
+
+Returns:
+- tuple: The mode and the token budget (None for "full").
+
+Raises:
+- ValueError: If the strategy is not valid.
+"""
+def parseStrategy(strategy: str) -> tuple:
+    mode, _, tokens = strategy.strip().partition(":")
+    mode = mode.lower()
+    if mode not in MODES:
+        raise ValueError(f"Unknown content strategy '{strategy}', expected one of {MODES}")
+    if mode == "full":
+        return mode, None
+    if not tokens.isdigit() or int(tokens) <= 0:
+        raise ValueError(f"Content strategy '{strategy}' needs a positive token budget")
+    return mode, int(tokens)
+
+"""
+Splits the content according to a content strategy.
+
+Parameters:
+- content (str): The document content.
+- strategy (str): The content strategy.
+- max_chunks (int): Maximum number of chunks for the mapreduce mode. Longer documents
+  are sampled evenly, so the number of inferences per document stays bounded.
+
+Returns:
+- list[str]: The content parts which have to be analyzed. More than one part means
+  the results have to be combined.
+"""
+def prepareContent(content: str, strategy: str, max_chunks: int = 16) -> list[str]:
+    mode, tokens = parseStrategy(strategy)
+    content = content or ""
+    if mode == "full" or estimateTokens(content) <= tokens:
+        return [content]
+
+    budget = tokens * CHARS_PER_TOKEN
+    if mode == "head":
+        return [content[:_boundary(content, budget)]]
+    if mode == "window":
+        head = content[:_boundary(content, budget // 2)]
+        tail = content[-(budget // 2):]
+        return [f"{head}\n[...]\n{tail}"]
+
+    chunks = splitContent(content, budget)
+    if len(chunks) > max_chunks:
+        logging.info(f"Document has {len(chunks)} chunks, only {max_chunks} evenly distributed chunks are analyzed")
+        step = (len(chunks) - 1) / (max_chunks - 1) if max_chunks > 1 else 0
+        chunks = [chunks[round(index * step)] for index in range(max_chunks)]
+    return chunks
+
+"""
+Splits a text into chunks of at most `size` characters, preferably at line or word boundaries.
+
+Parameters:
+- content (str): The text to split.
+- size (int): Maximum number of characters per chunk.
+- overlap (int, optional): Characters repeated at the start of the next chunk. Defaults to 5% of `size`.
+
+Returns:
+- list[str]: The chunks in document order.
+"""
+def splitContent(content: str, size: int, overlap: int = None) -> list[str]:
+    if overlap is None:
+        overlap = size // 20
+    chunks = []
+    start = 0
+    while start < len(content):
+        end = start + _boundary(content[start:], size)
+        chunks.append(content[start:end])
+        if end >= len(content):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+"""
+Finds a good cut position at or before `size`, preferring line breaks, then spaces.
+"""
+def _boundary(text: str, size: int) -> int:
+    if len(text) <= size:
+        return len(text)
+    minimum = size - size // 10  # Do not give away more than 10% of the budget
+    for separator in ("\n", " "):
+        position = text.rfind(separator, minimum, size)
+        if position != -1:
+            return position + 1
+    return size
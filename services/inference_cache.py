@@ -0,0 +1,156 @@
+import os, time, sqlite3, hashlib, asyncio, threading, logging
+
+"""
+Persistent, content-addressed cache for AI inference results.
+
+Results are stored in a SQLite database and keyed by a hash of everything which
+influences the answer of the model: the model name, the system prompt, the document
+content and the field prompt. Re-running a document with identical content therefore
+returns the stored answer instead of running the model again.
+
+Parameters:
+- path (str): Path of the SQLite database file.
+- max_entries (int): Maximum number of stored results. The least recently used entries are evicted first.
+- max_age (int): Maximum age of a stored result in days.
+"""
+class InferenceCache:
+    EVICTION_INTERVAL = 100  # Number of writes between two eviction runs
+
+    def __init__(self, path: str, max_entries: int = 10000, max_age: int = 30):
+        self._path = path
+        self._max_entries = max_entries
+        self._max_age = max_age * 24 * 60 * 60
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS inference ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS inference_accessed ON inference (accessed)")
+            self._connection.commit()
+        self._evict()
+
+    """
+    Builds the cache key for a single inference.
+
+    Parameters:
+    - model (str): Name of the model.
+    - systemprompt (str): The system prompt sent to the model.
+    - content (str): The document content.
+    - prompt (str): The field prompt.
+
+    Returns:
+    - str: A hex digest identifying the inference.
+    """
+    @staticmethod
+    def key(model: str, systemprompt: str, content: str, prompt: str) -> str:
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        digest = hashlib.sha256()
+        for part in (model, systemprompt, content_hash, prompt):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")  # Separator, so that parts cannot be shifted into each other
+        return digest.hexdigest()
+
+    """
+    Looks up a stored result.
+
+    Parameters:
+    - key (str): Key created by `key()`.
+
+    Returns:
+    - str: The stored result, or None if there is no valid entry.
+    """
+    async def get(self, key: str) -> str:
+        value = await asyncio.to_thread(self._get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    """
+    Stores a result.
+
+    Parameters:
+    - key (str): Key created by `key()`.
+    - value (str): The result of the inference.
+    """
+    async def put(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self._put, key, value)
+
+    """
+    Returns the hit/miss counters and the number of stored entries.
+
+    Returns:
+    - dict: Cache statistics.
+    """
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM inference").fetchone()[0]
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+            "entries": entries,
+            "max_entries": self._max_entries
+        }
+
+    """
+    Removes all stored results.
+    """
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM inference")
+            self._connection.commit()
+
+    def _get(self, key: str) -> str:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM inference WHERE key = ? AND created >= ?", (key, now - self._max_age)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE inference SET accessed = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+        return row[0]
+
+    def _put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO inference (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._connection.commit()
+            self._writes += 1
+            evict = self._writes % self.EVICTION_INTERVAL == 0
+        if evict:
+            self._evict()
+
+    """
+    Removes expired entries and trims the cache to `max_entries` by last access.
+    """
+    def _evict(self) -> None:
+        with self._lock:
+            expired = self._connection.execute(
+                "DELETE FROM inference WHERE created < ?", (time.time() - self._max_age,)
+            ).rowcount
+            trimmed = self._connection.execute(
+                "DELETE FROM inference WHERE key IN ("
+                "SELECT key FROM inference ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self._max_entries,)
+            ).rowcount
+            self._connection.commit()
+        if expired or trimmed:
+            logging.debug(f"Inference cache evicted {expired} expired and {trimmed} surplus entries")
@@ -0,0 +1,189 @@
+import bisect, threading, time
+from contextlib import contextmanager
+
+"""
+Minimal metrics in the Prometheus text format.
+
+The metrics are plain in-memory counters, recording one value is a dict lookup and an
+addition, so they can be used on the hot path of the workers. Values which are cheap
+to read at any time (queue depth, cache statistics, circuit breakers) are not tracked
+continuously but set as gauges when `/metrics` is scraped.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 14400)
+
+"""
+Base class of the metric types.
+
+Parameters:
+- name (str): Metric name, e.g. "paperless_pipeline_documents_total".
+- help (str): Description of the metric.
+- labels (tuple[str]): Names of the labels, the values are given in the same order.
+"""
+class Metric:
+    TYPE = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()  # The queue records from its database thread
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values = {}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key: tuple, value) -> list:
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}"]
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, *labels, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+"""
+Histogram with cumulative buckets.
+
+Parameters:
+- buckets (tuple[float]): Upper bounds of the buckets in ascending order.
+"""
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # Buckets, +Inf, sum
+            counts[index] += 1
+            counts[-1] += value
+
+    """
+    Measures the duration of a block.
+    """
+    @contextmanager
+    def time(self, *labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.monotonic() - start)
+
+    def _samples(self, key: tuple, counts: list) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+            cumulative += count
+            labels = _labels(self.labels + ("le",), key + (bound if bound == "+Inf" else _number(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(counts[-1])}")
+        lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+"""
+Collection of metrics which are rendered together.
+"""
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    """
+    Renders all metrics in the Prometheus text format.
+
+    Returns:
+    - str: The exposition text.
+    """
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+# The metrics of the pipeline
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "paperless_pipeline_stage_seconds", "Duration of the processing stages of a document", ("stage",)
+)
+INFERENCE_SECONDS = REGISTRY.histogram(
+    "paperless_pipeline_inference_seconds", "Duration of an inference per model and requested fields", ("model", "fields")
+)
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "paperless_pipeline_queue_wait_seconds", "Time between queueing and processing of an entry", ("lane",), WAIT_BUCKETS
+)
+DOCUMENTS = REGISTRY.counter(
+    "paperless_pipeline_documents_total", "Processed queue entries by outcome", ("result",)
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "paperless_pipeline_cache_lookups_total", "Lookups of the metadata cache: hit, stale (served while refreshing) or miss (first load)", ("cache", "result")
+)
+BACKEND_ERRORS = REGISTRY.counter(
+    "paperless_pipeline_backend_errors_total", "Failed calls to Paperless and Ollama", ("backend", "kind")
+)
+QUEUE_ENTRIES = REGISTRY.gauge(
+    "paperless_pipeline_queue_entries", "Entries of the processing queue by state", ("state",)
+)
+QUEUE_PENDING = REGISTRY.gauge(
+    "paperless_pipeline_queue_pending", "Entries waiting in a priority lane", ("lane",)
+)
+INFERENCE_CACHE = REGISTRY.gauge(
+    "paperless_pipeline_inference_cache", "Statistics of the inference cache", ("value",)
+)
+BREAKER_OPEN = REGISTRY.gauge(
+    "paperless_pipeline_breaker_open", "1 while the circuit breaker of a backend is open or half-open", ("backend",)
+)
+WORKERS_BUSY = REGISTRY.gauge(
+    "paperless_pipeline_workers_busy", "Queue workers which are processing an entry", ()
+)
@@ -0,0 +1,437 @@
+import os, json, time, uuid, sqlite3, asyncio, threading, logging
+from services.metrics import QUEUE_WAIT_SECONDS
+
+"""
+Durable processing queue backed by SQLite.
+
+Every entry is written to disk before the webhook is answered, so pending documents
+survive restarts, updates and crashes of the container. A worker leases an entry while
+it processes it and acknowledges it afterwards (at-least-once delivery). The worker
+renews its lease while it is busy, an entry whose lease expired is handed out again.
+Every lease has a token, acknowledging, failing or postponing an entry only has an
+effect while the caller still holds the lease, so a worker whose lease expired cannot
+remove the entry from the worker which took it over. Entries whose
+processing failed are retried after a delay until `max_attempts` is reached and are
+kept as failed entries afterwards. Entries which were leased when the process stopped
+are handed out again on startup.
+
+Entries can be given a key (e.g. the document id). A new entry for a key which is still
+pending is merged into the pending entry, and an entry for a key which is currently
+processed waits until the processing has finished, so the same key is never processed
+twice at the same time.
+
+Every entry belongs to a priority lane. Entries of the most urgent lanes (the lanes
+with the smallest delay, "interactive" by default) are always handed out first, no
+matter how long other work has waited. The other lanes are ordered by when their
+entries are due, which is the enqueue time plus the delay of the lane: a webhook
+overtakes waiting bulk work, but a bulk entry which waited longer than its lane delay
+is handed out before webhooks which arrived after it was due, so bulk work is delayed
+by newer webhooks for at most its lane delay.
+
+Entries have to be JSON serializable.
+
+Parameters:
+- path (str): Path of the SQLite database file.
+- lease (float): Seconds a worker may hold an entry without renewing the lease before it is handed out again.
+- max_attempts (int): Number of attempts before an entry is marked as failed.
+- retry_delay (float): Seconds before a failed entry is retried, doubled with every attempt.
+- poll_interval (float): Seconds between checks for expired leases and due retries while the queue is idle.
+- lanes (dict, optional): Delay in seconds per priority lane, defaults to `LANES`.
+"""
+class PersistentQueue:
+    LANES = {"interactive": 0, "webhook": 60, "bulk": 900}
+    DEFAULT_LANE = "webhook"
+
+    def __init__(self, path: str, lease: float = 1800, max_attempts: int = 3, retry_delay: float = 30, poll_interval: float = 1.0,
+                 lanes: dict = None):
+        self._path = path
+        self.lanes = dict(lanes or self.LANES)
+        self._urgent = [lane for lane, delay in self.lanes.items() if delay == min(self.lanes.values())]
+        self._waits = {lane: {"claimed": 0, "total_wait": 0.0, "max_wait": 0.0} for lane in self.lanes}
+        self._lease = lease
+        self.max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._available = asyncio.Event()
+        self._idle = asyncio.Event()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")  # Durable in WAL mode, without a sync per commit
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS queue ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, available REAL NOT NULL, lease_until REAL, "
+                "created REAL NOT NULL, error TEXT, key TEXT, lane TEXT, deadline REAL, lease_token TEXT)"
+            )
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(queue)")]
+            for column, definition in (("key", "TEXT"), ("lane", "TEXT"), ("deadline", "REAL"), ("lease_token", "TEXT")):
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE queue ADD COLUMN {column} {definition}")  # Queue created by an older version
+            self._connection.execute(
+                "UPDATE queue SET lane = ?, deadline = available WHERE deadline IS NULL", (self.DEFAULT_LANE,)
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS queue_state ON queue (state, deadline)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS queue_key ON queue (key, state)")
+            recovered = self._connection.execute(
+                "UPDATE queue SET state = 'pending', lease_until = NULL, lease_token = NULL WHERE state = 'leased'"
+            ).rowcount
+            self._connection.commit()
+            self._unfinished = self._connection.execute(
+                "SELECT COUNT(*) FROM queue WHERE state = 'pending'"
+            ).fetchone()[0]
+        if recovered:
+            logging.info(f"Recovered {recovered} unfinished queue entries")
+        if self._unfinished:
+            logging.info(f"{self._unfinished} queue entries are waiting to be processed")
+            self._available.set()
+        else:
+            self._idle.set()
+
+    """
+    Adds an entry to the queue.
+
+    Parameters:
+    - entry (dict): The entry.
+    - key (str, optional): Entries with the same key are coalesced.
+    - merge (callable, optional): Combines the pending entry with the new one, `merge(pending, new) -> dict`.
+      Without it the new entry replaces the pending one.
+    - lane (str, optional): The priority lane. A merged entry moves to the more urgent lane.
+
+    Returns:
+    - tuple: The id of the queue entry and how it was added:
+      "queued", "merged" into a pending entry or "deferred" until the entry in progress is finished.
+    """
+    async def put(self, entry: dict, key: str = None, merge=None, lane: str = None) -> tuple:
+        lane = self._lane(lane)
+        if key is None:
+            ids = await asyncio.to_thread(self._insert, [entry], lane)
+            self._added(len(ids))
+            return ids[0], "queued"
+        queue_id, status = await asyncio.to_thread(self._upsert, entry, str(key), merge, lane)
+        if status != "merged":
+            self._added(1)
+        return queue_id, status
+
+    """
+    Adds several entries to the queue within one transaction.
+
+    Parameters:
+    - entries (list[dict]): The entries.
+    - lane (str, optional): The priority lane.
+
+    Returns:
+    - list[int]: The ids of the queue entries.
+    """
+    async def putMany(self, entries: list, lane: str = None) -> list:
+        if not entries:
+            return []
+        ids = await asyncio.to_thread(self._insert, entries, self._lane(lane))
+        self._added(len(ids))
+        return ids
+
+    """
+    Waits for the next due entry and leases it.
+
+    Returns:
+    - dict: The entry with its "queue_id", its "lane", the "lease" token and the number of "attempts" including this one.
+    """
+    async def get(self) -> dict:
+        while True:
+            self._available.clear()  # Cleared before looking, so a concurrent put is not missed
+            entry = await asyncio.to_thread(self._claim)
+            if entry is not None:
+                return entry
+            try:
+                await asyncio.wait_for(self._available.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass  # Check for expired leases and due retries
+
+    """
+    Renews the lease of an entry which is still processed.
+
+    Parameters:
+    - queue_id (int): The id of the entry.
+    - lease (str): The lease token of the entry.
+
+    Returns:
+    - bool: False if the lease expired and the entry was handed out again.
+    """
+    async def extendLease(self, queue_id: int, lease: str) -> bool:
+        updated = await asyncio.to_thread(
+            self._execute,
+            "UPDATE queue SET lease_until = ? WHERE id = ? AND lease_token = ? AND state = 'leased'",
+            (time.time() + self._lease, queue_id, lease)
+        )
+        return self._owned(queue_id, updated, "renew")
+
+    """
+    Renews the lease of an entry until it is cancelled, run as a task next to the processing.
+
+    Parameters:
+    - queue_id (int): The id of the entry.
+    - lease (str): The lease token of the entry.
+    - interval (float, optional): Seconds between the renewals, a third of the lease by default.
+    """
+    async def heartbeat(self, queue_id: int, lease: str, interval: float = None) -> None:
+        interval = interval or self._lease / 3
+        while True:
+            await asyncio.sleep(interval)
+            if not await self.extendLease(queue_id, lease):
+                return
+
+    """
+    Marks an entry as processed and removes it.
+
+    Parameters:
+    - queue_id (int): The id of the entry.
+    - lease (str): The lease token of the entry.
+
+    Returns:
+    - bool: False if the lease was lost, the entry is left to its new holder.
+    """
+    async def ack(self, queue_id: int, lease: str) -> bool:
+        deleted = await asyncio.to_thread(
+            self._execute, "DELETE FROM queue WHERE id = ? AND lease_token = ? AND state = 'leased'", (queue_id, lease)
+        )
+        if not self._owned(queue_id, deleted, "acknowledge"):
+            return False
+        self._finished()
+        return True
+
+    """
+    Returns an entry whose processing failed. It is retried later or marked as failed
+    once it reached `max_attempts`.
+
+    Parameters:
+    - queue_id (int): The id of the entry.
+    - lease (str): The lease token of the entry.
+    - error (str, optional): Description of the failure.
+
+    Returns:
+    - bool: True if the entry will be retried, False if it failed or the lease was lost.
+    """
+    async def nack(self, queue_id: int, lease: str, error: str = None) -> bool:
+        retry = await asyncio.to_thread(self._release, queue_id, lease, error)
+        if not self._owned(queue_id, retry is not None, "release"):
+            return False
+        if not retry:
+            self._finished()
+        return retry
+
+    """
+    Returns an entry which could not be processed because a backend is down. The attempt
+    is not counted, the entry waits until `delay` seconds have passed.
+
+    Parameters:
+    - queue_id (int): The id of the entry.
+    - lease (str): The lease token of the entry.
+    - delay (float): Seconds before the entry is handed out again.
+
+    Returns:
+    - bool: False if the lease was lost, the entry is left to its new holder.
+    """
+    async def postpone(self, queue_id: int, lease: str, delay: float) -> bool:
+        available = time.time() + delay
+        updated = await asyncio.to_thread(
+            self._execute,
+            "UPDATE queue SET state = 'pending', lease_until = NULL, lease_token = NULL, attempts = MAX(attempts - 1, 0), "
+            "available = ?, deadline = MAX(deadline, ?) WHERE id = ? AND lease_token = ? AND state = 'leased'",
+            (available, available, queue_id, lease)
+        )
+        return self._owned(queue_id, updated, "postpone")
+
+    """
+    Waits until all entries are processed.
+    """
+    async def join(self) -> None:
+        await self._idle.wait()
+
+    """
+    Returns the number of unfinished (pending and leased) entries without a database query.
+    """
+    @property
+    def depth(self) -> int:
+        return self._unfinished
+
+    """
+    Returns the number of entries waiting to be processed.
+    """
+    def qsize(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM queue WHERE state = 'pending'").fetchone()[0]
+
+    """
+    Returns the number of entries per state.
+
+    Returns:
+    - dict: Number of pending, leased and failed entries.
+    """
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._connection.execute("SELECT state, COUNT(*) FROM queue GROUP BY state").fetchall()
+        counts = {"pending": 0, "leased": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    """
+    Returns the number of pending entries and the wait times per priority lane.
+
+    Returns:
+    - dict: Per lane the pending entries, the handed out entries and their average and maximum wait in seconds.
+    """
+    def laneStats(self) -> dict:
+        with self._lock:
+            pending = dict(self._connection.execute(
+                "SELECT lane, COUNT(*) FROM queue WHERE state = 'pending' GROUP BY lane"
+            ).fetchall())
+        return {
+            lane: {
+                "delay": delay,
+                "pending": pending.get(lane, 0),
+                "claimed": self._waits[lane]["claimed"],
+                "avg_wait": round(self._waits[lane]["total_wait"] / self._waits[lane]["claimed"], 3) if self._waits[lane]["claimed"] else None,
+                "max_wait": round(self._waits[lane]["max_wait"], 3)
+            }
+            for lane, delay in self.lanes.items()
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _added(self, count: int) -> None:
+        self._unfinished += count
+        self._idle.clear()
+        self._available.set()
+
+    def _finished(self) -> None:
+        self._unfinished = max(self._unfinished - 1, 0)
+        if self._unfinished == 0:
+            self._idle.set()
+
+    def _owned(self, queue_id: int, updated: bool, action: str) -> bool:
+        if not updated:
+            logging.warning(f"Could not {action} queue entry {queue_id}, its lease expired and it was handed out again")
+        return bool(updated)
+
+    def _lane(self, lane: str) -> str:
+        lane = lane or self.DEFAULT_LANE
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown priority lane '{lane}', expected one of {list(self.lanes)}")
+        return lane
+
+    def _insert(self, entries: list, lane: str) -> list:
+        now = time.time()
+        ids = []
+        with self._lock:
+            for entry in entries:
+                cursor = self._connection.execute(
+                    "INSERT INTO queue (payload, state, available, created, lane, deadline) VALUES (?, 'pending', ?, ?, ?, ?)",
+                    (json.dumps(entry), now, now, lane, now + self.lanes[lane])
+                )
+                ids.append(cursor.lastrowid)
+            self._connection.commit()
+        return ids
+
+    def _upsert(self, entry: dict, key: str, merge, lane: str) -> tuple:
+        now = time.time()
+        with self._lock:
+            pending = self._connection.execute(
+                "SELECT id, payload, lane, deadline FROM queue WHERE key = ? AND state = 'pending' ORDER BY id DESC LIMIT 1", (key,)
+            ).fetchone()
+            if pending is not None:
+                queue_id, payload, pendingLane, deadline = pending
+                merged = merge(json.loads(payload), entry) if merge else entry
+                if now + self.lanes[lane] < deadline:
+                    pendingLane, deadline = lane, now + self.lanes[lane]  # The new request is more urgent
+                self._connection.execute(
+                    "UPDATE queue SET payload = ?, lane = ?, deadline = ? WHERE id = ?",
+                    (json.dumps(merged), pendingLane, deadline, queue_id)
+                )
+                self._connection.commit()
+                return queue_id, "merged"
+
+            leased = self._connection.execute(
+                "SELECT 1 FROM queue WHERE key = ? AND state = 'leased'", (key,)
+            ).fetchone()
+            cursor = self._connection.execute(
+                "INSERT INTO queue (payload, state, available, created, key, lane, deadline) VALUES (?, 'pending', ?, ?, ?, ?, ?)",
+                (json.dumps(entry), now, now, key, lane, now + self.lanes[lane])
+            )
+            self._connection.commit()
+        return cursor.lastrowid, "deferred" if leased else "queued"
+
+    def _claim(self) -> dict:
+        now = time.time()
+        statement = (
+            "SELECT id, payload, attempts, lane, created FROM queue AS entry "
+            "WHERE ((state = 'pending' AND available <= ?) OR (state = 'leased' AND lease_until < ?)) "
+            "AND (key IS NULL OR NOT EXISTS ("
+            "SELECT 1 FROM queue AS other WHERE other.key = entry.key AND other.id != entry.id "
+            "AND other.state = 'leased' AND other.lease_until >= ?)) {lanes}"
+            "ORDER BY deadline, id LIMIT 1"
+        )
+        urgent = f"AND lane IN ({', '.join('?' for _ in self._urgent)}) "
+        with self._lock:
+            row = self._connection.execute(
+                statement.format(lanes=urgent), (now, now, now, *self._urgent)
+            ).fetchone()  # The most urgent lanes go first, aged work of the other lanes never overtakes them
+            if row is None:
+                row = self._connection.execute(statement.format(lanes=""), (now, now, now)).fetchone()
+            if row is None:
+                return None
+            queue_id, payload, attempts, lane, created = row
+            lease = uuid.uuid4().hex
+            self._connection.execute(
+                "UPDATE queue SET state = 'leased', lease_until = ?, lease_token = ?, attempts = attempts + 1 WHERE id = ?",
+                (now + self._lease, lease, queue_id)
+            )
+            self._connection.commit()
+        waits = self._waits.setdefault(lane, {"claimed": 0, "total_wait": 0.0, "max_wait": 0.0})
+        waits["claimed"] += 1
+        waits["total_wait"] += now - created
+        waits["max_wait"] = max(waits["max_wait"], now - created)
+        QUEUE_WAIT_SECONDS.observe(lane, value=now - created)
+        entry = json.loads(payload)
+        entry["queue_id"] = queue_id
+        entry["lane"] = lane
+        entry["lease"] = lease
+        entry["attempts"] = attempts + 1
+        return entry
+
+    def _release(self, queue_id: int, lease: str, error: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT attempts, lane FROM queue WHERE id = ? AND lease_token = ? AND state = 'leased'", (queue_id, lease)
+            ).fetchone()
+            if row is None:
+                return None  # The lease was lost
+            attempts, lane = row
+            if attempts >= self.max_attempts:
+                self._connection.execute(
+                    "UPDATE queue SET state = 'failed', lease_until = NULL, lease_token = NULL, error = ? WHERE id = ?", (error, queue_id)
+                )
+                retry = False
+            else:
+                available = time.time() + self._retry_delay * 2 ** (attempts - 1)
+                self._connection.execute(
+                    "UPDATE queue SET state = 'pending', lease_until = NULL, lease_token = NULL, available = ?, deadline = ?, error = ? "
+                    "WHERE id = ?",
+                    (available, available + self.lanes.get(lane, 0), error, queue_id)
+                )
+                retry = True
+            self._connection.commit()
+        return retry
+
+    def _execute(self, statement: str, parameters: tuple) -> int:
+        with self._lock:
+            rowcount = self._connection.execute(statement, parameters).rowcount
+            self._connection.commit()
+        return rowcount
@@ -0,0 +1,214 @@
+import time, random, asyncio, logging
+import aiohttp, httpx
+from ollama import ResponseError
+from pypaperless.exceptions import BadJsonResponseError # type: ignore
+from services.metrics import BACKEND_ERRORS
+
+"""
+Raised instead of calling a backend while its circuit breaker is open.
+"""
+class CircuitOpenError(ConnectionError):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is unavailable, retrying in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+"""
+Circuit breaker of one backend.
+
+After `failure_threshold` failed operations in a row the breaker opens and calls fail
+immediately with `CircuitOpenError`. After `reset_timeout` seconds a single trial call
+is let through (half-open), its success closes the breaker, its failure opens it again.
+
+Parameters:
+- name (str): Name of the backend, e.g. "paperless".
+- failure_threshold (int): Consecutive failures which open the breaker.
+- reset_timeout (float): Seconds the breaker stays open before a trial call.
+"""
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self.trips = 0
+        self.lastError = None
+        self._trial = False
+
+    """
+    Checks whether a call may be made and claims the trial call of a half-open breaker.
+
+    Raises:
+    - CircuitOpenError: If the breaker is open or the trial call is in flight.
+    """
+    def before(self) -> None:
+        if self.state == self.OPEN and self.retryIn() <= 0:
+            self.state = self.HALF_OPEN
+            self._trial = False
+            logging.info(f"Circuit breaker {self.name} is half-open, trying one call")
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trial):
+            raise CircuitOpenError(self.name, max(self.retryIn(), 1))
+        if self.state == self.HALF_OPEN:
+            self._trial = True
+
+    def recordSuccess(self) -> None:
+        if self.state != self.CLOSED:
+            logging.info(f"Circuit breaker {self.name} is closed again")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial = False
+
+    def recordFailure(self, error: Exception) -> None:
+        self.failures += 1
+        self.lastError = str(error)
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+                logging.warning(f"Circuit breaker {self.name} opened after {self.failures} failures: {error}")
+            self.state = self.OPEN
+            self.opened = time.monotonic()
+            self._trial = False
+
+    def abort(self) -> None:
+        self._trial = False
+
+    """
+    Returns the seconds until the open breaker lets a trial call through, 0 if calls are possible.
+    """
+    def retryIn(self) -> float:
+        if self.state == self.OPEN:
+            return max(self.opened + self.reset_timeout - time.monotonic(), 0.0)
+        if self.state == self.HALF_OPEN and self._trial:
+            return 1.0  # Wait for the result of the trial call
+        return 0.0
+
+    """
+    Waits until the breaker accepts calls again.
+    """
+    async def wait(self) -> None:
+        while (delay := self.retryIn()) > 0:
+            await asyncio.sleep(min(delay, 5.0))
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "retry_in": round(self.retryIn(), 1),
+            "last_error": self.lastError
+        }
+
+"""
+Deadline, retry and circuit breaker policy shared by all calls to one backend.
+
+Every attempt gets `timeout` seconds. Transient failures (timeouts, connection errors,
+HTTP 5xx and 429) are retried up to `retries` times with exponential backoff and full
+jitter, so many workers do not hit a recovering backend at the same moment. Only when
+all attempts failed the failure is counted by the circuit breaker. Other errors, e.g.
+a document which does not exist, are raised right away.
+
+Parameters:
+- name (str): Name of the backend.
+- timeout (float, optional): Seconds per attempt, None leaves the deadline to the operation.
+- retries (int): Retries after the first attempt.
+- base_delay (float): Backoff before the first retry in seconds.
+- max_delay (float): Upper bound of the backoff in seconds.
+- failure_threshold (int): See `CircuitBreaker`.
+- reset_timeout (float): See `CircuitBreaker`.
+"""
+class Resilience:
+    def __init__(self, name: str, timeout: float = 30.0, retries: int = 3, base_delay: float = 0.5, max_delay: float = 10.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.calls = 0
+        self.retried = 0
+        self.failed = 0
+
+    """
+    Runs an operation with deadline, retries and the circuit breaker.
+
+    Parameters:
+    - operation (callable): Coroutine function without arguments, called once per attempt.
+    - timeout (float, optional): Overrides the timeout per attempt.
+    - retries (int, optional): Overrides the number of retries.
+
+    Returns:
+    - The result of the operation.
+
+    Raises:
+    - CircuitOpenError: If the backend is known to be down.
+    - The error of the last attempt.
+    """
+    async def call(self, operation, timeout: float = None, retries: int = None):
+        timeout = timeout if timeout is not None else self.timeout
+        retries = retries if retries is not None else self.retries
+        self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before()
+            except CircuitOpenError:
+                BACKEND_ERRORS.inc(self.name, "circuit_open")
+                raise
+            try:
+                if timeout:
+                    result = await asyncio.wait_for(operation(), timeout)
+                else:
+                    result = await operation()
+            except asyncio.CancelledError:
+                self.breaker.abort()  # A cancelled trial call decides nothing
+                raise
+            except Exception as e:
+                if not isTransient(e):
+                    BACKEND_ERRORS.inc(self.name, "error")
+                    self.breaker.recordSuccess()  # The backend answered
+                    raise
+                BACKEND_ERRORS.inc(self.name, "timeout" if isinstance(e, asyncio.TimeoutError) else "transient")
+                if attempt >= retries or self.breaker.state != CircuitBreaker.CLOSED:
+                    self.failed += 1
+                    self.breaker.recordFailure(e)
+                    raise
+                attempt += 1
+                self.retried += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logging.warning(f"{self.name} call failed ({describeError(e)}), retry {attempt}/{retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.recordSuccess()
+            return result
+
+    def status(self) -> dict:
+        return dict(self.breaker.status(), calls=self.calls, retried=self.retried, failed=self.failed)
+
+"""
+Decides whether an error is worth a retry.
+
+Parameters:
+- error (Exception): The error of a backend call.
+
+Returns:
+- bool: True for timeouts, connection errors, HTTP 5xx and 429.
+"""
+def isTransient(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, aiohttp.ClientConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500 or error.status_code == 429
+    if isinstance(error, BadJsonResponseError) and error.args:
+        status = getattr(error.args[0], "status", 0)  # An error page of a proxy in front of Paperless
+        return status >= 500 or status == 429
+    return False
+
+def describeError(error: Exception) -> str:
+    return str(error) or type(error).__name__
@@ -0,0 +1,57 @@
+import logging
+
+"""
+Plausibility checks for the answers of the AI.
+
+The cheaper models of the model cascade do not report a usable confidence, so an
+answer is trusted if it passes these checks. Answers which fail them are escalated
+to the next, larger model.
+
+Parameters:
+- cache (callable, optional): Returns the metadata Cache (or None while Paperless is not connected).
+  Correspondent, document type and storage path have to be known names.
+- max_lengths (dict, optional): Maximum number of characters per field.
+"""
+class FieldValidator:
+    PLACEHOLDERS = {"", "unknown", "unbekannt", "n/a", "na", "none", "null", "-", "?", "not found", "no title"}
+    DEFAULT_MAX_LENGTH = 256
+    MAX_LENGTHS = {"title": 128}
+
+    def __init__(self, cache=None, max_lengths: dict = None):
+        self._cache = cache
+        self._max_lengths = {**self.MAX_LENGTHS, **(max_lengths or {})}
+
+    """
+    Checks a single answer.
+
+    Parameters:
+    - field (str): The name of the field.
+    - value: The answer of the model.
+
+    Returns:
+    - bool: True if the answer is plausible.
+    """
+    async def validate(self, field: str, value) -> bool:
+        if not isinstance(value, str):
+            return False
+        value = value.strip()
+        if value.strip(".").lower() in self.PLACEHOLDERS:
+            return False
+        if len(value) > self._max_lengths.get(field, self.DEFAULT_MAX_LENGTH):
+            return False
+
+        cache = self._cache() if self._cache else None
+        if cache is None:
+            return True
+        lookup = {
+            "correspondent": cache.getCorrespondantIDByName,
+            "document_type": cache.getTypeIDByName,
+            "storage_path": cache.getPathIDByName
+        }.get(field)
+        if lookup is None:
+            return True
+        try:
+            return await lookup(value) is not None
+        except Exception as e:
+            logging.debug(f"Could not check the {field} '{value}': {e}")
+            return True  # Do not escalate because Paperless is unavailable
@@ -0,0 +1,64 @@
+import pytest
+from services.admission import AdmissionController
+
+"""
+Tests the per-client rate limit.
+
+Expected Outcome:
+- A client may send `burst` requests at once, the next one is rejected with a wait time.
+- Other clients are not affected.
+"""
+def test_rate_limit():
+    admission = AdmissionController(rate=1, burst=2)
+    assert admission.admit("a", "webhook", 0)[0] is True
+    assert admission.admit("a", "webhook", 0)[0] is True
+
+    admitted, retry_after, reason = admission.admit("a", "webhook", 0)
+    assert (admitted, reason) == (False, "rate_limit")
+    assert retry_after >= 1
+    assert admission.admit("b", "webhook", 0)[0] is True
+
+"""
+Tests that lower priorities are shed first.
+
+Expected Outcome:
+- At 60% of the maximum depth bulk requests are rejected, webhook requests are still accepted.
+- A full queue rejects every request.
+"""
+def test_shedding():
+    admission = AdmissionController(max_depth=100, rate=0, shed={"bulk": 0.5, "webhook": 0.9})
+    assert admission.admit("a", "bulk", 60)[2] == "shed"
+    assert admission.admit("a", "webhook", 60)[0] is True
+    assert admission.admit("a", "interactive", 100)[2] == "queue_full"
+
+    status = admission.status()
+    assert status["rejected"] == {"shed": {"bulk": 1}, "queue_full": {"interactive": 1}}
+    assert status["admitted"] == 1
+
+"""
+Tests that a request refused because of the queue does not use up the rate of its client.
+
+Expected Outcome:
+- After a shed request the client can still send its full burst.
+"""
+def test_shed_keeps_rate():
+    admission = AdmissionController(max_depth=100, rate=1, burst=1, shed={"bulk": 0.5})
+    assert admission.admit("a", "bulk", 60)[2] == "shed"
+    assert admission.admit("a", "webhook", 60)[0] is True
+
+"""
+Tests that the buckets of the least recently seen clients are forgotten.
+
+Expected Outcome:
+- The number of buckets never exceeds MAX_CLIENTS, an active client keeps its bucket.
+"""
+def test_client_eviction():
+    admission = AdmissionController(rate=1, burst=1)
+    admission.MAX_CLIENTS = 3
+    admission.admit("active", "webhook", 0)
+    for client in range(10):
+        admission.admit(f"client {client}", "webhook", 0)
+        admission.admit("active", "webhook", 0)  # Seen again, rejected by its rate limit
+
+    assert admission.status()["clients"] == 3
+    assert admission.admit("active", "webhook", 0)[2] == "rate_limit"
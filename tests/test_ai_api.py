@@ -1,6 +1,6 @@
-import json, logging, pytest
-from unittest.mock import patch, MagicMock
-from services.ai_api import AI  # Import AI class for testing
+import json, asyncio, logging, pytest, httpx
+from unittest.mock import patch, AsyncMock
+from services.ai_api import AI, OllamaPool  # Import AI classes for testing
 
 # Initialize a logger for testing
 logger = logging.getLogger("test_logger")
@@ -27,12 +27,13 @@ Scenario:
 Expected Outcome:
 - The method returns the extracted value from the mock response.
 """
-def test_getResponse(ai_instance):
+@pytest.mark.asyncio
+async def test_getResponse(ai_instance):
     mock_response = {"message": {"content": json.dumps({"info": "Extracted Data"})}}
 
     # Mocking the AI chat response
-    with patch("services.ai_api.chat", return_value=mock_response):
-        response = ai_instance.getResponse("Test content", "Extract data")
+    with patch.object(ai_instance._pool.backends[0].client, "chat", new_callable=AsyncMock, return_value=mock_response):
+        response = await ai_instance.getResponse("Test content", "Extract data")
 
         # Ensuring the extracted info is correctly returned
         assert response == "Extracted Data"
@@ -49,13 +50,14 @@ Scenario:
 Expected Outcome:
 - The method raises a JSONDecodeError.
 """
-def test_getResponse_invalid_json(ai_instance):
+@pytest.mark.asyncio
+async def test_getResponse_invalid_json(ai_instance):
     mock_response = {"message": {"content": "Invalid JSON"}}
 
     # Mocking the AI response with invalid JSON
-    with patch("services.ai_api.chat", return_value=mock_response):
+    with patch.object(ai_instance._pool.backends[0].client, "chat", new_callable=AsyncMock, return_value=mock_response):
         with pytest.raises(json.JSONDecodeError):
-            ai_instance.getResponse("Test content", "Extract data")
+            await ai_instance.getResponse("Test content", "Extract data")
 
 """
 Tests the `selfCheck` method when the model loads successfully.
@@ -64,19 +66,273 @@ Parameters:
 - ai_instance (AI): The AI instance being tested.
 
 Scenario:
-- The model is successfully pulled and responds to a test message.
+- The model is successfully pulled and loaded.
 
 Expected Outcome:
 - The method returns True if the model loads successfully.
+- The load time reported by Ollama is recorded.
 """
-def test_selfCheck_success(ai_instance):
-    mock_pull_response = [{"status": "pulling manifest"}, {"status": "complete"}]
-    mock_chat_response = {"message": {"content": "Hello Gemma"}}
+@pytest.mark.asyncio
+async def test_selfCheck_success(ai_instance):
+    async def mock_pull_response():
+        for progress in [{"status": "pulling manifest"}, {"status": "complete"}]:
+            yield progress
+    mock_generate_response = {"response": "", "load_duration": 2_000_000_000}
 
-    # Mocking successful pull and chat response
-    with patch("services.ai_api.pull", return_value=mock_pull_response), \
-         patch("services.ai_api.ps", return_value=MagicMock()), \
-         patch("services.ai_api.chat", return_value=mock_chat_response):
+    # Mocking successful pull and model load
+    with patch.object(ai_instance._pool.backends[0].client, "pull", new_callable=AsyncMock, return_value=mock_pull_response()), \
+         patch.object(ai_instance._pool.backends[0].client, "generate", new_callable=AsyncMock, return_value=mock_generate_response):
 
         # Ensuring a successful model check returns True
-        assert ai_instance.selfCheck() is True
\ No newline at end of file
+        assert await ai_instance.selfCheck() is True
+
+        # Ensuring the load was recorded
+        stats = ai_instance._pool.backends[0].residency["test_model"]
+        assert stats["loaded"] is True
+        assert stats["loads"] == 1
+        assert stats["last_load_duration"] == 2.0
+
+"""
+Tests that `getResponse` gives up when the model does not answer in time.
+
+Parameters:
+- ai_instance (AI): The AI instance being tested.
+
+Scenario:
+- The chat call takes longer than the per-call timeout.
+
+Expected Outcome:
+- The method raises an asyncio.TimeoutError instead of blocking forever.
+"""
+@pytest.mark.asyncio
+async def test_getResponse_timeout(ai_instance):
+    async def slow_chat(*args, **kwargs):
+        await asyncio.sleep(1)
+
+    with patch.object(ai_instance._pool.backends[0].client, "chat", side_effect=slow_chat):
+        with pytest.raises(asyncio.TimeoutError):
+            await ai_instance.getResponse("Test content", "Extract data", timeout=0.01)
+"""
+Tests that `getResponses` extracts several fields with a single inference.
+
+Parameters:
+- ai_instance (AI): The AI instance being tested.
+
+Scenario:
+- Two fields are requested at once.
+
+Expected Outcome:
+- The chat is called exactly once with a schema containing both fields.
+- Both extracted values are returned.
+"""
+@pytest.mark.asyncio
+async def test_getResponses_single_pass():
+    ai_instance = AI(model="test_model", logger=logger, datafields=["title", "summary"])
+    mock_response = {"message": {"content": json.dumps({"title": "Invoice", "summary": "An invoice"})}}
+
+    with patch.object(ai_instance._pool.backends[0].client, "chat", new_callable=AsyncMock, return_value=mock_response) as mock_chat:
+        response = await ai_instance.getResponses("Test content", {"title": "Get the title", "summary": "Summarize"})
+
+        assert response == {"title": "Invoice", "summary": "An invoice"}
+        mock_chat.assert_awaited_once()
+        schema = mock_chat.call_args.kwargs["format"]
+        assert set(schema["required"]) == {"title", "summary"}
+
+"""
+Tests that long documents are analyzed in chunks and the partial answers are combined.
+
+Scenario:
+- The content is longer than the token budget of the mapreduce strategy.
+
+Expected Outcome:
+- One inference per chunk plus one combining inference is run.
+- The answer of the combining inference is returned.
+"""
+@pytest.mark.asyncio
+async def test_getResponses_mapreduce():
+    ai_instance = AI(model="test_model", logger=logger, datafields=["summary"], default_strategy="mapreduce:100", parallelism=2)
+    mock_response = {"message": {"content": json.dumps({"summary": "Combined"})}}
+
+    with patch.object(ai_instance._pool.backends[0].client, "chat", new_callable=AsyncMock, return_value=mock_response) as mock_chat:
+        response = await ai_instance.getResponses("text " * 200, {"summary": "Summarize"})
+
+        assert response == {"summary": "Combined"}
+        assert mock_chat.await_count == 4  # Three chunks and the combining call
+
+"""
+Tests that unloading a model is recorded.
+
+Parameters:
+- ai_instance (AI): The AI instance being tested.
+
+Expected Outcome:
+- The model is requested with keep_alive=0 and marked as not loaded.
+"""
+@pytest.mark.asyncio
+async def test_unloadModel(ai_instance):
+    with patch.object(ai_instance._pool.backends[0].client, "generate", new_callable=AsyncMock, return_value={"response": ""}) as mock_generate:
+        await ai_instance.loadModel()
+        await ai_instance.unloadModel()
+
+        assert mock_generate.call_args.kwargs["keep_alive"] == 0
+        stats = ai_instance._pool.backends[0].residency["test_model"]
+        assert stats["loaded"] is False
+        assert stats["unloads"] == 1
+
+"""
+Tests that switching the cascade unloads only the models which are not used anymore.
+
+Expected Outcome:
+- The dropped cheap model is unloaded, the model which is still used stays loaded.
+"""
+@pytest.mark.asyncio
+async def test_releaseModels():
+    previous = AI(model="big_model", logger=logger, cascade=["small_model"])
+    replacement = AI(model="big_model", logger=logger)
+    with patch.object(previous._pool.backends[0].client, "generate", new_callable=AsyncMock, return_value={"response": ""}) as mock_generate:
+        await previous.releaseModels(keep=replacement.models)
+
+    mock_generate.assert_awaited_once()
+    assert mock_generate.call_args.args[0] == "small_model"
+    assert previous._pool.backends[0].residency["small_model"]["unloads"] == 1
+    assert "big_model" not in previous._pool.backends[0].residency
+
+"""
+Tests that the pool routes a request to the least loaded healthy host.
+
+Scenario:
+- Three hosts, the first is busy and the second is unhealthy.
+
+Expected Outcome:
+- The request is sent to the third host.
+"""
+@pytest.mark.asyncio
+async def test_pool_least_loaded():
+    pool = OllamaPool("http://gpu1:11434, http://gpu2:11434,http://gpu3:11434", logger)
+    pool.backends[0].inflight = 2
+    pool.backends[1].healthy = False
+
+    async def operation(backend):
+        return backend.host
+
+    assert await pool.call(operation, timeout=1) == "http://gpu3:11434"
+    assert pool.backends[2].requests == 1
+    await pool.close()
+
+"""
+Tests that a request fails over to the next host if a host is unreachable.
+
+Scenario:
+- The first chosen host raises a connection error.
+
+Expected Outcome:
+- The host is marked unhealthy and the request succeeds on the other host.
+"""
+@pytest.mark.asyncio
+async def test_pool_failover():
+    pool = OllamaPool(["http://gpu1:11434", "http://gpu2:11434"], logger)
+
+    async def operation(backend):
+        if backend.host == "http://gpu1:11434":
+            raise httpx.ConnectError("unreachable")
+        return backend.host
+
+    assert await pool.call(operation, timeout=1) == "http://gpu2:11434"
+    assert pool.backends[0].healthy is False
+    assert pool.backends[0].failures == 1
+    await pool.close()
+
+"""
+Tests that a streamed answer is stopped as soon as all fields are complete.
+
+Scenario:
+- The model keeps generating after the requested field is complete.
+
+Expected Outcome:
+- The stream is closed early and the complete value is returned.
+- Time to first token and the early stop are recorded.
+"""
+@pytest.mark.asyncio
+async def test_getResponses_streaming_early_stop():
+    ai_instance = AI(model="test_model", logger=logger, datafields=["title"], stream=True)
+    consumed = []
+
+    async def mock_stream():
+        for text in ['{"title', '": "Inv', 'oice"', ', "rambling": "', 'a' * 10, 'a' * 10, '"}']:
+            consumed.append(text)
+            yield {"message": {"content": text}, "done": False}
+
+    with patch.object(ai_instance._pool.backends[0].client, "chat", new_callable=AsyncMock, return_value=mock_stream()) as mock_chat:
+        response = await ai_instance.getResponses("Test content", {"title": "Get the title"})
+
+        assert response == {"title": "Invoice"}
+        assert len(consumed) == 3
+        assert mock_chat.call_args.kwargs["options"]["num_predict"] > 0
+        stats = ai_instance.inferenceStats()
+        assert stats["calls"] == 1
+        assert stats["early_stops"] == 1
+        assert stats["avg_ttft"] is not None
+
+"""
+Tests that only rejected fields are escalated from the cheap model to the main model.
+
+Scenario:
+- The cheap model answers the title correctly but the summary with a placeholder.
+
+Expected Outcome:
+- The summary alone is asked again with the main model.
+- The tier statistics count one accepted and one escalated field for the cheap model.
+"""
+@pytest.mark.asyncio
+async def test_getResponses_cascade():
+    from services.validation import FieldValidator
+    ai_instance = AI(model="big_model", logger=logger, datafields=["title", "summary"], cascade=["small_model"], validator=FieldValidator())
+
+    async def chat(model, **kwargs):
+        if model == "small_model":
+            return {"message": {"content": json.dumps({"title": "Invoice", "summary": "unknown"})}}
+        return {"message": {"content": json.dumps({"summary": "An invoice"})}}
+
+    with patch.object(ai_instance._pool.backends[0].client, "chat", side_effect=chat) as mock_chat:
+        response = await ai_instance.getResponses("Test content", {"title": "Get the title", "summary": "Summarize"})
+
+        assert response == {"title": "Invoice", "summary": "An invoice"}
+        assert [call.args[0] for call in mock_chat.call_args_list] == ["small_model", "big_model"]
+        assert mock_chat.call_args.kwargs["format"]["required"] == ["summary"]
+        tiers = ai_instance.inferenceStats()["tiers"]
+        assert tiers["small_model"]["accepted"] == 1 and tiers["small_model"]["escalated"] == 1
+        assert tiers["big_model"]["hit_rate"] == 1.0
+
+"""
+Tests that closing the AI stops a model load which is still running in the background.
+
+Expected Outcome:
+- The keep-warm task and the warm-up task are cancelled.
+"""
+@pytest.mark.asyncio
+async def test_close_cancels_warm(ai_instance):
+    ai_instance._keepWarmTask = asyncio.create_task(asyncio.sleep(10))
+    ai_instance._warmTask = warm = asyncio.create_task(asyncio.sleep(10))
+    keepWarm = ai_instance._keepWarmTask
+
+    await ai_instance.close()
+    await asyncio.gather(keepWarm, warm, return_exceptions=True)
+
+    assert keepWarm.cancelled() and warm.cancelled()
+    assert ai_instance._warmTask is None and ai_instance._keepWarmTask is None
+
+"""
+Tests that embeddings run through the resilience layer of Ollama like the chat calls.
+
+Expected Outcome:
+- A transient failure is retried and the circuit breaker records the successful call.
+"""
+@pytest.mark.asyncio
+async def test_embed_resilience():
+    from services.resilience import Resilience
+    resilience = Resilience("ollama", None, retries=1, base_delay=0.01)
+    ai_instance = AI(model="test_model", logger=logger, resilience=resilience)
+    responses = [httpx.ConnectError("Connection refused"), {"embeddings": [[1.0, 0.0]]}]
+    with patch.object(ai_instance._pool.backends[0].client, "embed", new_callable=AsyncMock, side_effect=responses):
+        assert await ai_instance.embed(["text"], "embed-model") == [[1.0, 0.0]]
+    assert resilience.calls == 1 and resilience.retried == 1
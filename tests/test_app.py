@@ -1,6 +1,6 @@
 import asyncio, pytest, sys, os
 from unittest.mock import AsyncMock, MagicMock, patch
-from app import app, main, stopServer, background_task, init_before_serving  # Consolidated imports
+from app import app, main, stopServer, drainWorkers, background_task, acknowledgeTagged, init_before_serving  # Consolidated imports
 
 # Ensure the app's root directory is in the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -47,7 +47,8 @@ Expected Outcome:
 async def test_stopServer():
     from app import shutdown_event  # Import the global shutdown event variable
 
-    with patch("sys.exit") as mock_exit, patch("app.logging.info") as mock_log:
+    with patch("sys.exit") as mock_exit, patch("app.logging.info") as mock_log, \
+         patch.dict(app.config, {"WORKER_TASKS": None, "WORKERS": {}, "BACKFILL": None, "TAG_BATCHER": None}):
         shutdown_event.clear()  # Ensure the event is not set before execution
         task = asyncio.create_task(stopServer())  # Start stopServer as an asynchronous task
         await asyncio.sleep(1.1)  # Wait slightly longer than the delay in stopServer
@@ -57,40 +58,301 @@ async def test_stopServer():
         assert shutdown_event.is_set(), "shutdown_event was not set"
 
         # Ensure a log message confirms the shutdown process
-        mock_log.assert_called_with("Server is shutting down...")
+        mock_log.assert_any_call("Server is shutting down...")
 
         # Verify that the process exits with code 0
         mock_exit.assert_called_once_with(0)
+    shutdown_event.clear()
 
 """
 Tests whether the pre-server initialization completes successfully.
 
 Scenario:
-- The application should verify its configuration and initialize required services.
+- The application should start its background services without waiting for the connections.
 
 Expected Outcome:
-- The configuration check function is called once.
-- The paperless API is properly initialized.
-- A background task is created.
+- The connection initialization is started once.
+- One background task per worker is created.
 - A log entry confirms successful initialization.
 """
 @pytest.mark.asyncio
 async def test_init_before_serving():
-    with patch("app.config.checkConfig") as mock_check, \
+    with patch("app.config.initializeConnections", new_callable=AsyncMock) as mock_connect, \
          patch("app.logging.info") as mock_log, \
          patch("asyncio.create_task") as mock_create_task, \
-         patch.dict(app.config, {"PAPERLESS_API": AsyncMock()}):  # Use AsyncMock for async operations
+         patch.dict(app.config, {"PAPERLESS_API": AsyncMock(), "WORKER_TASKS": None, "WORKER_COUNT": 3}):  # Use AsyncMock for async operations
 
         await init_before_serving()
 
-        # Ensure the configuration check function was called
-        mock_check.assert_called_once_with(app)
+        # Ensure the connections are started in the background
+        mock_connect.assert_awaited_once_with(app)
 
-        # Ensure the paperless API initialization was awaited
-        await app.config["PAPERLESS_API"].initialize()
-
-        # Verify that a background task was created
-        mock_create_task.assert_called_once()
+        # Verify that the workers were started
+        assert mock_create_task.call_count == 3
 
         # Ensure a log message confirms the pre-server initialization
-        mock_log.assert_any_call("Pre-server initialization complete.")
\ No newline at end of file
+        mock_log.assert_any_call("Pre-server initialization complete.")
+
+"""
+Tests the readiness probe while the connections are still being established.
+
+Expected Outcome:
+- The liveness probe succeeds.
+- The readiness probe answers with 503 until both connections are ready, then with 200.
+"""
+@pytest.mark.asyncio
+async def test_readiness():
+    with patch.dict(app.config, {"AI_READY": asyncio.Event(), "PAPERLESS_READY": asyncio.Event()}):
+        client = app.test_client()
+        assert (await client.get("/status/live")).status_code == 200
+        assert (await client.get("/status/ready")).status_code == 503
+
+        app.config["AI_READY"].set()
+        app.config["PAPERLESS_READY"].set()
+        response = await client.get("/status/ready")
+        assert response.status_code == 200
+        assert (await response.get_json())["ready"] is True
+
+"""
+Tests that the worker status reads the queue off the event loop.
+
+Scenario:
+- The queue statistics are SQLite queries which may wait for a WAL checkpoint.
+
+Expected Outcome:
+- The queue length, states and lane statistics are reported.
+- All three queries run in a worker thread, not in the thread of the event loop.
+"""
+@pytest.mark.asyncio
+async def test_worker_status_off_loop():
+    import threading
+    loop_thread = threading.get_ident()
+    threads = []
+    queue = MagicMock()
+    queue.qsize.side_effect = lambda: threads.append(threading.get_ident()) or 2
+    queue.stats.side_effect = lambda: threads.append(threading.get_ident()) or {"pending": 2, "leased": 0, "failed": 0}
+    queue.laneStats.side_effect = lambda: threads.append(threading.get_ident()) or {}
+    with patch.dict(app.config, {"REQUEST_QUEUE": queue, "TAG_BATCHER": None, "WORKERS": {},
+                                 "INFERENCE_CONCURRENCY": 2, "INFERENCE_SLOTS": asyncio.Semaphore(2),
+                                 "PAPERLESS_CONCURRENCY": 4, "PAPERLESS_SLOTS": asyncio.Semaphore(4)}):
+        response = await app.test_client().get("/status/workers")
+
+    assert response.status_code == 200
+    data = await response.get_json()
+    assert data["queued"] == 2 and data["queue"]["pending"] == 2
+    assert len(threads) == 3 and loop_thread not in threads
+
+"""
+Tests that several workers process queue entries concurrently.
+
+Scenario:
+- Three entries are queued and processing an entry blocks until all three have started.
+
+Expected Outcome:
+- All entries are processed by different workers and counted as processed.
+"""
+@pytest.mark.asyncio
+async def test_workers_concurrent(tmp_path):
+    from services.queue import PersistentQueue
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    started = []
+    release = asyncio.Event()
+
+    async def process(entry, worker):
+        started.append(entry["doc_id"])
+        if len(started) == 3:
+            release.set()
+        await release.wait()
+        return True
+
+    ready = asyncio.Event()
+    ready.set()
+    with patch("app.process_queue", side_effect=process), \
+         patch.dict(app.config, {"AI_READY": ready, "PAPERLESS_READY": ready, "AI_API": MagicMock(), "WORKERS": {},
+                                 "REQUEST_QUEUE": request_queue}):
+        workers = [asyncio.create_task(background_task(worker_id)) for worker_id in range(3)]
+        for doc_id in (1, 2, 3):
+            await request_queue.put({"doc_id": doc_id})
+        await asyncio.wait_for(request_queue.join(), 1)
+
+        assert sorted(started) == [1, 2, 3]
+        assert sum(worker["processed"] for worker in app.config["WORKERS"].values()) == 3
+        assert request_queue.stats() == {"pending": 0, "leased": 0, "failed": 0}
+        for worker in workers:
+            worker.cancel()
+
+"""
+Tests that a webhook is stored as a compact queue entry.
+
+Scenario:
+- A webhook arrives while Paperless is still connecting.
+
+Expected Outcome:
+- The request is accepted and the queue entry only holds the document id, the fields, the tag and timestamps.
+"""
+@pytest.mark.asyncio
+async def test_webhook_compact_entry(tmp_path):
+    from services.queue import PersistentQueue
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    with patch.dict(app.config, {"PAPERLESS_READY": asyncio.Event(), "REQUEST_QUEUE": request_queue, "AI_API": None}):
+        client = app.test_client()
+        response = await client.post("/ai/request", json={"url": "http://paperless/documents/42/", "tag": "ai", "title": "Get the title"})
+        assert response.status_code == 202
+
+        entry = await request_queue.get()
+        assert entry["doc_id"] == 42
+        assert set(entry) == {"doc_id", "client_ip", "fields", "tag", "bypass_cache", "received", "queue_id", "lane", "lease", "attempts"}
+
+"""
+Tests the drain of the workers during the shutdown.
+
+Scenario:
+- One worker finishes its entry quickly, the other one hangs beyond the timeout.
+
+Expected Outcome:
+- The finished entry is acknowledged, the hanging entry is counted as abandoned and
+  returned to the queue without using up an attempt.
+"""
+@pytest.mark.asyncio
+async def test_drain_workers(tmp_path):
+    from services.queue import PersistentQueue
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    started = []
+
+    async def process(entry, worker):
+        started.append(entry["doc_id"])
+        if entry["doc_id"] == 1:
+            await asyncio.sleep(0.05)
+            return True
+        await asyncio.sleep(10)
+
+    ready = asyncio.Event()
+    ready.set()
+    with patch("app.process_queue", side_effect=process), patch("app.shutdown_event", asyncio.Event()) as shutdown, \
+         patch.dict(app.config, {"AI_READY": ready, "PAPERLESS_READY": ready, "AI_API": MagicMock(), "WORKERS": {},
+                                 "REQUEST_QUEUE": request_queue}):
+        app.config["WORKER_TASKS"] = [asyncio.create_task(background_task(worker_id)) for worker_id in range(2)]
+        for doc_id in (1, 2):
+            await request_queue.put({"doc_id": doc_id})
+        while len(started) < 2:
+            await asyncio.sleep(0.01)
+
+        shutdown.set()
+        assert await drainWorkers(0.3) == 1
+        assert all(task.done() for task in app.config["WORKER_TASKS"])
+        app.config["WORKER_TASKS"] = None
+
+        assert request_queue.stats() == {"pending": 1, "leased": 0, "failed": 0}
+        entry = await request_queue.get()
+        assert (entry["doc_id"], entry["attempts"]) == (2, 1)
+
+"""
+Tests that an entry whose buffered tags could not be written is not acknowledged.
+
+Expected Outcome:
+- An entry is acknowledged once its tags are written.
+- An entry whose tags failed is returned to the queue and processed again.
+"""
+@pytest.mark.asyncio
+async def test_acknowledge_tagged(tmp_path):
+    from services.queue import PersistentQueue
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"), retry_delay=0)
+    await request_queue.putMany([{"doc_id": 1}, {"doc_id": 2}])
+    written, failed = await request_queue.get(), await request_queue.get()
+
+    tagging = [asyncio.get_running_loop().create_future() for _ in range(2)]
+    tasks = [asyncio.create_task(acknowledgeTagged(request_queue, entry["queue_id"], entry["lease"], future))
+             for entry, future in zip((written, failed), tagging)]
+    await asyncio.sleep(0.01)
+    assert request_queue.stats()["leased"] == 2  # Held until the tags are written
+
+    tagging[0].set_result(True)
+    tagging[1].set_exception(RuntimeError("Tagging of document 2 failed"))
+    await asyncio.gather(*tasks)
+
+    assert request_queue.stats() == {"pending": 1, "leased": 0, "failed": 0}
+    entry = await asyncio.wait_for(request_queue.get(), 2)
+    assert (entry["doc_id"], entry["attempts"]) == (2, 2)
+
+"""
+Tests that the inbox search runs through the resilience layer of Paperless page by page.
+
+Scenario:
+- Paperless does not report the "all" ids, the second page fails once with a connection error.
+
+Expected Outcome:
+- Only the ids are requested, the failed page is retried on its own and every inbox document is listed once.
+"""
+@pytest.mark.asyncio
+async def test_inbox_list_retry():
+    from services.resilience import Resilience
+    requests = []
+
+    async def request_json(method, path, params=None):
+        requests.append(dict(params))
+        number = params.get("page", 1)
+        if number == 2 and sum(1 for request in requests if request.get("page") == 2) == 1:
+            raise ConnectionError("Connection reset")
+        ids = [1, 2, 3][(number - 1) * 2:number * 2] if params["page_size"] > 1 else [1]
+        return {"count": 3, "next": "more" if number == 1 and params["page_size"] > 1 else None, "results": [{"id": doc_id} for doc_id in ids]}
+
+    api = MagicMock(is_initialized=True)
+    api.request_json = AsyncMock(side_effect=request_json)
+    with patch.dict(app.config, {"PAPERLESS_API": api, "PAPERLESS_RESILIENCE": Resilience("paperless", base_delay=0.01), "INBOX_TAG": "Inbox"}):
+        response = await app.test_client().get("/doc/list_inbox")
+
+    assert response.status_code == 200
+    assert await response.get_json() == [1, 2, 3]
+    assert all(request["query"] == "tag:Inbox" and request["fields"] == "id" for request in requests)
+    assert [request.get("page") for request in requests] == [None, 1, 2, 2]
+
+"""
+Tests that a document which failed on its last attempt gets the error tag without being fetched again.
+
+Expected Outcome:
+- The document is fetched once, the error tag is added with a single PATCH.
+"""
+@pytest.mark.asyncio
+async def test_process_queue_error_tag():
+    from types import SimpleNamespace
+    from routes.processing import process_queue
+    from services.resilience import Resilience
+    api = MagicMock()
+    api.documents = AsyncMock(return_value=SimpleNamespace(id=7, title="Old", tags=[1], content="text", modified=None))
+    api.request_json = AsyncMock(return_value={"id": 7})
+    ai = MagicMock()
+    ai.getResponses = AsyncMock(side_effect=ValueError("Invalid answer"))
+    cache = MagicMock()
+    cache.getTagIDsByName = AsyncMock(return_value=[9])
+    with patch.dict(app.config, {"PAPERLESS_API": api, "AI_API": ai, "CACHE": cache, "PAPERLESS_RESILIENCE": Resilience("paperless"),
+                                 "PAPERLESS_SLOTS": asyncio.Semaphore(1), "INFERENCE_SLOTS": asyncio.Semaphore(1),
+                                 "ERROR_TAG": "ai-error", "EXTRACTION_MODE": "combined"}):
+        async with app.app_context():
+            assert await process_queue({"doc_id": 7, "fields": [{"title": "Get the title"}], "last_attempt": True}) is False
+
+    api.documents.assert_awaited_once_with(7)
+    api.request_json.assert_awaited_once()
+    assert api.request_json.call_args.kwargs["json"] == {"tags": [1, 9]}
+
+"""
+Tests that invalid bulk edit payloads are rejected with the offending entry.
+
+Expected Outcome:
+- Non-numeric document ids, tag lists which are not lists of names and invalid field values are answered with 400.
+- Nothing is sent to Paperless.
+"""
+@pytest.mark.asyncio
+async def test_bulk_validation():
+    editor = MagicMock()
+    editor.run = AsyncMock(return_value={})
+    cache = MagicMock()
+    cache.getTagIDsByName = AsyncMock(return_value=[])
+    with patch.dict(app.config, {"CACHE": cache, "BULK_EDITOR": editor}):
+        client = app.test_client()
+        for operation, entry in (({"documents": [1, "abc"]}, "abc"), ({"documents": "1,2"}, "1,2"),
+                                 ({"documents": [1], "add_tags": "inbox"}, "inbox"), ({"documents": [1], "remove_tags": [5]}, 5),
+                                 ({"documents": [1], "correspondent": 3}, 3)):
+            response = await client.post("/doc/bulk", json={"operations": [operation]})
+            assert response.status_code == 400
+            assert (await response.get_json())["entry"] == entry
+    editor.run.assert_not_awaited()
@@ -0,0 +1,112 @@
+import asyncio, json, pytest
+from unittest.mock import MagicMock, AsyncMock
+from services.backfill import Backfill
+from services.queue import PersistentQueue
+
+"""
+Provides a Paperless mock with the documents 1 to 5, a full text query returns them by relevance.
+"""
+@pytest.fixture
+def paperless():
+    async def request_json(method, path, params=None):
+        ids = [4, 2, 5, 1, 3] if params.get("query") else [1, 2, 3, 4, 5]
+        page = ids[:params["page_size"]]
+        return {"count": len(ids), "all": ids, "next": "more" if len(ids) > len(page) else None, "results": [{"id": doc_id} for doc_id in page]}
+
+    api = MagicMock()
+    api.request_json = AsyncMock(side_effect=request_json)
+    return api
+
+"""
+Tests that a backfill queues every matching document in the bulk lane and writes a checkpoint.
+
+Expected Outcome:
+- All five documents are queued in the order of the query result with the fields of the request.
+- The ids are resolved with a single request.
+- The resolved ids are written to the id file once, the checkpoint only holds the position and the finished state.
+"""
+@pytest.mark.asyncio
+async def test_backfill(tmp_path, paperless):
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    backfill = Backfill(paperless, request_queue, str(tmp_path / "backfill.json"), rate=0, page_size=2)
+
+    await backfill.start({"fields": [{"title": "Get the title"}], "tag": None}, query="invoice")
+    await asyncio.wait_for(backfill._task, 1)
+
+    assert request_queue.laneStats()["bulk"]["pending"] == 5
+    entry = await request_queue.get()
+    assert entry["doc_id"] == 4 and entry["fields"] == [{"title": "Get the title"}]
+    assert paperless.request_json.await_count == 1
+    assert paperless.request_json.call_args.kwargs["params"]["query"] == "invoice"
+
+    progress = backfill.progress()
+    assert progress["state"] == "finished"
+    assert progress["queued"] == 5
+    with open(tmp_path / "backfill.json") as file:
+        checkpoint = json.load(file)
+    assert "ids" not in checkpoint and checkpoint["index"] == 5 and checkpoint["resolved"] is True
+    with open(tmp_path / "backfill.ids.json") as file:
+        assert json.load(file) == [4, 2, 5, 1, 3]
+
+"""
+Tests that an interrupted backfill continues after the last checkpoint.
+
+Expected Outcome:
+- Only the documents after the checkpointed position are queued, in the stored order.
+"""
+@pytest.mark.asyncio
+async def test_backfill_resume(tmp_path, paperless):
+    path = tmp_path / "backfill.json"
+    (tmp_path / "backfill.ids.json").write_text(json.dumps([4, 2, 5, 1, 3]))
+    path.write_text(json.dumps({
+        "state": "running", "query": None, "filters": {}, "request": {"fields": [{"title": "t"}]}, "rate": 0,
+        "resolved": True, "index": 3, "cursor": 1, "total": 5, "queued": 3, "merged": 0, "started": 0, "finished": None, "error": None
+    }))
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    backfill = Backfill(paperless, request_queue, str(path), page_size=2)
+
+    assert backfill.resumeInterrupted() is True
+    await asyncio.wait_for(backfill._task, 1)
+
+    assert request_queue.qsize() == 2
+    assert [(await request_queue.get())["doc_id"] for _ in range(2)] == [1, 3]
+    assert paperless.request_json.await_count == 0
+    assert backfill.progress()["queued"] == 5
+
+"""
+Tests that a checkpoint with an id cursor of an older version continues after that id.
+
+Expected Outcome:
+- The ids are resolved and only the documents after the cursor are queued.
+"""
+@pytest.mark.asyncio
+async def test_backfill_resume_cursor(tmp_path, paperless):
+    path = tmp_path / "backfill.json"
+    path.write_text(json.dumps({
+        "state": "running", "query": None, "filters": {}, "request": {"fields": [{"title": "t"}]}, "rate": 0,
+        "cursor": 3, "total": 5, "queued": 3, "merged": 0, "started": 0, "finished": None, "error": None
+    }))
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    backfill = Backfill(paperless, request_queue, str(path), page_size=2)
+
+    assert backfill.resumeInterrupted() is True
+    await asyncio.wait_for(backfill._task, 1)
+
+    assert request_queue.qsize() == 2
+    assert backfill.progress()["queued"] == 5
+
+"""
+Tests that an invalid rate is rejected before the backfill is accepted.
+
+Expected Outcome:
+- Zero, negative and non-numeric rates raise ValueError and no backfill is started.
+"""
+@pytest.mark.asyncio
+async def test_backfill_rate(tmp_path, paperless):
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"))
+    backfill = Backfill(paperless, request_queue, str(tmp_path / "backfill.json"))
+
+    for rate in (0, -1, "fast", [5]):
+        with pytest.raises(ValueError):
+            await backfill.start({"fields": [{"title": "t"}]}, rate=rate)
+    assert backfill.job is None
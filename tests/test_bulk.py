@@ -0,0 +1,85 @@
+import asyncio, pytest
+from unittest.mock import MagicMock, AsyncMock
+from services.bulk import BulkEditor, TagBatcher
+
+def paperless(fail: bool = False):
+    api = MagicMock()
+    api.request_json = AsyncMock(side_effect=Exception("Bad Request") if fail else None, return_value="OK")
+    return api
+
+"""
+Tests that operations are grouped by kind and sent in chunks.
+
+Scenario:
+- Three documents get the same tags, two of them also a document type. The chunk size is two.
+
+Expected Outcome:
+- Two modify_tags requests (chunks of two and one) and one set_document_type request are sent.
+- Every document is reported as successful.
+"""
+@pytest.mark.asyncio
+async def test_bulk_group_chunks():
+    api = paperless()
+    editor = BulkEditor(api, chunk_size=2)
+    results = await editor.run([
+        {"documents": [1, 2], "add_tags": [5], "remove_tags": [6], "document_type": 3},
+        {"documents": [3], "add_tags": [5], "remove_tags": [6]}
+    ])
+
+    calls = [call.kwargs["json"] for call in api.request_json.call_args_list]
+    assert [call["method"] for call in calls] == ["modify_tags", "modify_tags", "set_document_type"]
+    assert calls[0] == {"documents": [1, 2], "method": "modify_tags", "parameters": {"add_tags": [5], "remove_tags": [6]}}
+    assert calls[2]["parameters"] == {"document_type": 3}
+    assert results == {1: {"ok": True}, 2: {"ok": True}, 3: {"ok": True}}
+
+"""
+Tests that a failed bulk edit is reported per document.
+"""
+@pytest.mark.asyncio
+async def test_bulk_failure():
+    results = await BulkEditor(paperless(fail=True)).run([{"documents": [1], "correspondent": None}])
+    assert results[1]["ok"] is False
+    assert "set_correspondent" in results[1]["errors"][0]
+
+"""
+Tests that the tag batcher writes the tags of several documents with one request.
+
+Expected Outcome:
+- Nothing is written before the batch is full, then one modify_tags request for both documents.
+"""
+@pytest.mark.asyncio
+async def test_tag_batcher():
+    api = paperless()
+    batcher = TagBatcher(BulkEditor(api), size=2, interval=60)
+
+    first = await batcher.add(1, add=[5], remove=[6])
+    api.request_json.assert_not_awaited()
+    assert not first.done()
+    second = await batcher.add(2, add=[5], remove=[6])
+
+    api.request_json.assert_awaited_once()
+    assert api.request_json.call_args.kwargs["json"]["documents"] == [1, 2]
+    assert await first is True and await second is True
+    assert batcher.status() == {"pending": 0, "flushed": 2, "failed": 0}
+    assert await batcher.add(3) is None  # Nothing to change
+    batcher._task.cancel()
+
+"""
+Tests that a failed flush is reported to the documents of the batch.
+
+Expected Outcome:
+- The futures of both documents raise, so their queue entries are not acknowledged.
+- Both documents are counted as failed.
+"""
+@pytest.mark.asyncio
+async def test_tag_batcher_failure():
+    batcher = TagBatcher(BulkEditor(paperless(fail=True)), size=2, interval=60)
+
+    first = await batcher.add(1, add=[5])
+    second = await batcher.add(2, add=[5])
+
+    for written in (first, second):
+        with pytest.raises(RuntimeError, match="Bad Request"):
+            await written
+    assert batcher.status() == {"pending": 0, "flushed": 0, "failed": 2}
+    batcher._task.cancel()
@@ -0,0 +1,222 @@
+import asyncio, pytest
+from types import SimpleNamespace
+from services.cache import Cache
+
+"""
+Provides an async iterable of Paperless items, like `api.tags`.
+
+Parameters:
+- count (int): Number of items.
+
+Returns:
+- The iterable, its "fetches" attribute counts the iterations. If "gate" is set to an
+  event, the iteration waits for it.
+"""
+class FakeItems:
+    def __init__(self, count: int):
+        self.items = [SimpleNamespace(id=index, name=f"Tag {index}") for index in range(1, count + 1)]
+        self.fetches = 0
+        self.gate = None
+
+    async def __aiter__(self):
+        self.fetches += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        for item in self.items:
+            yield item
+
+def makeCache(count: int) -> Cache:
+    tags = FakeItems(count)
+    api = SimpleNamespace(tags=tags, correspondents=FakeItems(0), document_types=FakeItems(0), storage_paths=FakeItems(0))
+    return Cache(api, cache_time=60)
+
+"""
+Tests the lookups by id and by name.
+
+Expected Outcome:
+- Names are found regardless of case and whitespace.
+- Batch lookups return the results in order, None for unknown entries.
+- All lookups share one fetch of the tags.
+"""
+@pytest.mark.asyncio
+async def test_lookups():
+    cache = makeCache(3)
+    assert await cache.getTagNameByID(2) == "Tag 2"
+    assert await cache.getTagIDByName("  tag   3 ") == 3
+    assert await cache.getTagIDByName("TAG 1") == 1
+    assert await cache.getTagIDByName("Tag 4") is None
+    assert await cache.getTagListNamesByID([3, 1, 9]) == ["Tag 3", "Tag 1", None]
+    assert await cache.getTagIDsByName(["tag 2", "unknown"]) == [2, None]
+    assert cache._api.tags.fetches == 1
+
+"""
+Item list which fails as soon as it is scanned.
+"""
+class NoScanList(list):
+    def __iter__(self):
+        raise AssertionError("The lookup scanned the item list")
+
+    def __contains__(self, item):
+        raise AssertionError("The lookup scanned the item list")
+
+    def index(self, *args):
+        raise AssertionError("The lookup scanned the item list")
+
+"""
+Tests that the lookups use the indexes by id and name and never scan the item list.
+
+Expected Outcome:
+- Every lookup kind is answered while the item list refuses iteration.
+"""
+@pytest.mark.asyncio
+async def test_lookup_uses_indexes():
+    cache = makeCache(1000)
+    await cache.getTagNameByID(1)  # Fill the cache
+    cache._tagsCache["cache"] = NoScanList(list.__iter__(cache._tagsCache["cache"]))
+
+    assert await cache.getTagNameByID(999) == "Tag 999"
+    assert await cache.getTagIDByName("TAG 500") == 500
+    assert await cache.getTagIDsByName(["tag 2", "unknown"]) == [2, None]
+    assert await cache.getTagListNamesByID([3, 1001]) == ["Tag 3", None]
+
+"""
+Index which counts its lookups.
+"""
+class CountingDict(dict):
+    lookups = 0
+
+    def get(self, key, default=None):
+        CountingDict.lookups += 1
+        return super().get(key, default)
+
+    def __getitem__(self, key):
+        CountingDict.lookups += 1
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        CountingDict.lookups += 1
+        return super().__contains__(key)
+
+"""
+Benchmark of the lookups in caches with 1k and 100k tags, counted in index lookups
+instead of wall-clock time, so the result does not depend on the machine.
+
+Expected Outcome:
+- 1000 lookups by id and 1000 lookups by name cost one index lookup each, in both caches.
+- The item list of 100k tags is never scanned.
+"""
+@pytest.mark.asyncio
+async def test_lookup_benchmark():
+    async def measure(count: int) -> int:
+        cache = makeCache(count)
+        await cache.getTagNameByID(1)  # Fill the cache
+        container = cache._tagsCache
+        container.update(cache=NoScanList(list.__iter__(container["cache"])), byID=CountingDict(container["byID"]), byName=CountingDict(container["byName"]))
+        CountingDict.lookups = 0
+        await cache.getTagIDsByName([f"tag {index}" for index in range(1, 1001)])
+        for index in range(1, 1001):
+            assert await cache.getTagNameByID(index) == f"Tag {index}"
+        return CountingDict.lookups
+
+    assert await measure(1000) == await measure(100000) == 2000
+
+"""
+Tests that concurrent lookups share one refresh and expired items are served while refreshing.
+
+Scenario:
+- Ten lookups hit an empty cache at the same time.
+- The cache expires and the next refresh is slow.
+
+Expected Outcome:
+- The first load fetches the tags once for all lookups.
+- After the expiry the lookup answers right away from the previous items, one background
+  refresh swaps in the new items.
+"""
+@pytest.mark.asyncio
+async def test_single_flight_refresh():
+    cache = makeCache(3)
+    tags = cache._api.tags
+    results = await asyncio.gather(*(cache.getTagIDByName("Tag 2") for _ in range(10)))
+    assert results == [2] * 10
+    assert tags.fetches == 1
+
+    tags.gate = asyncio.Event()
+    tags.items.append(SimpleNamespace(id=4, name="Tag 4"))
+    cache._tagsCache["lastRefresh"] -= cache._cache_time * 60  # Expired
+
+    assert await asyncio.wait_for(cache.getTagIDByName("Tag 4"), 0.5) is None  # Previous items
+    assert await cache.getTagIDByName("Tag 1") == 1
+    refresh = cache._tagsCache["task"]
+    assert refresh is not None and not refresh.done()
+
+    tags.gate.set()
+    await refresh
+    assert await cache.getTagIDByName("Tag 4") == 4
+    assert tags.fetches == 2
+
+"""
+Provides a Paperless API with tags whose list endpoint reports the ids of all tags.
+
+Returns:
+- The API, its "requests" attribute records the parameters of every request.
+"""
+class FakeApi(SimpleNamespace):
+    def __init__(self, count: int):
+        super().__init__(tags=FakeItems(count), correspondents=FakeItems(0), document_types=FakeItems(0), storage_paths=FakeItems(0))
+        self.requests = []
+
+    async def request_json(self, method: str, endpoint: str, params: dict = None):
+        self.requests.append(params)
+        items = {item.id: item for item in self.tags.items}
+        if "id__in" in params:
+            ids = [int(key) for key in params["id__in"].split(",")]
+            return {"results": [{"id": key, "name": items[key].name} for key in ids if key in items]}
+        return {"count": len(items), "all": list(items), "results": []}
+
+"""
+Tests the incremental refresh.
+
+Scenario:
+- After the first full load one tag is deleted, one is renamed and one is added.
+
+Expected Outcome:
+- The refresh fetches only the new tag, the deleted tag is dropped.
+- The rename is picked up by the full refresh once its interval passed.
+- Once the full refresh interval passed, all tags are listed again.
+"""
+@pytest.mark.asyncio
+async def test_delta_refresh():
+    api = FakeApi(3)
+    cache = Cache(api, cache_time=60, full_refresh=360)
+    await cache.getTagNameByID(1)
+    assert api.tags.fetches == 1
+
+    api.tags.items = [item for item in api.tags.items if item.id != 2] + [SimpleNamespace(id=4, name="Tag 4")]
+    api.tags.items[0].name = "Renamed"
+    await cache.refreshCacheOfContainer(cache._tagsCache, api.tags)
+    assert api.tags.fetches == 1
+    assert api.requests == [{"page_size": 1}, {"id__in": "4", "fields": "id,name", "page_size": 1}]
+    assert await cache.getTagListNamesByID([1, 2, 3, 4]) == ["Tag 1", None, "Tag 3", "Tag 4"]
+
+    cache._tagsCache["lastFull"] -= 360 * 60
+    await cache.refreshCacheOfContainer(cache._tagsCache, api.tags)
+    assert api.tags.fetches == 2
+    assert await cache.getTagIDByName("renamed") == 1 and await cache.getTagIDByName("Tag 1") is None
+
+"""
+Tests that the cache is restored from its snapshot after a restart.
+
+Expected Outcome:
+- A new cache on the same snapshot answers lookups without fetching the tags.
+"""
+@pytest.mark.asyncio
+async def test_snapshot(tmp_path):
+    path = str(tmp_path / "metadata_cache.json")
+    cache = Cache(FakeApi(3), cache_time=60, snapshot_path=path)
+    assert await cache.getTagIDByName("Tag 3") == 3
+
+    api = FakeApi(3)
+    restarted = Cache(api, cache_time=60, snapshot_path=path)
+    assert await restarted.getTagIDByName("tag 3") == 3
+    assert await restarted.getTagNameByID(1) == "Tag 1"
+    assert api.tags.fetches == 0 and api.requests == []
@@ -0,0 +1,86 @@
+import pytest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock, AsyncMock
+from services.changeset import DocumentChangeSet, ConflictError
+
+MODIFIED = "2025-01-01T10:00:00+00:00"
+
+def document(tags: list, title: str = "Old", modified: str = MODIFIED):
+    return SimpleNamespace(id=7, title=title, tags=list(tags), modified=datetime.fromisoformat(modified))
+
+def paperless(modified: str = MODIFIED, current=None):
+    api = MagicMock()
+
+    async def request_json(method, path, params=None, json=None):
+        if method == "get":
+            return {"count": 1, "results": [{"id": 7, "modified": modified}]}
+        return {"id": 7, "modified": "2025-01-02T10:00:00Z"}
+
+    api.request_json = AsyncMock(side_effect=request_json)
+    api.documents = AsyncMock(return_value=current)
+    return api
+
+"""
+Tests that field and tag changes are written with one PATCH.
+
+Expected Outcome:
+- Only the changed fields and the resulting tag list are sent.
+- Without the conflict check the PATCH is the only request.
+"""
+@pytest.mark.asyncio
+async def test_commit_single_patch():
+    doc = document([1, 2])
+    api = paperless()
+    changes = DocumentChangeSet(doc).set("title", "New").removeTags([2]).addTags([3])
+
+    assert await changes.commit(api) is True
+
+    assert api.request_json.await_count == 1
+    method, path = api.request_json.call_args.args
+    assert (method, path) == ("patch", "/api/documents/7/")
+    assert api.request_json.call_args.kwargs["json"] == {"title": "New", "tags": [1, 3]}
+    assert doc.tags == [1, 3]
+    assert doc.modified == datetime(2025, 1, 2, 10, tzinfo=timezone.utc)
+
+"""
+Tests that nothing is written if the changes do not change anything.
+"""
+@pytest.mark.asyncio
+async def test_commit_nothing_changed():
+    api = paperless()
+    changes = DocumentChangeSet(document([1])).set("title", "Old").addTags([1])
+
+    assert await changes.commit(api, check_conflicts=False) is False
+    api.request_json.assert_not_awaited()
+
+"""
+Tests that changes are applied on top of a document which was modified in the meantime.
+
+Scenario:
+- Someone added tag 5 while the document was processed.
+
+Expected Outcome:
+- The document is fetched again and tag 5 is kept.
+"""
+@pytest.mark.asyncio
+async def test_commit_conflict():
+    current = document([1, 5], modified="2025-01-01T11:00:00+00:00")
+    api = paperless(modified="2025-01-01T11:00:00+00:00", current=current)
+    changes = DocumentChangeSet(document([1])).removeTags([1]).addTags([3])
+
+    assert await changes.commit(api, check_conflicts=True) is True
+    assert api.request_json.await_count == 2
+    api.documents.assert_awaited_once_with(7)
+    assert api.request_json.call_args.kwargs["json"] == {"tags": [5, 3]}
+
+"""
+Tests that a deleted document is reported as a conflict.
+"""
+@pytest.mark.asyncio
+async def test_commit_deleted():
+    api = MagicMock()
+    api.request_json = AsyncMock(return_value={"count": 0, "results": []})
+
+    with pytest.raises(ConflictError):
+        await DocumentChangeSet(document([1])).set("title", "New").commit(api, check_conflicts=True)
@@ -0,0 +1,130 @@
+import pytest
+import numpy as np
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from services.classifier import Classifier
+
+"""
+Creates a fake Paperless document.
+"""
+def document(doc_id, content, correspondent=None, document_type=None, storage_path=None):
+    return SimpleNamespace(id=doc_id, title="", content=content, correspondent=correspondent,
+                           document_type=document_type, storage_path=storage_path)
+
+"""
+Provides a classifier with a fake AI which embeds texts by counting the letters a, b and c.
+
+Returns:
+- Classifier: A classifier with an empty index in a temporary directory.
+"""
+@pytest.fixture
+def classifier(tmp_path):
+    ai = MagicMock()
+    ai.embed = AsyncMock(side_effect=lambda texts, model: [[text.count("a"), text.count("b"), text.count("c")] for text in texts])
+    cache = MagicMock()
+    cache.getCorrespondentNameByID = AsyncMock(side_effect=lambda key: f"Correspondent {key}")
+    cache.getDocumentTypeNameByID = AsyncMock(side_effect=lambda key: f"Type {key}")
+    cache.getStoragePathNameByID = AsyncMock(side_effect=lambda key: f"Path {key}")
+    cache.getAllPaths = AsyncMock(return_value=[])
+    return Classifier(ai, MagicMock(), cache, str(tmp_path / "index.npz"), "embed-model", k=3, threshold=0.9)
+
+"""
+Tests that the nearest neighbours decide the suggestion.
+
+Scenario:
+- Documents of two correspondents with clearly different content are indexed.
+
+Expected Outcome:
+- A new document is assigned to the correspondent with similar documents, without asking the AI.
+"""
+@pytest.mark.asyncio
+async def test_suggest_knn(classifier):
+    await classifier._add([
+        document(1, "aaaa", correspondent=10, document_type=1),
+        document(2, "aaab", correspondent=10, document_type=1),
+        document(3, "bbbb", correspondent=20, document_type=2),
+        document(4, "cccc", correspondent=30),
+    ])
+
+    suggestions = await classifier.suggest([document(5, "aaaa b")])
+
+    assert suggestions[5]["correspondent"]["id"] == 10
+    assert suggestions[5]["correspondent"]["name"] == "Correspondent 10"
+    assert suggestions[5]["correspondent"]["source"] == "knn"
+    assert suggestions[5]["document_type"]["id"] == 1
+    assert suggestions[5]["storage_path"]["id"] is None
+
+"""
+Tests that the index survives a restart.
+
+Expected Outcome:
+- A saved index is loaded with the same documents and labels.
+- An index built with another embedding model is discarded.
+"""
+@pytest.mark.asyncio
+async def test_save_load(classifier, tmp_path):
+    await classifier._add([document(1, "aaaa", correspondent=10), document(2, "bbbb", correspondent=20)])
+    await classifier.save()
+
+    restored = Classifier(classifier.ai, MagicMock(), MagicMock(), str(tmp_path / "index.npz"), "embed-model")
+    assert await restored.load() is True
+    assert len(restored) == 2
+    vectors = np.stack(await restored._embed([document(3, "bbb")]))
+    assert restored.vote(vectors)[0]["correspondent"][0] == 20
+
+    other = Classifier(classifier.ai, MagicMock(), MagicMock(), str(tmp_path / "index.npz"), "other-model")
+    assert await other.load() is False
+
+"""
+Fake Paperless API which lists the given documents and reports their ids in "all".
+"""
+class FakeDocuments:
+    def __init__(self, documents):
+        self.documents = documents
+        self.filters = []
+
+    def reduce(self, **filters):
+        self.filters.append(filters)
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def __aiter__(self):
+        for item in self.documents:
+            yield item
+
+"""
+Tests that documents deleted in Paperless are removed from the index.
+
+Scenario:
+- Three documents are indexed by a full synchronisation.
+- Document 2 is deleted in Paperless before the next incremental synchronisation.
+
+Expected Outcome:
+- The deleted document is dropped from the index and can no longer vote.
+- The remaining documents keep their labels.
+"""
+@pytest.mark.asyncio
+async def test_sync_prunes_deleted(classifier):
+    documents = [document(1, "aaaa", correspondent=10), document(2, "bbbb", correspondent=20), document(3, "cccc", correspondent=30)]
+    api = SimpleNamespace(documents=FakeDocuments(documents))
+    api.request_json = AsyncMock(side_effect=lambda method, path, params: {"all": [item.id for item in api.documents.documents]})
+    classifier._api = api
+
+    assert await classifier.sync(full=True) == 3
+    assert len(classifier) == 3
+
+    api.documents.documents = [documents[0], documents[2]]
+    await classifier.sync()
+
+    assert len(classifier) == 2
+    assert 2 not in classifier._positions
+    assert "modified__gt" in api.documents.filters[-1]
+    api.request_json.assert_awaited_with("get", "/api/documents/", params={"page_size": 1, "fields": "id"})
+    vectors = np.stack(await classifier._embed([document(4, "bbb c")]))
+    assert classifier.vote(vectors)[0]["correspondent"][0] == 30
+    assert classifier._labels["correspondent"].tolist() == [10, 30]
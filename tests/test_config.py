@@ -0,0 +1,49 @@
+import os
+from unittest.mock import patch
+from services.config import parseLaneValues
+
+"""
+Tests the parsing of the per lane settings.
+
+Scenario:
+- The setting only changes one lane and contains entries without a colon, without a lane and with a text.
+
+Expected Outcome:
+- The valid entry overrides its default, the other lanes keep their defaults.
+- The malformed entries are skipped with an error message instead of failing the start.
+"""
+def test_parse_lane_values():
+    with patch.dict("os.environ", {"QUEUE_LANE_DELAYS": "bulk:300,webhook,:5,interactive:soon"}), \
+         patch("services.config.logging.error") as mock_error:
+        delays = parseLaneValues("QUEUE_LANE_DELAYS", "interactive:0,webhook:60,bulk:900")
+
+    assert delays == {"interactive": 0, "webhook": 60, "bulk": 300}
+    assert mock_error.call_count == 3
+
+"""
+Tests that ADMISSION_SHED keeps the shedding levels of the lanes it does not list.
+"""
+def test_parse_shed_levels():
+    with patch.dict("os.environ", {"ADMISSION_SHED": "bulk=0.3,webhook:0.8"}), patch("services.config.logging.error"):
+        shed = parseLaneValues("ADMISSION_SHED", "bulk:0.5,webhook:0.9,interactive:1.0")
+
+    assert shed == {"bulk": 0.5, "webhook": 0.8, "interactive": 1.0}
+
+"""
+Tests that the default inference concurrency grows with the number of Ollama hosts.
+
+Expected Outcome:
+- Three hosts get 6 inference slots and enough workers to keep them busy.
+"""
+def test_concurrency_defaults():
+    import importlib
+    from services import config
+    environment = {"OLLAMA_HOST": "http://a:11434,http://b:11434,http://c:11434"}
+    try:
+        with patch.dict("os.environ", environment):
+            for name in ("INFERENCE_CONCURRENCY", "WORKER_COUNT"):
+                os.environ.pop(name, None)
+            importlib.reload(config)
+            assert (config.INFERENCE_CONCURRENCY, config.WORKER_COUNT) == (6, 8)
+    finally:
+        importlib.reload(config)
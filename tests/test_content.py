@@ -0,0 +1,52 @@
+import pytest
+from services.content import estimateTokens, parseStrategy, prepareContent
+
+"""
+Tests parsing of content strategies.
+
+Expected Outcome:
+- Valid strategies are split into mode and budget, invalid ones raise a ValueError.
+"""
+def test_parseStrategy():
+    assert parseStrategy("head:2000") == ("head", 2000)
+    assert parseStrategy("full") == ("full", None)
+    with pytest.raises(ValueError):
+        parseStrategy("tail:100")
+    with pytest.raises(ValueError):
+        parseStrategy("head")
+
+"""
+Tests that the head and window strategies keep the content within the token budget.
+
+Scenario:
+- A document of roughly 10000 tokens is prepared with a budget of 1000 tokens.
+
+Expected Outcome:
+- A single content part within the budget is returned.
+"""
+def test_prepareContent_budget():
+    content = "word " * 8000
+
+    for strategy in ("head:1000", "window:1000"):
+        parts = prepareContent(content, strategy)
+        assert len(parts) == 1
+        assert estimateTokens(parts[0]) <= 1010
+
+    assert prepareContent(content, "full") == [content]
+    assert prepareContent("short", "head:1000") == ["short"]
+
+"""
+Tests that the mapreduce strategy covers the whole document with a bounded number of chunks.
+
+Expected Outcome:
+- Every chunk fits the budget and the number of chunks never exceeds `max_chunks`.
+"""
+def test_prepareContent_mapreduce():
+    content = "line of text\n" * 4000
+
+    chunks = prepareContent(content, "mapreduce:1000")
+    assert len(chunks) > 1
+    assert all(estimateTokens(chunk) <= 1000 for chunk in chunks)
+    assert chunks[0].startswith("line") and content.endswith(chunks[-1])
+
+    assert len(prepareContent(content, "mapreduce:100", max_chunks=5)) == 5
@@ -0,0 +1,80 @@
+import json, logging, pytest
+from unittest.mock import patch, AsyncMock
+from services.ai_api import AI
+from services.inference_cache import InferenceCache
+
+# Initialize a logger for testing
+logger = logging.getLogger("test_logger")
+
+"""
+Provides an inference cache backed by a temporary database.
+
+Returns:
+- InferenceCache: A cache which keeps at most three entries.
+"""
+@pytest.fixture
+def inference_cache(tmp_path):
+    return InferenceCache(str(tmp_path / "cache.sqlite"), max_entries=3, max_age=1)
+
+"""
+Tests storing and retrieving a result.
+
+Scenario:
+- A result is looked up before and after it was stored.
+
+Expected Outcome:
+- The first lookup is a miss, the second one a hit.
+"""
+@pytest.mark.asyncio
+async def test_get_put(inference_cache):
+    key = InferenceCache.key("model", "system", "content", "prompt")
+
+    assert await inference_cache.get(key) is None
+    await inference_cache.put(key, "value")
+    assert await inference_cache.get(key) == "value"
+
+    stats = inference_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["entries"] == 1
+
+"""
+Tests that the cache is trimmed to its maximum size.
+
+Scenario:
+- More results than `max_entries` are stored and an eviction is run.
+
+Expected Outcome:
+- Only the most recently used entries remain.
+"""
+@pytest.mark.asyncio
+async def test_eviction(inference_cache):
+    for index in range(5):
+        await inference_cache.put(InferenceCache.key("model", "system", f"content {index}", "prompt"), str(index))
+    inference_cache._evict()
+
+    assert inference_cache.stats()["entries"] == 3
+    assert await inference_cache.get(InferenceCache.key("model", "system", "content 0", "prompt")) is None
+    assert await inference_cache.get(InferenceCache.key("model", "system", "content 4", "prompt")) == "4"
+
+"""
+Tests that the AI serves repeated requests from the cache.
+
+Scenario:
+- The same document is processed twice, then once more with the bypass flag.
+
+Expected Outcome:
+- The model is called for the first and the bypassed request only.
+"""
+@pytest.mark.asyncio
+async def test_ai_uses_cache(inference_cache):
+    ai_instance = AI(model="test_model", logger=logger, datafields=["title"], cache=inference_cache)
+    mock_response = {"message": {"content": json.dumps({"title": "Invoice"})}}
+
+    with patch.object(ai_instance._pool.backends[0].client, "chat", new_callable=AsyncMock, return_value=mock_response) as mock_chat:
+        assert await ai_instance.getResponses("Test content", {"title": "Get the title"}) == {"title": "Invoice"}
+        assert await ai_instance.getResponses("Test content", {"title": "Get the title"}) == {"title": "Invoice"}
+        assert mock_chat.await_count == 1
+
+        await ai_instance.getResponses("Test content", {"title": "Get the title"}, bypass_cache=True)
+        assert mock_chat.await_count == 2
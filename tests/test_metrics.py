@@ -0,0 +1,46 @@
+import pytest
+from services.metrics import Registry
+
+"""
+Tests the Prometheus text format of the metric types.
+
+Expected Outcome:
+- Counters are summed per label values, label values are escaped.
+- Histogram buckets are cumulative and end with +Inf, sum and count.
+"""
+def test_render():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests", ("backend",))
+    histogram = registry.histogram("stage_seconds", "Stages", ("stage",), buckets=(0.1, 1))
+
+    counter.inc("paperless")
+    counter.inc("paperless", amount=2)
+    counter.inc('say "hi"')
+    for value in (0.05, 0.5, 5):
+        histogram.observe("fetch", value=value)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{backend="paperless"} 3' in lines
+    assert 'requests_total{backend="say \\"hi\\""} 1' in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="+Inf"} 3' in lines
+    assert 'stage_seconds_sum{stage="fetch"} 5.55' in lines
+    assert 'stage_seconds_count{stage="fetch"} 3' in lines
+
+"""
+Tests the /metrics endpoint.
+
+Expected Outcome:
+- The endpoint answers in the Prometheus text format and contains the queue and breaker gauges.
+"""
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    from app import app
+    response = await app.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    text = await response.get_data(as_text=True)
+    assert 'paperless_pipeline_queue_entries{state="pending"}' in text
+    assert 'paperless_pipeline_breaker_open{backend="paperless"} 0' in text
@@ -0,0 +1,209 @@
+import asyncio, time, pytest
+from services.queue import PersistentQueue
+
+"""
+Provides a persistent queue backed by a temporary database.
+
+Returns:
+- PersistentQueue: A queue which retries an entry once, without delay.
+"""
+@pytest.fixture
+def request_queue(tmp_path):
+    return PersistentQueue(str(tmp_path / "queue.sqlite"), max_attempts=2, retry_delay=0, poll_interval=0.05)
+
+"""
+Tests that entries are handed out in order and removed once acknowledged.
+
+Expected Outcome:
+- The entries are returned in the order they were added, with their queue id and attempt.
+- The queue is empty after both entries were acknowledged.
+"""
+@pytest.mark.asyncio
+async def test_put_get_ack(request_queue):
+    await request_queue.put({"doc_id": 1})
+    await request_queue.putMany([{"doc_id": 2}])
+
+    first = await request_queue.get()
+    second = await request_queue.get()
+    assert (first["doc_id"], second["doc_id"]) == (1, 2)
+    assert first["attempts"] == 1
+    assert request_queue.stats() == {"pending": 0, "leased": 2, "failed": 0}
+
+    await request_queue.ack(first["queue_id"], first["lease"])
+    await request_queue.ack(second["queue_id"], second["lease"])
+    await asyncio.wait_for(request_queue.join(), 1)
+    assert request_queue.qsize() == 0
+
+"""
+Tests that a failed entry is retried and given up after the maximum number of attempts.
+
+Expected Outcome:
+- The first failure returns the entry to the queue, the second marks it as failed.
+"""
+@pytest.mark.asyncio
+async def test_nack_retry(request_queue):
+    await request_queue.put({"doc_id": 1})
+
+    entry = await request_queue.get()
+    assert await request_queue.nack(entry["queue_id"], entry["lease"], "timeout") is True
+
+    entry = await asyncio.wait_for(request_queue.get(), 1)
+    assert entry["attempts"] == 2
+    assert await request_queue.nack(entry["queue_id"], entry["lease"], "timeout") is False
+    assert request_queue.stats()["failed"] == 1
+    await asyncio.wait_for(request_queue.join(), 1)
+
+"""
+Tests that entries leased by a stopped process are processed again after a restart.
+
+Expected Outcome:
+- A new queue on the same file hands out the unacknowledged entry again.
+"""
+@pytest.mark.asyncio
+async def test_recovery(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    request_queue = PersistentQueue(path)
+    await request_queue.put({"doc_id": 7})
+    await request_queue.get()  # Leased, but never acknowledged
+    request_queue.close()
+
+    restarted = PersistentQueue(path)
+    assert restarted.qsize() == 1
+    entry = await asyncio.wait_for(restarted.get(), 1)
+    assert entry["doc_id"] == 7
+    assert entry["attempts"] == 2
+
+"""
+Tests that enqueueing is fast enough for bursts of webhooks.
+
+Expected Outcome:
+- 1000 single entries are stored within a few seconds.
+"""
+@pytest.mark.asyncio
+async def test_put_throughput(request_queue):
+    start = time.monotonic()
+    for doc_id in range(1000):
+        await request_queue.put({"doc_id": doc_id})
+    assert time.monotonic() - start < 5
+    assert request_queue.qsize() == 1000
+
+"""
+Tests that entries for the same key are coalesced.
+
+Scenario:
+- A second entry arrives while the first one is pending, a third while it is processed.
+
+Expected Outcome:
+- The second entry is merged into the first, the third is deferred until the first is acknowledged.
+"""
+@pytest.mark.asyncio
+async def test_coalesce(request_queue):
+    from routes.processing import merge_entries
+    first, status = await request_queue.put({"fields": [{"title": "a"}], "tag": "one"}, key=5, merge=merge_entries)
+    assert status == "queued"
+    merged, status = await request_queue.put({"fields": [{"summary": "b"}], "tag": "two"}, key=5, merge=merge_entries)
+    assert (merged, status) == (first, "merged")
+
+    entry = await request_queue.get()
+    assert entry["fields"] == [{"title": "a"}, {"summary": "b"}]
+    assert entry["tag"] == "two"
+
+    _, status = await request_queue.put({"fields": [{"title": "c"}], "tag": "three"}, key=5, merge=merge_entries)
+    assert status == "deferred"
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(request_queue.get(), 0.2)  # Not handed out while the first entry is processed
+
+    await request_queue.ack(entry["queue_id"], entry["lease"])
+    deferred = await asyncio.wait_for(request_queue.get(), 1)
+    assert deferred["tag"] == "three"
+
+"""
+Tests that urgent lanes overtake bulk work without starving it.
+
+Scenario:
+- A bulk entry is queued before an interactive entry, later an old bulk entry is past its lane delay.
+
+Expected Outcome:
+- The interactive entry is handed out first.
+- A bulk entry which waited longer than its lane delay is handed out before a newer webhook entry.
+- A new interactive entry still overtakes bulk entries which waited longer than their lane delay.
+"""
+@pytest.mark.asyncio
+async def test_priority_lanes(tmp_path):
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"), lanes={"interactive": 0, "webhook": 60, "bulk": 0.2})
+    await request_queue.put({"doc_id": 1}, lane="bulk")
+    await request_queue.put({"doc_id": 2}, lane="interactive")
+    assert (await request_queue.get())["doc_id"] == 2
+    assert (await request_queue.get())["doc_id"] == 1
+
+    await request_queue.put({"doc_id": 3}, lane="bulk")
+    await asyncio.sleep(0.3)
+    await request_queue.put({"doc_id": 4}, lane="webhook")
+    assert (await request_queue.get())["doc_id"] == 3
+
+    for doc_id in (5, 6):
+        await request_queue.put({"doc_id": doc_id}, lane="bulk")
+    await asyncio.sleep(0.3)
+    await request_queue.put({"doc_id": 7}, lane="interactive")
+    assert [(await request_queue.get())["doc_id"] for _ in range(3)] == [7, 5, 6]
+
+    lanes = request_queue.laneStats()
+    assert lanes["bulk"]["claimed"] == 4 and lanes["interactive"]["claimed"] == 2
+    assert lanes["webhook"]["pending"] == 1
+    with pytest.raises(ValueError):
+        await request_queue.put({"doc_id": 8}, lane="urgent")
+
+"""
+Tests that a postponed entry does not use up an attempt.
+
+Expected Outcome:
+- The entry is handed out again after the delay with the same attempt number.
+"""
+@pytest.mark.asyncio
+async def test_postpone(request_queue):
+    await request_queue.put({"doc_id": 1})
+
+    entry = await request_queue.get()
+    await request_queue.postpone(entry["queue_id"], entry["lease"], 0.1)
+    assert request_queue.stats()["pending"] == 1
+
+    entry = await asyncio.wait_for(request_queue.get(), 1)
+    assert entry["attempts"] == 1
+
+"""
+Tests the lease of an entry which takes longer than the lease to process.
+
+Scenario:
+- One entry is renewed by its worker, the lease of the other one expires and it is handed out again.
+
+Expected Outcome:
+- The renewed entry is not handed out a second time.
+- The worker which lost its lease can neither acknowledge, fail nor postpone the entry,
+  the new holder acknowledges it and the depth only drops once per entry.
+"""
+@pytest.mark.asyncio
+async def test_lease(tmp_path):
+    request_queue = PersistentQueue(str(tmp_path / "queue.sqlite"), lease=0.2, poll_interval=0.05)
+    await request_queue.putMany([{"doc_id": 1}, {"doc_id": 2}])
+    renewed = await request_queue.get()
+    expired = await request_queue.get()
+
+    heartbeat = asyncio.create_task(request_queue.heartbeat(renewed["queue_id"], renewed["lease"], 0.05))
+    taken_over = await asyncio.wait_for(request_queue.get(), 1)
+    assert taken_over["doc_id"] == 2 and taken_over["lease"] != expired["lease"]
+    heartbeats = [heartbeat, asyncio.create_task(request_queue.heartbeat(taken_over["queue_id"], taken_over["lease"], 0.05))]
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(request_queue.get(), 0.3)  # Both entries stay leased
+    for heartbeat in heartbeats:
+        heartbeat.cancel()
+
+    assert await request_queue.ack(expired["queue_id"], expired["lease"]) is False
+    assert await request_queue.nack(expired["queue_id"], expired["lease"], "late") is False
+    assert await request_queue.postpone(expired["queue_id"], expired["lease"], 0) is False
+    assert await request_queue.extendLease(expired["queue_id"], expired["lease"]) is False
+    assert request_queue.depth == 2
+
+    assert await request_queue.ack(taken_over["queue_id"], taken_over["lease"]) is True
+    assert await request_queue.ack(renewed["queue_id"], renewed["lease"]) is True
+    assert request_queue.depth == 0
+    await asyncio.wait_for(request_queue.join(), 1)
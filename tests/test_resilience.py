@@ -0,0 +1,82 @@
+import asyncio, pytest
+from services.resilience import Resilience, CircuitBreaker, CircuitOpenError, isTransient
+
+"""
+Provides an operation which fails a given number of times before it succeeds.
+
+Parameters:
+- failures (int): Number of failing calls.
+- error (Exception): The raised error.
+
+Returns:
+- callable: The operation, its "calls" attribute counts the calls.
+"""
+def flaky(failures: int, error: Exception = ConnectionError("down")):
+    async def operation():
+        operation.calls += 1
+        if operation.calls <= failures:
+            raise error
+        return "ok"
+    operation.calls = 0
+    return operation
+
+"""
+Tests that transient errors are retried and other errors are raised right away.
+
+Expected Outcome:
+- Two connection errors are retried, the third attempt succeeds.
+- A ValueError is not retried.
+"""
+@pytest.mark.asyncio
+async def test_retry():
+    resilience = Resilience("paperless", timeout=1, retries=3, base_delay=0.01)
+    operation = flaky(2)
+    assert await resilience.call(operation) == "ok"
+    assert operation.calls == 3
+    assert resilience.status()["retried"] == 2
+
+    operation = flaky(1, ValueError("bad"))
+    with pytest.raises(ValueError):
+        await resilience.call(operation)
+    assert operation.calls == 1
+    assert resilience.breaker.state == CircuitBreaker.CLOSED
+
+"""
+Tests the deadline of an attempt.
+
+Expected Outcome:
+- A hanging operation is cancelled after the timeout and counts as transient failure.
+"""
+@pytest.mark.asyncio
+async def test_deadline():
+    resilience = Resilience("ollama", timeout=0.05, retries=0)
+    with pytest.raises(asyncio.TimeoutError):
+        await resilience.call(lambda: asyncio.sleep(10))
+    assert resilience.breaker.failures == 1
+    assert isTransient(asyncio.TimeoutError())
+
+"""
+Tests the states of the circuit breaker.
+
+Expected Outcome:
+- After two failed calls the breaker opens and calls fail without reaching the backend.
+- After the reset timeout one trial call is made, its success closes the breaker.
+"""
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    resilience = Resilience("paperless", timeout=1, retries=0, failure_threshold=2, reset_timeout=0.1)
+    operation = flaky(2)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await resilience.call(operation)
+    assert resilience.breaker.state == CircuitBreaker.OPEN
+    assert resilience.breaker.retryIn() > 0
+
+    with pytest.raises(CircuitOpenError):
+        await resilience.call(operation)
+    assert operation.calls == 2
+
+    await asyncio.wait_for(resilience.breaker.wait(), 1)
+    assert await resilience.call(operation) == "ok"
+    status = resilience.status()
+    assert (status["state"], status["trips"], status["failures"]) == ("closed", 1, 0)